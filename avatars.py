@@ -0,0 +1,154 @@
+import hashlib
+import os
+import re
+import threading
+from io import BytesIO
+from flask import abort, current_app, request, url_for
+from page_cache import FileSystemCache
+
+# Comment avatars are served from /avatar/<hash> instead of linking every commenter's
+# gravatar.com image. Each avatar is fetched from Gravatar once (at the largest size), resized
+# to every size in AVATAR_SIZES, and kept in an LRU cache on disk (the page cache's file
+# backend) holding at most AVATAR_CACHE_MAX_ENTRIES images for AVATAR_CACHE_TTL seconds. Browsers
+# get them with a long max-age and an ETag. People without a Gravatar, and any failed fetch,
+# get static/assets/img/default-profile.jpg.
+#
+# The hash is saved with each user (User.avatar_hash) so pages don't hash emails. Point
+# AVATAR_UPSTREAM at a local server to try it without Gravatar. Pillow is only needed for the
+# resizing, without it every size gets the image Gravatar sent. requests is imported by the first
+# fetch, not when the app starts.
+
+GRAVATAR_URL = "https://www.gravatar.com/avatar/"
+DEFAULT_AVATAR = "assets/img/default-profile.jpg"
+HASH_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+
+def avatar_hash(email):
+    # Gravatar's hash of an email address
+    return hashlib.md5((email or "").strip().lower().encode()).hexdigest()
+
+
+def _resize(data, size):
+    try:
+        from PIL import Image
+    except ImportError:
+        return data, None
+    with Image.open(BytesIO(data)) as image:
+        image = image.convert("RGB")
+        if image.size != (size, size):
+            image = image.resize((size, size), Image.LANCZOS)
+        buffer = BytesIO()
+        image.save(buffer, "JPEG", quality=85, optimize=True)
+    return buffer.getvalue(), "image/jpeg"
+
+
+class AvatarProxy:
+    def __init__(self, app=None, response_hook=None):
+        self.response_hook = response_hook
+        self._session = None
+        self._lock = threading.Lock()
+        self._defaults = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('AVATAR_UPSTREAM', GRAVATAR_URL)
+        app.config.setdefault('AVATAR_SIZES', (50, 100, 200))
+        app.config.setdefault('AVATAR_CACHE_DIR', os.path.join(app.instance_path, 'avatars'))
+        app.config.setdefault('AVATAR_CACHE_MAX_ENTRIES', 5000)
+        # How long a fetched avatar is used before asking Gravatar again
+        app.config.setdefault('AVATAR_CACHE_TTL', 24 * 3600)
+        # Browser cache lifetime, after that they revalidate with the ETag
+        app.config.setdefault('AVATAR_MAX_AGE', 7 * 24 * 3600)
+        app.config.setdefault('AVATAR_FETCH_TIMEOUT', 3)
+        self.cache = FileSystemCache(app.config['AVATAR_CACHE_DIR'],
+                                     max_entries=app.config['AVATAR_CACHE_MAX_ENTRIES'],
+                                     timeout=app.config['AVATAR_CACHE_TTL'])
+        app.extensions['avatars'] = self
+        app.add_url_rule("/avatar/<avatar_hash>", "avatar", self.send)
+        app.jinja_env.globals["avatar_url"] = self.url
+
+    def url(self, hash_value, size=100):
+        if not hash_value:
+            return url_for("static", filename=DEFAULT_AVATAR)
+        return url_for("avatar", avatar_hash=hash_value, s=size)
+
+    def _size(self):
+        # The smallest configured size that's at least what was asked for
+        sizes = sorted(self.app.config['AVATAR_SIZES'])
+        asked = request.args.get('s', 100, type=int)
+        return next((size for size in sizes if size >= asked), sizes[-1])
+
+    def _variants(self, data, content_type):
+        # Every configured size of one image: {size: (etag, content type, bytes)}
+        variants = {}
+        for size in self.app.config['AVATAR_SIZES']:
+            resized, resized_type = _resize(data, size)
+            variants[size] = (hashlib.sha1(resized).hexdigest(), resized_type or content_type, resized)
+        return variants
+
+    def _default(self, size):
+        if not self._defaults:
+            with open(os.path.join(self.app.static_folder, DEFAULT_AVATAR), "rb") as file:
+                self._defaults = self._variants(file.read(), "image/jpeg")
+        return self._defaults[size]
+
+    def _get_session(self):
+        import requests
+        with self._lock:
+            if self._session is None:
+                session = requests.Session()
+                if self.response_hook is not None:
+                    # Lets the app time every fetch (see metrics.py)
+                    session.hooks['response'].append(self.response_hook)
+                self._session = session
+        return self._session
+
+    def _fetch(self, hash_value):
+        # (variants, cacheable): a missing Gravatar is cached like a real one, a failed fetch isn't
+        import requests
+        try:
+            response = self._get_session().get(self.app.config['AVATAR_UPSTREAM'] + hash_value,
+                                        params={"s": max(self.app.config['AVATAR_SIZES']), "d": "404"},
+                                        timeout=self.app.config['AVATAR_FETCH_TIMEOUT'])
+        except requests.RequestException as error:
+            self.app.logger.warning("Fetching avatar %s failed: %s", hash_value, error)
+            return None, False
+        if response.status_code == 404:
+            return None, True
+        if response.status_code != 200 or not response.headers.get("Content-Type", "").startswith("image/"):
+            self.app.logger.warning("Fetching avatar %s failed: HTTP %s", hash_value, response.status_code)
+            return None, False
+        try:
+            return self._variants(response.content, response.headers["Content-Type"]), True
+        except OSError:
+            # Not an image Pillow can read
+            return None, True
+
+    def send(self, avatar_hash):
+        if not HASH_PATTERN.match(avatar_hash):
+            abort(404)
+        size = self._size()
+        max_age = self.app.config['AVATAR_MAX_AGE']
+        entry = self.cache.get(f"{avatar_hash}:{size}")
+        if entry is None:
+            variants, cacheable = self._fetch(avatar_hash)
+            if variants is None:
+                variants = dict.fromkeys(self.app.config['AVATAR_SIZES'])
+            if cacheable:
+                for variant_size, variant in variants.items():
+                    # No avatar is saved as "default", not as another copy of the default image
+                    self.cache.set(f"{avatar_hash}:{variant_size}", variant or "default")
+            else:
+                # Try again soon
+                max_age = 300
+            entry = variants[size]
+        if entry is None or entry == "default":
+            entry = self._default(size)
+        etag, content_type, data = entry
+        response = current_app.response_class(data, content_type=content_type)
+        response.set_etag(etag)
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+        return response.make_conditional(request)
@@ -0,0 +1,16 @@
+# Load testing tools. All of them use their own database (DB_URI, sqlite:///benchmark.db by
+# default) so they never touch the real posts.db.
+#
+#   python -m benchmarks.seed --users 100000 --posts 10000 --comments 1000000
+#   python -m benchmarks.run --requests 5000 --output results.json --baseline last_results.json
+#   python -m benchmarks.startup --runs 10 --output startup.json
+import os
+
+os.environ.setdefault('DB_URI', 'sqlite:///benchmark.db')
+os.environ.setdefault('FLASK_KEY', 'benchmark')
+# Nothing the benchmark does should send real email
+os.environ.setdefault('MAIL_QUEUE_AUTOSTART', '0')
+# Every request comes from one IP and a couple of accounts, the rate limits would stop the run
+os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
+
+BENCHMARK_PASSWORD = "benchmark-password"
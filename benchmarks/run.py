@@ -0,0 +1,284 @@
+import argparse
+import json
+import math
+import random
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from benchmarks import BENCHMARK_PASSWORD
+
+# Runs a mix of page views, logins and comments against the app and reports latency
+# percentiles, requests per second and SQL queries per request. Seed the database first
+# (python -m benchmarks.seed), then either:
+#
+#   python -m benchmarks.run                                  through the Flask test client
+#   python -m benchmarks.run --url http://127.0.0.1:8000      against a running gunicorn
+#
+# --output saves the report as JSON. Given an earlier report with --baseline, the run fails
+# (exit code 1) when latency, throughput or queries per request got worse by more than
+# --max-regression.
+#
+# Queries per request are counted directly in test client mode. Against gunicorn they come
+# from the /metrics endpoint (needs --metrics-token), only as an overall number, and are only
+# exact with a single gunicorn worker since every worker keeps its own metrics.
+
+DEFAULT_MIX = "home=50,post=35,comment=10,login=5"
+CSRF_PATTERN = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+METRICS_QUERIES_PATTERN = re.compile(r'^http_request_db_queries_(sum|count)\{[^}]*\} (\S+)$', re.MULTILINE)
+
+
+def percentile(values, percent):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)]
+
+
+def csrf_token(page):
+    match = CSRF_PATTERN.search(page)
+    if match is None:
+        raise RuntimeError("No csrf_token found on the page")
+    return match.group(1)
+
+
+class TestClientTarget:
+    name = "test-client"
+
+    def __init__(self, app, db):
+        from sqlalchemy import event
+        self.app = app
+        self._local = threading.local()
+        with app.app_context():
+            engine = db.engine
+
+        @event.listens_for(engine, "after_cursor_execute")
+        def count_query(*args):
+            # The test client handles each request on the thread that made it
+            self._local.queries = getattr(self._local, "queries", 0) + 1
+
+    def client(self):
+        client = self.app.test_client()
+
+        def send(method, path, data=None):
+            response = client.open(path, method=method, data=data)
+            return response.status_code, response.get_data(as_text=True)
+        return send
+
+    def thread_queries(self):
+        return getattr(self._local, "queries", 0)
+
+    def total_queries(self):
+        return None
+
+
+class HttpTarget:
+    def __init__(self, url, metrics_token=None, timeout=30):
+        self.name = url
+        self.url = url.rstrip("/")
+        self.metrics_token = metrics_token
+        self.timeout = timeout
+
+    def client(self):
+        import requests
+        session = requests.Session()
+
+        def send(method, path, data=None):
+            response = session.request(method, self.url + path, data=data, allow_redirects=False, timeout=self.timeout)
+            return response.status_code, response.text
+        return send
+
+    def thread_queries(self):
+        return None
+
+    def total_queries(self):
+        # Running totals of queries and requests seen by /metrics
+        if not self.metrics_token:
+            return None
+        import requests
+        response = requests.get(self.url + "/metrics", headers={"Authorization": f"Bearer {self.metrics_token}"},
+                                timeout=self.timeout)
+        response.raise_for_status()
+        totals = {"sum": 0.0, "count": 0.0}
+        for kind, value in METRICS_QUERIES_PATTERN.findall(response.text):
+            totals[kind] += float(value)
+        return totals
+
+
+class Workload:
+    def __init__(self, target, user_count, post_ids, mix, seed):
+        self.target = target
+        self.user_count = user_count
+        self.post_ids = post_ids
+        self.mix = mix
+        self.seed = seed
+
+    def worker(self, worker_number):
+        rng = random.Random(self.seed + worker_number)
+        # One visitor who logs in again and again, and one who stays logged in and comments
+        login_client = self.target.client()
+        login_token = csrf_token(login_client("GET", "/login")[1])
+        commenter = self.target.client()
+        comment_token = csrf_token(commenter("GET", "/login")[1])
+        commenter("POST", "/login", {"email": "user1@example.com", "password": BENCHMARK_PASSWORD,
+                                     "csrf_token": comment_token})
+        scenarios = {
+            "home": lambda: login_client("GET", "/"),
+            "post": lambda: login_client("GET", f"/post/{rng.choice(self.post_ids)}"),
+            "login": lambda: login_client("POST", "/login", {
+                "email": f"user{rng.randint(1, self.user_count)}@example.com",
+                "password": BENCHMARK_PASSWORD, "csrf_token": login_token}),
+            "comment": lambda: commenter("POST", f"/post/{rng.choice(self.post_ids)}", {
+                "comment": f"<p>Benchmark comment {rng.random()}</p>", "csrf_token": comment_token}),
+        }
+        names = list(self.mix)
+        weights = [self.mix[name] for name in names]
+
+        def run(count):
+            results = []
+            for name in rng.choices(names, weights, k=count):
+                queries_before = self.target.thread_queries()
+                started = time.perf_counter()
+                status, _ = scenarios[name]()
+                elapsed = time.perf_counter() - started
+                queries_after = self.target.thread_queries()
+                queries = None if queries_before is None else queries_after - queries_before
+                results.append((name, elapsed, status, queries))
+            return results
+        return run
+
+    def run(self, requests, warmup, concurrency):
+        workers = [self.worker(number) for number in range(concurrency)]
+        for worker in workers:
+            worker(warmup // concurrency)
+        per_worker = [requests // concurrency + (1 if number < requests % concurrency else 0)
+                      for number in range(concurrency)]
+        queries_before = self.target.total_queries()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            batches = list(executor.map(lambda pair: pair[0](pair[1]), zip(workers, per_worker)))
+        elapsed = time.perf_counter() - started
+        queries_after = self.target.total_queries()
+        results = [result for batch in batches for result in batch]
+        overall_queries = None
+        if queries_before is not None and queries_after["count"] > queries_before["count"]:
+            overall_queries = ((queries_after["sum"] - queries_before["sum"]) /
+                               (queries_after["count"] - queries_before["count"]))
+        return results, elapsed, overall_queries
+
+
+def summarize(results, elapsed=None, queries_per_request=None):
+    latencies = [seconds * 1000 for _, seconds, _, _ in results]
+    queries = [count for _, _, _, count in results if count is not None]
+    if queries_per_request is None and queries:
+        queries_per_request = sum(queries) / len(queries)
+    summary = {
+        "requests": len(results),
+        "errors": sum(1 for _, _, status, _ in results if status >= 400),
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+        "mean_ms": sum(latencies) / len(latencies) if latencies else None,
+        "queries_per_request": queries_per_request,
+    }
+    if elapsed is not None:
+        summary["seconds"] = elapsed
+        summary["requests_per_second"] = len(results) / elapsed if elapsed else None
+    return {key: round(value, 3) if isinstance(value, float) else value for key, value in summary.items()}
+
+
+def compare(report, baseline, max_regression):
+    # Lower is better for latency and queries, higher is better for throughput
+    checks = [("p50_ms", False), ("p95_ms", False), ("p99_ms", False), ("queries_per_request", False),
+              ("requests_per_second", True)]
+    sections = [("overall", report["overall"], baseline.get("overall", {}))]
+    sections += [(name, stats, baseline.get("scenarios", {}).get(name, {}))
+                 for name, stats in report["scenarios"].items()]
+    regressions = []
+    for section, current, previous in sections:
+        for key, higher_is_better in checks:
+            new, old = current.get(key), previous.get(key)
+            if new is None or old is None or old == 0:
+                continue
+            change = (new - old) / old
+            if (-change if higher_is_better else change) > max_regression:
+                regressions.append(f"{section} {key}: {old} -> {new} ({change:+.1%})")
+    return regressions
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in ("home", "post", "login", "comment"):
+            raise argparse.ArgumentTypeError(f"Unknown scenario {name.strip()!r}")
+        mix[name.strip()] = float(weight)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the blog and report latency and throughput.")
+    parser.add_argument("--url", help="Base URL of a running server, leave out to use the Flask test client")
+    parser.add_argument("--metrics-token", help="METRICS_TOKEN of the server, to read its query counts")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--warmup", type=int, default=100, help="Requests made first and left out of the report")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f"Weight of each scenario (default {DEFAULT_MIX})")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Save the report to this JSON file")
+    parser.add_argument("--baseline", help="Earlier JSON report to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.10,
+                        help="Allowed change for the worse against the baseline (default 0.10, i.e. 10%%)")
+    args = parser.parse_args()
+
+    from main import app, db, User, BlogPost, Comment
+    with app.app_context():
+        user_count = db.session.execute(db.select(db.func.max(User.id))).scalar() or 0
+        post_ids = db.session.execute(db.select(BlogPost.id)).scalars().all()
+        comment_count = db.session.execute(db.select(db.func.count(Comment.id))).scalar()
+        database = db.engine.url.render_as_string(hide_password=True)
+    if not user_count or not post_ids:
+        sys.exit(f"{database} has no users or posts, run python -m benchmarks.seed first")
+
+    target = HttpTarget(args.url, args.metrics_token) if args.url else TestClientTarget(app, db)
+    workload = Workload(target, user_count, post_ids, args.mix, args.seed)
+    results, elapsed, overall_queries = workload.run(args.requests, args.warmup, args.concurrency)
+
+    report = {
+        "created_at": datetime.utcnow().isoformat(timespec="seconds"),
+        "target": target.name,
+        "database": database,
+        "data": {"users": user_count, "posts": len(post_ids), "comments": comment_count},
+        "settings": {"requests": args.requests, "warmup": args.warmup, "concurrency": args.concurrency,
+                     "mix": args.mix, "seed": args.seed, "page_cache": app.config['PAGE_CACHE_TYPE']},
+        "overall": summarize(results, elapsed, overall_queries),
+        "scenarios": {name: summarize([result for result in results if result[0] == name])
+                      for name in args.mix},
+    }
+
+    print(f"{'scenario':<10}{'requests':>10}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'queries':>10}")
+    for name, stats in [("overall", report["overall"])] + list(report["scenarios"].items()):
+        print(f"{name:<10}{stats['requests']:>10}{stats['errors']:>8}{stats['p50_ms'] or 0:>10.2f}"
+              f"{stats['p95_ms'] or 0:>10.2f}{stats['p99_ms'] or 0:>10.2f}{stats['queries_per_request'] or 0:>10.2f}")
+    print(f"{report['overall']['requests_per_second']} requests/second")
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(report, json.load(file), args.max_regression)
+        if regressions:
+            print(f"Regressions over {args.max_regression:.0%} against {args.baseline}:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print(f"No regressions over {args.max_regression:.0%} against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
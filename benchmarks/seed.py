@@ -0,0 +1,99 @@
+import argparse
+import random
+import time
+from sqlalchemy import insert
+from benchmarks import BENCHMARK_PASSWORD
+from renditions import render_post
+from avatars import avatar_hash
+
+# Fills the benchmark database with made up users, posts, comments and suggested edits.
+# Rows are inserted in large batches with executemany, which is much faster than adding
+# ORM objects one at a time.
+
+BATCH_SIZE = 5000
+WORDS = ("python flask blog weather news coding viola art games website database cache query "
+         "template server browser travel music food science history").split()
+
+
+def sentence(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize()
+
+
+def insert_in_batches(db, model, total, make_row, label):
+    started = time.perf_counter()
+    for start in range(0, total, BATCH_SIZE):
+        rows = [make_row(number) for number in range(start, min(start + BATCH_SIZE, total))]
+        db.session.execute(insert(model), rows)
+        db.session.commit()
+        print(f"\r{label}: {min(start + BATCH_SIZE, total)}/{total}", end="", flush=True)
+    print(f"\r{label}: {total} in {time.perf_counter() - started:.1f}s")
+
+
+def seed(users, posts, comments, edits, subscribers, seed_value=1, reset=False):
+    import main
+    from main import app, db, User, BlogPost, Comment, Suggested_Edits
+    rng = random.Random(seed_value)
+    with app.app_context():
+        if reset:
+            db.drop_all()
+        main.migrations.upgrade()
+        if db.session.execute(db.select(User.id).limit(1)).first() is not None:
+            raise SystemExit(f"{db.engine.url} already has users in it, run again with --reset to empty it first")
+        # Every user gets the same password so the login workload can sign in as anyone
+        password = main.password_hasher.hash(BENCHMARK_PASSWORD)
+        writers = max(1, min(users, 20))
+        insert_in_batches(db, User, users, lambda number: {
+            "id": number + 1,
+            "email": f"user{number + 1}@example.com",
+            "password": password,
+            "name": f"User {number + 1}",
+            "permission_status": "Blog-Writer" if number < writers else "Community_Member",
+            "interests": rng.choice(WORDS) if rng.random() < subscribers else None,
+            "approx_location": rng.choice(["Boston", "Paris", "Tokyo", "Lima"]),
+            "avatar_hash": avatar_hash(f"user{number + 1}@example.com"),
+        }, "users")
+
+        def post_row(number):
+            body = f"<h2>{sentence(rng, 3)}</h2>" + "".join(f"<p>{sentence(rng, 40)}</p>" for _ in range(rng.randint(3, 12)))
+            return {
+                "id": number + 1,
+                "author_id": rng.randint(1, writers),
+                "title": f"{sentence(rng, 4)} {number + 1}",
+                "subtitle": sentence(rng, 8),
+                "date": "April 13, 2024",
+                "body": body,
+                "img_url": "https://example.com/post-bg.jpg",
+                "comment_count": 0,
+                **render_post(body),
+            }
+
+        def comment_row(number):
+            # Made up text has nothing to sanitize, so it's its own rendition
+            text = f"<p>{sentence(rng, rng.randint(5, 30))}</p>"
+            return {"text": text, "text_html": text, "author_id": rng.randint(1, users), "post_id": rng.randint(1, posts)}
+
+        insert_in_batches(db, BlogPost, posts, post_row, "posts")
+        insert_in_batches(db, Comment, comments, comment_row, "comments")
+        insert_in_batches(db, Suggested_Edits, edits, lambda number: {
+            "edit_type": rng.choice(["Bug", "Feature", "Content"]),
+            "edit_text": sentence(rng, 20),
+            "other_info": sentence(rng, 5),
+        }, "suggested edits")
+        # Same count the comment routes keep up to date
+        db.session.execute(db.update(BlogPost).values(
+            comment_count=db.select(db.func.count(Comment.id)).where(Comment.post_id == BlogPost.id).scalar_subquery()))
+        db.session.commit()
+        print(f"search index: {main.search_index.rebuild()} posts")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fill the benchmark database with made up data.")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--posts", type=int, default=200)
+    parser.add_argument("--comments", type=int, default=5000)
+    parser.add_argument("--edits", type=int, default=100)
+    parser.add_argument("--subscribers", type=float, default=0.3, help="Share of users signed up for the newsletter")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed, the same seed gives the same data")
+    parser.add_argument("--reset", action="store_true", help="Drop every table in DB_URI first")
+    args = parser.parse_args()
+    seed(args.users, args.posts, args.comments, args.edits, args.subscribers, args.seed, args.reset)
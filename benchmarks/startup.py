@@ -0,0 +1,115 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# Measures how long a new worker takes to be ready: importing main, create_app() and the first
+# request to the home page, each run in a fresh Python process. Seed the database first
+# (python -m benchmarks.seed), then:
+#
+#   python -m benchmarks.startup --runs 10 --output startup.json
+#
+# To compare two versions, save a report with --output on one and pass it as --baseline on the
+# other, the run fails (exit code 1) when a median got worse by more than --max-regression.
+# --cold-templates gives every run an empty Jinja bytecode cache, like the first worker after a
+# deploy. Versions without create_app() use main.app.
+
+CHILD = """
+import json, sys, time
+import benchmarks
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+app = main.create_app() if hasattr(main, "create_app") else main.app
+created = time.perf_counter()
+status = app.test_client().get("/").status_code
+finished = time.perf_counter()
+print(json.dumps({
+    "import_ms": (imported - started) * 1000,
+    "create_app_ms": (created - imported) * 1000,
+    "first_request_ms": (finished - created) * 1000,
+    "status": status,
+    "modules": [name for name in ("requests", "flask_mail", "smtplib", "statistics") if name in sys.modules],
+}))
+"""
+TIMINGS = ("process_ms", "import_ms", "create_app_ms", "first_request_ms")
+
+
+def run_once(cold_templates):
+    env = dict(os.environ)
+    with tempfile.TemporaryDirectory() as jinja_cache:
+        if cold_templates:
+            env["JINJA_CACHE_DIR"] = jinja_cache
+        started = time.perf_counter()
+        output = subprocess.run([sys.executable, "-c", CHILD], env=env, capture_output=True, text=True)
+        elapsed = (time.perf_counter() - started) * 1000
+    if output.returncode != 0:
+        sys.exit(f"Startup run failed:\n{output.stderr}")
+    result = json.loads(output.stdout.strip().splitlines()[-1])
+    result["process_ms"] = elapsed
+    return result
+
+
+def summarize(results):
+    summary = {key: round(statistics.median(result[key] for result in results), 2) for key in TIMINGS}
+    summary["runs"] = len(results)
+    summary["errors"] = sum(1 for result in results if result["status"] != 200)
+    # Optional modules loaded by the time the first page was served
+    summary["modules"] = results[-1]["modules"]
+    return summary
+
+
+def compare(report, baseline, max_regression):
+    regressions = []
+    for key in TIMINGS:
+        new, old = report.get(key), baseline.get(key)
+        if new is None or old is None or old == 0:
+            continue
+        change = (new - old) / old
+        if change > max_regression:
+            regressions.append(f"{key}: {old} -> {new} ({change:+.1%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time importing the app and serving its first request.")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--cold-templates", action="store_true",
+                        help="Start every run with an empty Jinja bytecode cache")
+    parser.add_argument("--output", help="Save the report to this JSON file")
+    parser.add_argument("--baseline", help="Earlier JSON report to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.10,
+                        help="Allowed change for the worse against the baseline (default 0.10, i.e. 10%%)")
+    args = parser.parse_args()
+
+    # One untimed run first, so the database file and .pyc files are in place for every timed run
+    run_once(args.cold_templates)
+    report = summarize([run_once(args.cold_templates) for _ in range(args.runs)])
+
+    for key in TIMINGS:
+        print(f"{key:<18}{report[key]:>10.2f}")
+    print(f"modules loaded: {', '.join(report['modules']) or 'none'}")
+    if report["errors"]:
+        print(f"{report['errors']} runs didn't get a 200 from /")
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(report, json.load(file), args.max_regression)
+        if regressions:
+            print(f"Regressions over {args.max_regression:.0%} against {args.baseline}:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print(f"No regressions over {args.max_regression:.0%} against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+import math
+from datetime import datetime, timezone
+from email.utils import format_datetime
+from xml.sax.saxutils import escape
+from flask import Response, abort, stream_with_context, url_for
+
+# Atom (/feed.xml) and RSS (/rss.xml) feeds of the newest posts, and a sitemap of every post.
+# They're streamed from the database a batch of rows at a time, using the excerpt saved with
+# each post instead of loading post bodies, and go through the page cache in the "posts" group,
+# so they're made again only after a post is added, edited or deleted, and carry the same
+# ETag/Last-Modified as the home page.
+#
+# A sitemap file can list at most SITEMAP_MAX_URLS pages. Past that /sitemap.xml becomes a
+# sitemap index of /sitemap-1.xml, /sitemap-2.xml, ..., each one covering a fixed range of post
+# ids, so a shard's URL and contents don't move when newer posts are added.
+
+ATOM_TYPE = "application/atom+xml; charset=utf-8"
+RSS_TYPE = "application/rss+xml; charset=utf-8"
+XML_TYPE = "application/xml; charset=utf-8"
+# Pages that aren't posts, listed at the start of the (first) sitemap
+STATIC_PAGES = ("get_all_posts", "about", "contact")
+
+
+def _attribute(value):
+    return escape(str(value), {'"': "&quot;"})
+
+
+def _iso(moment):
+    return (moment or datetime.utcnow()).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class Feeds:
+    def __init__(self, app=None, db=None, post_model=None, user_model=None, page_cache=None, validator=None):
+        if app is not None:
+            self.init_app(app, db, post_model, user_model, page_cache, validator)
+
+    def init_app(self, app, db, post_model, user_model, page_cache, validator):
+        self.app = app
+        self.db = db
+        self.post_model = post_model
+        self.user_model = user_model
+        app.config.setdefault('FEED_TITLE', "The Random Blog")
+        # Newest posts in the Atom and RSS feeds
+        app.config.setdefault('FEED_MAX_ENTRIES', 20)
+        # The sitemap protocol allows 50,000 URLs per file
+        app.config.setdefault('SITEMAP_MAX_URLS', 50000)
+
+        cached = page_cache.cached("posts", validator=lambda **kwargs: validator())
+        app.add_url_rule("/feed.xml", "atom_feed", cached(self.atom))
+        app.add_url_rule("/rss.xml", "rss_feed", cached(self.rss))
+        app.add_url_rule("/sitemap.xml", "sitemap", cached(self.sitemap))
+        app.add_url_rule("/sitemap-<int:shard>.xml", "sitemap_shard", cached(self.sitemap_shard))
+
+    def _newest_posts(self):
+        post = self.post_model
+        user = self.user_model
+        return self.db.session.execute(
+            self.db.select(post.id, post.title, post.subtitle, post.excerpt, post.created_at, post.updated_at,
+                           user.name.label("author_name"))
+            .outerjoin(user, post.author_id == user.id)
+            .order_by(post.id.desc())
+            .limit(self.app.config['FEED_MAX_ENTRIES'])
+            .execution_options(yield_per=100)
+        )
+
+    def _stream(self, chunks, content_type):
+        return Response(stream_with_context(chunks), content_type=content_type)
+
+    def atom(self):
+        def chunks():
+            updated = self.db.session.execute(self.db.select(self.db.func.max(self.post_model.updated_at))).scalar()
+            yield '<?xml version="1.0" encoding="utf-8"?>\n<feed xmlns="http://www.w3.org/2005/Atom">\n'
+            yield f"<title>{escape(self.app.config['FEED_TITLE'])}</title>\n"
+            yield f'<link href="{_attribute(url_for("get_all_posts", _external=True))}"/>\n'
+            yield f'<link rel="self" href="{_attribute(url_for("atom_feed", _external=True))}"/>\n'
+            yield f"<id>{escape(url_for('get_all_posts', _external=True))}</id>\n<updated>{_iso(updated)}</updated>\n"
+            for row in self._newest_posts():
+                link = url_for("show_post", post_id=row.id, _external=True)
+                yield (f"<entry><title>{escape(row.title)}</title>"
+                       f'<link href="{_attribute(link)}"/><id>{escape(link)}</id>'
+                       f"<published>{_iso(row.created_at)}</published><updated>{_iso(row.updated_at)}</updated>"
+                       f"<author><name>{escape(row.author_name or '')}</name></author>"
+                       f"<summary>{escape(row.excerpt or row.subtitle)}</summary></entry>\n")
+            yield "</feed>\n"
+        return self._stream(chunks(), ATOM_TYPE)
+
+    def rss(self):
+        def chunks():
+            yield ('<?xml version="1.0" encoding="utf-8"?>\n'
+                   '<rss version="2.0" xmlns:dc="http://purl.org/dc/elements/1.1/"><channel>\n')
+            yield (f"<title>{escape(self.app.config['FEED_TITLE'])}</title>"
+                   f"<link>{escape(url_for('get_all_posts', _external=True))}</link>"
+                   f"<description>{escape(self.app.config['FEED_TITLE'])}</description>\n")
+            for row in self._newest_posts():
+                link = escape(url_for("show_post", post_id=row.id, _external=True))
+                published = format_datetime((row.created_at or datetime.utcnow()).replace(tzinfo=timezone.utc),
+                                            usegmt=True)
+                yield (f"<item><title>{escape(row.title)}</title><link>{link}</link>"
+                       f'<guid isPermaLink="true">{link}</guid><pubDate>{published}</pubDate>'
+                       f"<dc:creator>{escape(row.author_name or '')}</dc:creator>"
+                       f"<description>{escape(row.excerpt or row.subtitle)}</description></item>\n")
+            yield "</channel></rss>\n"
+        return self._stream(chunks(), RSS_TYPE)
+
+    def _shard_size(self):
+        # Posts per sitemap shard, leaving room for the other pages in the first one
+        return self.app.config['SITEMAP_MAX_URLS'] - len(STATIC_PAGES)
+
+    def _shard_count(self):
+        max_id = self.db.session.execute(self.db.select(self.db.func.max(self.post_model.id))).scalar() or 0
+        return max(1, math.ceil(max_id / self._shard_size()))
+
+    def sitemap(self):
+        post = self.post_model
+        count = self.db.session.execute(self.db.select(self.db.func.count(post.id))).scalar()
+        if count <= self._shard_size():
+            return self._urlset(None)
+        size = self._shard_size()
+
+        def chunks():
+            # One query for the last change in every shard
+            shard = ((post.id - 1) // size).label("shard")
+            lastmods = dict(self.db.session.execute(
+                self.db.select(shard, self.db.func.max(post.updated_at)).group_by(shard)).all())
+            yield ('<?xml version="1.0" encoding="utf-8"?>\n'
+                   '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+            for number in range(1, self._shard_count() + 1):
+                location = escape(url_for("sitemap_shard", shard=number, _external=True))
+                lastmod = lastmods.get(number - 1)
+                yield (f"<sitemap><loc>{location}</loc>"
+                       + (f"<lastmod>{_iso(lastmod)}</lastmod>" if lastmod else "") + "</sitemap>\n")
+            yield "</sitemapindex>\n"
+        return self._stream(chunks(), XML_TYPE)
+
+    def sitemap_shard(self, shard):
+        if not 1 <= shard <= self._shard_count():
+            abort(404)
+        return self._urlset(shard)
+
+    def _urlset(self, shard):
+        post = self.post_model
+
+        def chunks():
+            query = self.db.select(post.id, post.updated_at).order_by(post.id)
+            if shard is not None:
+                size = self._shard_size()
+                query = query.where(post.id > (shard - 1) * size, post.id <= shard * size)
+            yield ('<?xml version="1.0" encoding="utf-8"?>\n'
+                   '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+            if shard in (None, 1):
+                for endpoint in STATIC_PAGES:
+                    yield f"<url><loc>{escape(url_for(endpoint, _external=True))}</loc></url>\n"
+            for row in self.db.session.execute(query.execution_options(yield_per=1000)):
+                location = escape(url_for("show_post", post_id=row.id, _external=True))
+                yield f"<url><loc>{location}</loc><lastmod>{_iso(row.updated_at)}</lastmod></url>\n"
+            yield "</urlset>\n"
+        return self._stream(chunks(), XML_TYPE)
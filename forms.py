@@ -1,6 +1,6 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, SubmitField, PasswordField, SelectField
-from wtforms.validators import DataRequired, URL, Email, EqualTo
+from wtforms import StringField, SubmitField, PasswordField, SelectField, IntegerField
+from wtforms.validators import DataRequired, URL, Email, EqualTo, NumberRange, InputRequired
 from flask_ckeditor import CKEditorField
 
 
@@ -65,4 +65,22 @@ class ContactMe(FlaskForm):
     name = StringField("Name/Username: ")
     email_address = StringField("Email: ")
     message = StringField("Message: ")
-    submit = SubmitField("This email will be sent to me and I will try to respond to you as soon as possible.")
\ No newline at end of file
+    submit = SubmitField("This email will be sent to me and I will try to respond to you as soon as possible.")
+
+class QuoteForm(FlaskForm):
+    text = StringField("Quote", validators=[DataRequired()])
+    author = StringField("Who said it (Not Required)")
+    weight = IntegerField("How often it's shown compared to the other quotes (0 hides it)", default=1,
+                          validators=[InputRequired(), NumberRange(min=0)])
+    submit = SubmitField("Save Quote")
+
+class DeletePost(FlaskForm):
+    # Only the CSRF token, for the delete buttons on the home page
+    submit = SubmitField("✘")
+
+class BulkUserAction(FlaskForm):
+    # The users it applies to are the ticked user_ids checkboxes of the user list
+    action = SelectField("With the selected users:", choices=[("Blog-Writer", "Change to blog writer"),
+                                                             ("Community_Member", "Change to community member"),
+                                                             ("delete", "Delete")], validators=[DataRequired()])
+    submit = SubmitField("Apply")
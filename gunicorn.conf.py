@@ -0,0 +1,35 @@
+import gc
+import os
+
+# gunicorn reads this file from the working directory (the Procfile runs "main:create_app()").
+#
+# With preload_app the app is imported once, in the master process, and the workers are forked
+# from it, sharing its modules and compiled templates copy-on-write instead of each importing
+# everything again. Importing main doesn't open database connections or start threads; each
+# worker opens its own connections and starts its background threads on its first request.
+
+preload_app = True
+
+# Threaded workers. A login waiting on the password hashing pool (see password_hashing.py) holds
+# one thread, so the worker's other threads keep serving pages, and PASSWORD_HASH_MAX_PENDING
+# limits how many threads of a worker can be waiting. Every worker starts its own
+# PASSWORD_HASH_WORKERS processes, so prefer a few workers with more threads (WEB_CONCURRENCY
+# sets the number of workers).
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+
+
+def when_ready(server):
+    # The app is loaded and its templates compiled by now (see create_app in main.py). Leave
+    # everything made while loading it out of garbage collection. A collection writes to every
+    # object it looks at, which would copy the shared pages into each worker.
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    # Connections can't be shared between processes. If the master opened any, the worker drops
+    # them (without closing them under the master) and opens its own.
+    from main import app, db
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
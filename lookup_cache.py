@@ -0,0 +1,136 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from sqlalchemy import delete, insert, select
+
+# Cache for the news and weather lookups used by the personalized emails. Each source has its
+# own time to live (geocoding never changes, forecasts and news do), lookups that found nothing
+# are cached too (negative caching) so unknown locations aren't asked for again on every run,
+# and entries can be kept in a database table so they survive restarts.
+
+MISSING = object()
+
+
+class DatabaseStore:
+    # Keeps cache entries in a table. Uses the engine directly (not db.session) because the
+    # lookups run in worker threads without an app context.
+    def __init__(self, engine, table):
+        self.engine = engine
+        self.table = table
+
+    def get(self, source, key):
+        with self.engine.connect() as connection:
+            row = connection.execute(
+                select(self.table.c.value, self.table.c.expires_at)
+                .where(self.table.c.source == source, self.table.c.key == key)
+            ).first()
+        if row is None:
+            return MISSING
+        if row.expires_at is not None and row.expires_at < datetime.utcnow():
+            return MISSING
+        return json.loads(row.value)
+
+    def set(self, source, key, value, ttl):
+        expires_at = None if ttl is None else datetime.utcnow() + timedelta(seconds=ttl)
+        with self.engine.begin() as connection:
+            connection.execute(delete(self.table).where(self.table.c.source == source, self.table.c.key == key))
+            connection.execute(insert(self.table).values(source=source, key=key, value=json.dumps(value),
+                                                         expires_at=expires_at))
+
+    def purge_expired(self):
+        with self.engine.begin() as connection:
+            result = connection.execute(delete(self.table).where(self.table.c.expires_at < datetime.utcnow()))
+        return result.rowcount
+
+
+class LookupCache:
+    def __init__(self, ttls, negative_ttls=None, store=None, max_entries=10000):
+        # ttls maps a source ("news", "geocode", "forecast") to seconds, None means forever
+        self.ttls = ttls
+        self.negative_ttls = negative_ttls or {}
+        self.store = store
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def _count(self, source, name):
+        with self._lock:
+            counters = self._stats.setdefault(source, {"hits": 0, "misses": 0, "negative_hits": 0, "store_hits": 0})
+            counters[name] += 1
+
+    def stats(self):
+        with self._lock:
+            return {source: dict(counters) for source, counters in self._stats.items()}
+
+    def _get_memory(self, source, key):
+        with self._lock:
+            entry = self._entries.get((source, key))
+            if entry is None:
+                return MISSING
+            expires, value = entry
+            if expires is not None and expires < time.monotonic():
+                del self._entries[(source, key)]
+                return MISSING
+            self._entries.move_to_end((source, key))
+            return value
+
+    def _set_memory(self, source, key, value, ttl):
+        with self._lock:
+            self._entries[(source, key)] = (None if ttl is None else time.monotonic() + ttl, value)
+            self._entries.move_to_end((source, key))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get_or_fetch(self, source, key, fetch):
+        value = self._get_memory(source, key)
+        if value is MISSING and self.store is not None:
+            value = self.store.get(source, key)
+            if value is not MISSING:
+                self._count(source, "store_hits")
+                self._set_memory(source, key, value, self.negative_ttls.get(source) if value is None else self.ttls.get(source))
+        if value is not MISSING:
+            self._count(source, "negative_hits" if value is None else "hits")
+            return value
+        self._count(source, "misses")
+        value = fetch()
+        if value is None:
+            if source not in self.negative_ttls:
+                return None
+            ttl = self.negative_ttls[source]
+        else:
+            ttl = self.ttls.get(source)
+        self._set_memory(source, key, value, ttl)
+        if self.store is not None:
+            self.store.set(source, key, value, ttl)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class CachedNewsWeatherClient:
+    # Same methods as news_weather.NewsWeatherClient, answered from the cache when possible
+    def __init__(self, client, cache):
+        self.client = client
+        self.cache = cache
+
+    def news(self, interest):
+        return self.cache.get_or_fetch("news", interest.strip().lower(), lambda: self.client.news(interest))
+
+    def geocode(self, location):
+        coordinates = self.cache.get_or_fetch("geocode", location.strip().lower(), lambda: self.client.geocode(location))
+        # Stored as a JSON list, but callers use the coordinates as dictionary keys
+        return tuple(coordinates) if coordinates is not None else None
+
+    def forecast(self, lat, lon):
+        return self.cache.get_or_fetch("forecast", f"{round(lat, 2)},{round(lon, 2)}", lambda: self.client.forecast(lat, lon))
+
+    def stats(self):
+        return self.cache.stats()
+
+    def close(self):
+        self.client.close()
@@ -0,0 +1,237 @@
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+# Outbound mail queue. Routes only add a row to the outgoing email table and return, worker
+# threads (started inside the web process, or in their own process with "flask mail-worker")
+# pick the rows up and send them over one SMTP connection that stays open while there is work.
+# Failed sends are retried with exponential backoff and end up "dead" after too many attempts.
+#
+# Routes queue an Email, which only holds the fields that are saved. flask_mail (and smtplib and
+# the email package with it) is imported by the first worker that sends, and the Mail extension
+# is made then too unless one was passed in, so web processes that only queue never load them.
+
+PENDING = "pending"
+SENDING = "sending"
+SENT = "sent"
+DEAD = "dead"
+
+
+class Email:
+    # The parts of a flask_mail.Message the queue saves, enqueue() takes either
+    def __init__(self, subject, sender=None, recipients=None, bcc=None, body=None):
+        self.subject = subject
+        self.sender = sender
+        self.recipients = list(recipients or [])
+        self.bcc = list(bcc or [])
+        self.body = body
+
+
+class MailQueue:
+    def __init__(self, app=None, db=None, mail=None, model=None):
+        self.db = db
+        self.mail = mail
+        self.model = model
+        self._threads = []
+        self._pid = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._next_send_at = 0
+        # Called with (seconds, sent_ok) after every send attempt, used for the SMTP timings in metrics.py
+        self.send_observer = None
+        if app is not None:
+            self.init_app(app, db, mail, model)
+
+    def init_app(self, app, db, mail, model):
+        self.app = app
+        self.db = db
+        self.mail = mail
+        self.model = model
+        app.config.setdefault('MAIL_QUEUE_WORKERS', 1)
+        app.config.setdefault('MAIL_QUEUE_AUTOSTART', True)
+        app.config.setdefault('MAIL_QUEUE_MAX_ATTEMPTS', 5)
+        # Seconds before the first retry, doubled after every failed attempt
+        app.config.setdefault('MAIL_QUEUE_RETRY_DELAY', 30)
+        app.config.setdefault('MAIL_QUEUE_POLL_INTERVAL', 5)
+        # A job stuck in "sending" this long (worker was killed mid send) is picked up again
+        app.config.setdefault('MAIL_QUEUE_STALE_AFTER', 600)
+        # Most messages (each newsletter batch is one message) sent per minute by each process, 0 for no limit
+        app.config.setdefault('MAIL_QUEUE_MAX_PER_MINUTE', 0)
+        app.extensions['mail_queue'] = self
+
+        @app.before_request
+        def start_mail_workers():
+            if app.config['MAIL_QUEUE_AUTOSTART']:
+                self.start()
+
+        @app.cli.command("mail-worker")
+        def mail_worker_command():
+            """Send queued emails until stopped (Ctrl+C)."""
+            self.start()
+            try:
+                while True:
+                    time.sleep(1)
+            except KeyboardInterrupt:
+                self.stop()
+
+    def enqueue(self, msg, commit=True, **columns):
+        job = self.model(
+            subject=msg.subject,
+            sender=msg.sender if isinstance(msg.sender, str) else None,
+            recipients="\n".join(msg.recipients or []),
+            bcc="\n".join(msg.bcc or []),
+            body=msg.body or "",
+            status=PENDING,
+            attempts=0,
+            next_attempt_at=datetime.utcnow(),
+            created_at=datetime.utcnow(),
+            **columns
+        )
+        self.db.session.add(job)
+        if commit:
+            self.db.session.commit()
+            self.notify()
+        return job
+
+    def notify(self):
+        if self.app.config['MAIL_QUEUE_AUTOSTART']:
+            self.start()
+        self._wakeup.set()
+
+    def start(self):
+        # Threads don't survive a fork, so start them again in every gunicorn worker process
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stopping.clear()
+            self._threads = []
+            for number in range(self.app.config['MAIL_QUEUE_WORKERS']):
+                thread = threading.Thread(target=self._run, name=f"mail-queue-{number}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self):
+        self._stopping.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout=10)
+        self._pid = None
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                with self.app.app_context():
+                    self.drain()
+            except Exception as error:
+                self.app.logger.exception("Mail queue worker error: %s", error)
+            self._wakeup.wait(self.app.config['MAIL_QUEUE_POLL_INTERVAL'])
+            self._wakeup.clear()
+
+    def _mail(self):
+        if self.mail is None:
+            from flask_mail import Mail
+            self.mail = Mail(self.app)
+        return self.mail
+
+    def drain(self):
+        # Send every job that is due. The SMTP connection is only opened once there is a job
+        # and is reused for every job after it.
+        job = self._claim_next()
+        while job is not None and not self._stopping.is_set():
+            try:
+                with self._mail().connect() as connection:
+                    while job is not None and not self._stopping.is_set():
+                        delivered = self._deliver(connection, job)
+                        job = self._claim_next()
+                        if not delivered:
+                            # The connection may be broken, open a new one for the next job
+                            break
+            except Exception as error:
+                # Could not reach the mail server, try again after the poll interval
+                if job is not None:
+                    self._failed(job, error)
+                return
+        if job is not None:
+            # Stopping, put the job back for the next worker
+            job.status = PENDING
+            self.db.session.commit()
+
+    def _claim_next(self):
+        model = self.model
+        now = datetime.utcnow()
+        stale = now - timedelta(seconds=self.app.config['MAIL_QUEUE_STALE_AFTER'])
+        while True:
+            job = self.db.session.execute(
+                self.db.select(model)
+                .where(((model.status == PENDING) & (model.next_attempt_at <= now)) |
+                       ((model.status == SENDING) & (model.locked_at < stale)))
+                .order_by(model.id)
+                .limit(1)
+            ).scalar()
+            if job is None:
+                return None
+            # Only one worker can move the job to "sending", anyone else updates zero rows
+            result = self.db.session.execute(
+                self.db.update(model)
+                .where(model.id == job.id, model.status == job.status, model.attempts == job.attempts)
+                .values(status=SENDING, locked_at=now)
+            )
+            self.db.session.commit()
+            if result.rowcount == 1:
+                self.db.session.refresh(job)
+                return job
+
+    def _wait_for_rate_limit(self):
+        max_per_minute = self.app.config['MAIL_QUEUE_MAX_PER_MINUTE']
+        if not max_per_minute:
+            return
+        # Every worker thread takes the next free send slot, so the limit holds for the whole process
+        with self._lock:
+            now = time.monotonic()
+            send_at = max(now, self._next_send_at)
+            self._next_send_at = send_at + 60 / max_per_minute
+        if send_at > now:
+            self._stopping.wait(send_at - now)
+
+    def _deliver(self, connection, job):
+        from flask_mail import Message
+        msg = Message(job.subject,
+                      sender=job.sender,
+                      recipients=job.recipients.split("\n") if job.recipients else [],
+                      bcc=job.bcc.split("\n") if job.bcc else [],
+                      body=job.body)
+        self._wait_for_rate_limit()
+        started = time.perf_counter()
+        try:
+            connection.send(msg)
+        except Exception as error:
+            self._observe_send(started, False)
+            self._failed(job, error)
+            return False
+        self._observe_send(started, True)
+        job.status = SENT
+        job.attempts += 1
+        job.sent_at = datetime.utcnow()
+        self.db.session.commit()
+        return True
+
+    def _observe_send(self, started, ok):
+        if self.send_observer is not None:
+            self.send_observer(time.perf_counter() - started, ok)
+
+    def _failed(self, job, error):
+        job.attempts += 1
+        job.last_error = str(error)[:1000]
+        if job.attempts >= self.app.config['MAIL_QUEUE_MAX_ATTEMPTS']:
+            job.status = DEAD
+            self.app.logger.error("Giving up on email %s after %s attempts: %s", job.id, job.attempts, error)
+        else:
+            job.status = PENDING
+            delay = self.app.config['MAIL_QUEUE_RETRY_DELAY'] * 2 ** (job.attempts - 1)
+            job.next_attempt_at = datetime.utcnow() + timedelta(seconds=delay)
+        self.db.session.commit()
@@ -1,32 +1,48 @@
-import smtplib
-from datetime import date
+import click
+import threading
+import json
+from datetime import date, datetime
 from typing import List
 import sqlalchemy.exc
-from flask import Flask, abort, render_template, redirect, url_for, flash, request
+from jinja2 import FileSystemBytecodeCache
+from flask import Flask, abort, render_template, redirect, url_for, flash, request, jsonify
 from flask_bootstrap import Bootstrap5
 from flask_ckeditor import CKEditor
-from flask_gravatar import Gravatar
 from flask_login import UserMixin, login_user, LoginManager, current_user, logout_user
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import relationship, DeclarativeBase, Mapped, mapped_column
-from sqlalchemy import Integer, String, Text
+from sqlalchemy.orm import relationship, DeclarativeBase, Mapped, mapped_column, joinedload
+from sqlalchemy import Integer, String, Text, DateTime, JSON
 from functools import wraps
-from werkzeug.security import generate_password_hash, check_password_hash
 import os
 import forms
+from page_cache import PageCache
+from mail_queue import MailQueue, Email
+from lookup_cache import LookupCache, DatabaseStore
+from search import SearchIndex
+from migrations import Migrations
+from newsletter import NewsletterSender
+from password_hashing import PasswordHasher
+from metrics import Metrics
+from static_assets import StaticAssets
+from renditions import render_post, render_comment
+from user_cache import UserCache
+from rate_limit import RateLimiter, DatabaseBackend
+from feeds import Feeds
+from reset_tokens import ResetTokens, InvalidResetToken, ExpiredResetToken
+from avatars import AvatarProxy, avatar_hash
+from purge import Purger
+from quotes import QuotePool
+from read_replica import ReadReplica, RoutingSession
+from werkzeug.middleware.proxy_fix import ProxyFix
 # Import your forms from the forms.py
 from forms import CreatePostForm
-from flask_mail import Mail, Message
-import requests
-import html
-import statistics
 
 
 def admin_only(function):
     @wraps(function)
     def wrapper_function(*args, **kwargs):
-        if current_user.permission_status != "Blog-Writer":
-            pass
+        if not current_user.is_authenticated or current_user.permission_status != "Blog-Writer":
+            return abort(403)
         elif current_user.id != 1:
             return abort(403)
         else:
@@ -59,6 +75,12 @@ This will install the packages from the requirements.txt for this project.
 '''
 
 app = Flask(__name__)
+# Compiled templates are saved here, so a new worker loads them instead of compiling every
+# template again. JINJA_CACHE_DIR=off keeps them in memory only.
+app.config['JINJA_CACHE_DIR'] = os.environ.get('JINJA_CACHE_DIR', os.path.join(app.instance_path, 'jinja_cache'))
+if app.config['JINJA_CACHE_DIR'] != 'off':
+    os.makedirs(app.config['JINJA_CACHE_DIR'], exist_ok=True)
+    app.jinja_options = {**app.jinja_options, "bytecode_cache": FileSystemBytecodeCache(app.config['JINJA_CACHE_DIR'])}
 app.config['SECRET_KEY'] = os.environ.get('FLASK_KEY')
 password = os.environ.get('password')
 my_email = os.environ.get('my_email')
@@ -71,50 +93,133 @@ app.config['MAIL_USE_SSL'] = True
 ckeditor = CKEditor(app)
 Bootstrap5(app)
 
+# Password hashing settings. Hashes made with older settings are upgraded when the user logs in.
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha256')
+app.config['PASSWORD_SALT_LENGTH'] = int(os.environ.get('PASSWORD_SALT_LENGTH', 16))
+app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('PASSWORD_HASH_WORKERS', 2))
+app.config['PASSWORD_HASH_MAX_PENDING'] = int(os.environ.get('PASSWORD_HASH_MAX_PENDING', 32))
+password_hasher = PasswordHasher(app)
+
+# Limits on the routes that send email, hash passwords or write comments (see rate_limit.py).
+# "memory" counts per worker process, "database" is shared by all of them.
+app.config['RATE_LIMIT_BACKEND'] = os.environ.get('RATE_LIMIT_BACKEND', 'memory')
+app.config['RATE_LIMIT_ENABLED'] = os.environ.get('RATE_LIMIT_ENABLED', '1') == '1'
+# Overrides per route, e.g. RATE_LIMITS='{"comment": "5/minute;50/day"}'
+app.config['RATE_LIMITS'] = json.loads(os.environ.get('RATE_LIMITS', '{}'))
+rate_limiter = RateLimiter(app)
+# Behind a proxy (e.g. Heroku's router) the client's IP and the scheme (for the absolute links in
+# the feeds) are in X-Forwarded-For/X-Forwarded-Proto
+if os.environ.get('TRUSTED_PROXY_COUNT'):
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=int(os.environ.get('TRUSTED_PROXY_COUNT')),
+                            x_proto=int(os.environ.get('TRUSTED_PROXY_COUNT')))
+
+
+def submitted_email():
+    # Rate limit key for the forms that act on an email address, whoever asks
+    return (request.form.get('email') or '').strip().lower() or None
+
 # TODO: Configure Flask-Login
 login_manager = LoginManager()
 login_manager.init_app(app)
 @login_manager.user_loader
 def load_user(user_id):
-    #Use when database already has at least one user
-    # return db.get_or_404(User, user_id)
-    #If refactoring database (For example new feature) Use this line and comment out first line until one account is made
-    return User.query.get(int(user_id))
+    # A cached snapshot of the user, not a User row (see user_cache.py)
+    return user_cache.load(user_id)
 
 # CREATE DATABASE
 class Base(DeclarativeBase):
     pass
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get("DB_URI", 'sqlite:///posts.db')
-db = SQLAlchemy(model_class=Base)
+# Connection pool of every engine. Pools are per worker process, so the number of workers times
+# (DB_POOL_SIZE + DB_MAX_OVERFLOW) has to stay under the database server's connection limit.
+engine_options = {
+    # Test a connection before handing it out, so ones the server or a proxy closed are replaced
+    'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', '1') == '1',
+    # Replace connections older than this (seconds) before the server's idle timeout closes them
+    'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+}
+for option, variable in (('pool_size', 'DB_POOL_SIZE'), ('max_overflow', 'DB_MAX_OVERFLOW'),
+                         ('pool_timeout', 'DB_POOL_TIMEOUT')):
+    if os.environ.get(variable):
+        engine_options[option] = int(os.environ.get(variable))
+# Anything else create_engine takes, e.g. DB_ENGINE_OPTIONS='{"pool_use_lifo": true}'
+engine_options.update(json.loads(os.environ.get('DB_ENGINE_OPTIONS', '{}')))
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options
+# Read replica for the read-only pages (see read_replica.py)
+if os.environ.get('DB_REPLICA_URI'):
+    app.config['SQLALCHEMY_BINDS'] = {'replica': os.environ.get('DB_REPLICA_URI')}
+app.config['REPLICA_STICKY_SECONDS'] = int(os.environ.get('REPLICA_STICKY_SECONDS', 10))
+# Number of post previews shown on each page of the home page
+app.config['POSTS_PER_PAGE'] = int(os.environ.get('POSTS_PER_PAGE', 10))
+app.config['ADMIN_USERS_PER_PAGE'] = int(os.environ.get('ADMIN_USERS_PER_PAGE', 50))
+# Number of comments shown under a post before "Load more comments"
+app.config['COMMENTS_PER_PAGE'] = int(os.environ.get('COMMENTS_PER_PAGE', 20))
+db = SQLAlchemy(model_class=Base, session_options={"class_": RoutingSession})
 db.init_app(app)
-mail = Mail(app)
+read_replica = ReadReplica(app, db)
 
-gravatar = Gravatar(app,
-                    size=100,
-                    rating='g',
-                    default='retro',
-                    force_default=False,
-                    force_lower=False,
-                    use_ssl=False,
-                    base_url=None)
+
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    # SQLite only enforces foreign keys (and runs ON DELETE actions) when asked to, per connection
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+
+with app.app_context():
+    if db.engine.dialect.name == "sqlite":
+        sqlalchemy.event.listen(db.engine, "connect", enable_sqlite_foreign_keys)
+# Rendered page cache: "memory" (pages per worker), "filesystem" (shared by all workers) or "null" (off).
+# Either way invalidations reach every worker, through version files in PAGE_CACHE_DIR.
+app.config['PAGE_CACHE_TYPE'] = os.environ.get('PAGE_CACHE_TYPE', 'memory')
+if os.environ.get('PAGE_CACHE_DIR'):
+    app.config['PAGE_CACHE_DIR'] = os.environ.get('PAGE_CACHE_DIR')
+app.config['PAGE_CACHE_MAX_ENTRIES'] = int(os.environ.get('PAGE_CACHE_MAX_ENTRIES', 500))
+app.config['PAGE_CACHE_TIMEOUT'] = int(os.environ.get('PAGE_CACHE_TIMEOUT', 300))
+# Cache-Control of the home page and posts for logged out visitors, e.g. "public, max-age=60"
+# to let a CDN serve them
+app.config['PAGE_CACHE_CONTROL'] = os.environ.get('PAGE_CACHE_CONTROL', 'no-cache')
+page_cache = PageCache(app)
+# Fingerprinted, precompressed and resized static files, built by "flask --app main assets build"
+if os.environ.get('STATIC_BUILD_DIR'):
+    app.config['STATIC_BUILD_DIR'] = os.environ.get('STATIC_BUILD_DIR')
+static_assets = StaticAssets(app)
+# Pages link to the hashed file names, so a new build has to change their cache keys and ETags
+app.config['PAGE_CACHE_RELEASE'] = static_assets.version
 
 
 # CONFIGURE TABLES
 class User(UserMixin, db.Model):
     __tablename__ = "users"
+    __table_args__ = (
+        # Newsletter subscribers only, used by the newsletter emails (see migrations.py)
+        db.Index('ix_users_newsletter_subscribers', 'id', 'email',
+                 sqlite_where=sqlalchemy.text('interests IS NOT NULL'),
+                 postgresql_where=sqlalchemy.text('interests IS NOT NULL')),
+        # The user list filtered by role, in id order
+        db.Index('ix_users_permission_status_id', 'permission_status', 'id'),
+    )
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     email: Mapped[str] = mapped_column(String(100), unique=True)
-    password: Mapped[str] = mapped_column(String(100))
+    password: Mapped[str] = mapped_column(String(255))
     name: Mapped[str] = mapped_column(String(100))
-    comments = relationship('Comment', back_populates='comment_author')
+    # Deleting a user leaves their comments and posts without an author (ON DELETE SET NULL in
+    # the database), passive_deletes stops the ORM loading them first
+    comments = relationship('Comment', back_populates='comment_author', passive_deletes=True)
     # This will act like a List of BlogPost objects attached to each User.
     # The "author" refers to the author property in the BlogPost class.
-    posts = relationship("BlogPost", back_populates="author")
-    reset_password_token: Mapped[str] = mapped_column(Text, nullable=True)
+    posts = relationship("BlogPost", back_populates="author", passive_deletes=True)
+    reset_password_token: Mapped[str] = mapped_column(Text, nullable=True, index=True)
     permission_status: Mapped[str] = mapped_column(Text, nullable=False)
     interests: Mapped[str] = mapped_column(Text, nullable=True)
     approx_location: Mapped[str] = mapped_column(Text, nullable=True)
     recieve_additional_information: Mapped[str] = mapped_column(Text, nullable=True)
+    # Gravatar hash of the email, for the /avatar URLs (see avatars.py)
+    avatar_hash: Mapped[str] = mapped_column(String(32), nullable=True)
+
+
+# Values of User.permission_status
+USER_ROLES = ("Blog-Writer", "Community_Member")
 
 
 class BlogPost(db.Model):
@@ -122,7 +227,8 @@ class BlogPost(db.Model):
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
 
     # Create Foreign Key, "users.id" the users refers to the tablename of User.
-    author_id: Mapped[int] = mapped_column(Integer, db.ForeignKey("users.id"))
+    author_id: Mapped[int] = mapped_column(Integer, db.ForeignKey("users.id", ondelete="SET NULL"), nullable=True,
+                                           index=True)
     # Create reference to the User object. The "posts" refers to the posts property in the User class.
     author = relationship("User", back_populates="posts")
 
@@ -131,18 +237,44 @@ class BlogPost(db.Model):
     date: Mapped[str] = mapped_column(String(250), nullable=False)
     body: Mapped[str] = mapped_column(Text, nullable=False)
     img_url: Mapped[str] = mapped_column(String(250), nullable=False)
-    comments = relationship('Comment', back_populates='parent_post')
-    #
+    # Deleted with the post by the database (ON DELETE CASCADE)
+    comments = relationship('Comment', back_populates='parent_post', cascade="all, delete", passive_deletes=True)
+    # Kept up to date by show_post and remove_comment so the count doesn't need a query
+    comment_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0, server_default="0")
+    # date is only for showing, these are for Last-Modified/ETag. updated_at moves whenever the post
+    # is edited or commented on (the comment routes change comment_count, which counts as an update).
+    created_at: Mapped[datetime] = mapped_column(DateTime, nullable=True, default=datetime.utcnow)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, nullable=True, default=datetime.utcnow,
+                                                 onupdate=datetime.utcnow, index=True)
+    # Made from body by set_body when the post is saved (see renditions.py), so showing a post
+    # doesn't parse any HTML
+    body_html: Mapped[str] = mapped_column(Text, nullable=True)
+    excerpt: Mapped[str] = mapped_column(Text, nullable=True)
+    word_count: Mapped[int] = mapped_column(Integer, nullable=True)
+    reading_minutes: Mapped[int] = mapped_column(Integer, nullable=True)
+    toc: Mapped[list] = mapped_column(JSON, nullable=True)
+
+    def set_body(self, body):
+        self.body = body
+        for name, value in render_post(body).items():
+            setattr(self, name, value)
 
 class Comment(db.Model):
     __tablename__ = 'comments'
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     text: Mapped[str] = mapped_column(Text, nullable=False)
-    author_id: Mapped[int] = mapped_column(Integer, db.ForeignKey("users.id"))
+    author_id: Mapped[int] = mapped_column(Integer, db.ForeignKey("users.id", ondelete="SET NULL"), nullable=True,
+                                           index=True)
     comment_author = relationship('User', back_populates='comments')
     parent_post = relationship('BlogPost', back_populates='comments')
-    post_id: Mapped[int] = mapped_column(Integer, db.ForeignKey('blog_posts.id'))
+    post_id: Mapped[int] = mapped_column(Integer, db.ForeignKey('blog_posts.id', ondelete="CASCADE"), index=True)
     #Change to string if error occurs
+    # Sanitized text, made by set_text when the comment is saved
+    text_html: Mapped[str] = mapped_column(Text, nullable=True)
+
+    def set_text(self, text):
+        self.text = text
+        self.text_html = render_comment(text)
 
 class Suggested_Edits(db.Model):
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
@@ -152,19 +284,198 @@ class Suggested_Edits(db.Model):
 
 
 class Reset_Password(db.Model):
+    # No longer written, reset links are signed tokens now (see reset_tokens.py)
     __tablename__ = 'reset_password'
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
-    email: Mapped[str] = mapped_column(Text, nullable=False)
+    email: Mapped[str] = mapped_column(Text, nullable=False, index=True)
     reset_token: Mapped[str] = mapped_column(String, nullable=True)
     last_reset: Mapped[str] = mapped_column(String, nullable=False)
+
+
+class Outgoing_Email(db.Model):
+    # Emails waiting to be sent by the mail queue workers (see mail_queue.py)
+    __tablename__ = 'outgoing_emails'
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    subject: Mapped[str] = mapped_column(String(250), nullable=False)
+    sender: Mapped[str] = mapped_column(String(250), nullable=True)
+    recipients: Mapped[str] = mapped_column(Text, nullable=False, default="")
+    bcc: Mapped[str] = mapped_column(Text, nullable=False, default="")
+    body: Mapped[str] = mapped_column(Text, nullable=False)
+    # pending, sending, sent or dead (gave up after MAIL_QUEUE_MAX_ATTEMPTS)
+    status: Mapped[str] = mapped_column(String(20), nullable=False, default="pending")
+    attempts: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    last_error: Mapped[str] = mapped_column(Text, nullable=True)
+    next_attempt_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    locked_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    sent_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+    # Set for the batches of a newsletter
+    newsletter_id: Mapped[int] = mapped_column(Integer, db.ForeignKey('newsletters.id'), nullable=True, index=True)
+
+
+class Newsletter(db.Model):
+    # A newsletter sent with new_newsletter_email, its batches are in outgoing_emails (see newsletter.py)
+    __tablename__ = 'newsletters'
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    subject: Mapped[str] = mapped_column(String(250), nullable=False)
+    body: Mapped[str] = mapped_column(Text, nullable=False)
+    sender: Mapped[str] = mapped_column(String(250), nullable=True)
+    # queueing (still making batches) or queued
+    status: Mapped[str] = mapped_column(String(20), nullable=False)
+    total_recipients: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    batch_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    # Last subscriber put in a batch, queueing carries on after them if it gets interrupted
+    last_user_id: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    locked_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+
+
+class Api_Cache(db.Model):
+    # Saved news/weather lookups so they survive restarts (see lookup_cache.py)
+    __tablename__ = 'api_cache'
+    __table_args__ = (db.UniqueConstraint('source', 'key'),)
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    source: Mapped[str] = mapped_column(String(20), nullable=False)
+    key: Mapped[str] = mapped_column(Text, nullable=False)
+    # JSON, "null" for lookups that found nothing
+    value: Mapped[str] = mapped_column(Text, nullable=False)
+    # Empty means it never expires
+    expires_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+
+
+class Rate_Limit_Counter(db.Model):
+    # Rate limit counts shared by every worker (see rate_limit.py)
+    __tablename__ = "rate_limit_counters"
+    key: Mapped[str] = mapped_column(String(250), primary_key=True)
+    window_start: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
+    count: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+
+
+class Site_Change(db.Model):
+    # When something happened that no row's updated_at shows, e.g. posts being deleted
+    __tablename__ = "site_changes"
+    name: Mapped[str] = mapped_column(String(50), primary_key=True)
+    changed_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+
+
+def record_site_change(name):
+    now = datetime.utcnow()
+    if not db.session.execute(db.update(Site_Change).where(Site_Change.name == name).values(changed_at=now)).rowcount:
+        db.session.add(Site_Change(name=name, changed_at=now))
+    db.session.commit()
+
+
+class Purge_Job(db.Model):
+    # A user or post with too many comments/posts to delete in one go (see purge.py)
+    __tablename__ = "purge_jobs"
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    # user or post
+    kind: Mapped[str] = mapped_column(String(10), nullable=False)
+    target_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    # pending or done
+    status: Mapped[str] = mapped_column(String(20), nullable=False, index=True)
+    # Child rows deleted or detached so far
+    removed: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    locked_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+
+
+class Quote(db.Model):
+    # Quotes shown on the home page (see quotes.py)
+    __tablename__ = "quotes"
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    text: Mapped[str] = mapped_column(Text, nullable=False)
+    author: Mapped[str] = mapped_column(String(250), nullable=True)
+    # How often it's picked compared to the others, 0 hides it
+    weight: Mapped[int] = mapped_column(Integer, nullable=False, default=1)
+    created_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, default=datetime.utcnow)
+    # Tells the workers' quote pools about edits when there's no page cache (see quotes.py)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, nullable=True, default=datetime.utcnow,
+                                                 onupdate=datetime.utcnow)
 # TODO: Create a User table for all your registered users.
 
-with app.app_context():
-    db.create_all()
+# Logged in users are kept as small read only snapshots, so most pages don't query the users
+# table. Role changes show up in other worker processes after USER_CACHE_TTL seconds.
+app.config['USER_CACHE_TTL'] = int(os.environ.get('USER_CACHE_TTL', 60))
+user_cache = UserCache(app, db, User)
+
+# Password reset links are signed tokens, valid once for RESET_TOKEN_MAX_AGE seconds
+app.config['RESET_TOKEN_MAX_AGE'] = int(os.environ.get('RESET_TOKEN_MAX_AGE', 3600))
+reset_tokens = ResetTokens(app, db, User, Reset_Password)
+
+app.config['SEARCH_RESULTS_PER_PAGE'] = int(os.environ.get('SEARCH_RESULTS_PER_PAGE', 20))
+search_index = SearchIndex(app, db, BlogPost)
+
+# Request timings, SQL query counts and outbound call timings, shown at /metrics
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+# Log requests slower than this many seconds, or running at least this many SQL queries
+if os.environ.get('SLOW_REQUEST_SECONDS'):
+    app.config['SLOW_REQUEST_SECONDS'] = float(os.environ.get('SLOW_REQUEST_SECONDS'))
+if os.environ.get('SLOW_REQUEST_QUERIES'):
+    app.config['SLOW_REQUEST_QUERIES'] = int(os.environ.get('SLOW_REQUEST_QUERIES'))
+metrics = Metrics(app, db)
+metrics.gauge("password_hash_pending", "Password hashes running or waiting in this process.",
+              lambda: password_hasher.stats()["pending"])
+rate_limiter.observer = metrics.observe_rate_limit
+
+# Comment avatars, fetched from Gravatar once and served from a disk cache
+if os.environ.get('AVATAR_CACHE_DIR'):
+    app.config['AVATAR_CACHE_DIR'] = os.environ.get('AVATAR_CACHE_DIR')
+app.config['AVATAR_CACHE_MAX_ENTRIES'] = int(os.environ.get('AVATAR_CACHE_MAX_ENTRIES', 5000))
+app.config['AVATAR_UPSTREAM'] = os.environ.get('AVATAR_UPSTREAM', 'https://www.gravatar.com/avatar/')
+avatars = AvatarProxy(app, response_hook=metrics.requests_hook)
+if app.config['RATE_LIMIT_BACKEND'] == 'database':
+    with app.app_context():
+        rate_limiter.backend = DatabaseBackend(db.engine, Rate_Limit_Counter.__table__)
+
+# Tables are made and changed with "flask --app main db upgrade" (see migrations.py), run it
+# before starting the app. Nothing touches the database while main is imported.
+migrations = Migrations(app, db)
+migrations.after_upgrade.append(search_index.create)
+
+# Emails are sent in the background, routes only queue them
+app.config['MAIL_QUEUE_WORKERS'] = int(os.environ.get('MAIL_QUEUE_WORKERS', 1))
+# Set MAIL_QUEUE_AUTOSTART=0 when running "flask mail-worker" as its own process
+app.config['MAIL_QUEUE_AUTOSTART'] = os.environ.get('MAIL_QUEUE_AUTOSTART', '1') == '1'
+app.config['MAIL_QUEUE_MAX_ATTEMPTS'] = int(os.environ.get('MAIL_QUEUE_MAX_ATTEMPTS', 5))
+# 0 means no limit. Keep this under what the SMTP server allows.
+app.config['MAIL_QUEUE_MAX_PER_MINUTE'] = int(os.environ.get('MAIL_QUEUE_MAX_PER_MINUTE', 0))
+mail_queue = MailQueue(app, db, model=Outgoing_Email)
+mail_queue.send_observer = metrics.observe_smtp
+metrics.gauge("mail_queue_pending", "Queued emails waiting to be sent.",
+              lambda: db.session.execute(db.select(db.func.count(Outgoing_Email.id))
+                                         .where(Outgoing_Email.status == "pending")).scalar())
+
+# Subscribers per newsletter email (they are put in bcc)
+app.config['NEWSLETTER_BATCH_SIZE'] = int(os.environ.get('NEWSLETTER_BATCH_SIZE', 50))
+newsletter_sender = NewsletterSender(app, db, User, Newsletter, mail_queue)
+
+# Users and posts with more comments/posts than this are deleted by a background purge, in
+# batches, instead of in one statement
+app.config['PURGE_INLINE_LIMIT'] = int(os.environ.get('PURGE_INLINE_LIMIT', 1000))
+app.config['PURGE_BATCH_SIZE'] = int(os.environ.get('PURGE_BATCH_SIZE', 500))
+purger = Purger(app, db, Purge_Job, User, BlogPost, Comment)
+
+
+def rows_deleted(kind, ids):
+    # Deleted posts (and authors' names gone from posts) don't move any updated_at, so the home
+    # page's Last-Modified would stay the same without this
+    record_site_change("posts_deleted")
+    if kind == "user":
+        for user_id in ids:
+            user_cache.invalidate(user_id)
+        # Their name disappears from their posts and comments
+        page_cache.clear()
+    else:
+        page_cache.invalidate("posts", *[f"post:{post_id}" for post_id in ids])
+
+
+purger.on_deleted = rows_deleted
 
 
 # TODO: Use Werkzeug to hash the user's password when creating a new user.
 @app.route('/register', methods=["GET", "POST"])
+@rate_limiter.limit("register", "5/hour")
 def register():
     form = forms.RegisterForm()
     if form.validate_on_submit():
@@ -177,31 +488,29 @@ def register():
             flash("You've already signed up with that email, log in instead!")
             return redirect(url_for('login'))
 
-        hash_and_salted_password = generate_password_hash(
-            form.password.data,
-            method='pbkdf2:sha256',
-            salt_length=8
-        )
+        hash_and_salted_password = password_hasher.hash(form.password.data)
         new_user = User(
             email=form.email.data,
             name=form.name.data,
             password=hash_and_salted_password,
-            permission_status = "Community_Member"
+            permission_status = "Community_Member",
+            avatar_hash=avatar_hash(form.email.data)
         )
         db.session.add(new_user)
         db.session.commit()
         # This line will authenticate the user with Flask-Login
         login_user(new_user)
 
-        msg = Message('Hello and welcome to my blog website', sender=my_email, recipients=[new_user.email])
+        msg = Email('Hello and welcome to my blog website', sender=my_email, recipients=[new_user.email])
         msg.body = "Thank you for signing up on my blog website. I am glad that you decided to sign up! Now you can access all the features of the website and can enjoy my website more. I hope you enjoy spending time on my website. If you have any feedback you would like to share that will make my website better, share it under 'suggest edit'. Also if there are any other questions that you want to ask me so that only I can see it, you can also ask those questions there as well. Thank you and I hope you enjoy!"
-        mail.send(msg)
+        mail_queue.enqueue(msg)
         return redirect(url_for("get_all_posts"))
     return render_template("register.html", form=form, current_user=current_user)
 
 
 # TODO: Retrieve a user from the database based on their email. 
 @app.route('/login', methods=['GET', "POST"])
+@rate_limiter.limit("login", "10/minute;100/hour", keys=("ip", submitted_email))
 def login():
     form = forms.LoginForm()
     if form.validate_on_submit():
@@ -211,7 +520,11 @@ def login():
             flash('Email Not Found')
         else:
             password = request.form.get('password')
-            if check_password_hash(pwhash=user.password, password=password) == True:
+            if password_hasher.verify(user.password, password) == True:
+                if password_hasher.needs_rehash(user.password):
+                    # Saved with older hash settings, save it again with the current ones
+                    user.password = password_hasher.hash(password)
+                    db.session.commit()
                 login_user(user)
             else:
                 flash("Password Incorrect, please try again.")
@@ -225,57 +538,166 @@ def logout():
     logout_user()
     return redirect(url_for('get_all_posts'))
 
-#TODO: Add feature that will allow me to dynamically add new quotes and save them in a database rather than a hardcoded list
+# Home page quotes come from the quotes table, through a pool kept in each process so the home
+# page doesn't query it. Other workers pick up changes within QUOTE_POOL_TTL seconds.
+app.config['QUOTE_POOL_TTL'] = int(os.environ.get('QUOTE_POOL_TTL', 300))
+quote_pool = QuotePool(app, db, Quote, page_cache)
+
+
+def get_post_page(after=None, before=None, page_size=10):
+    # Keyset pagination on BlogPost.id. Only loads the columns the post preview needs
+    # (no body) and joins the author name in so the template doesn't lazy load each author.
+    query = db.select(
+        BlogPost.id,
+        BlogPost.title,
+        BlogPost.subtitle,
+        BlogPost.date,
+        BlogPost.reading_minutes,
+        User.name.label('author_name')
+    ).outerjoin(User, BlogPost.author_id == User.id)
+    if before is not None:
+        # Going back a page: take the page right before the cursor and flip it back into order
+        query = query.where(BlogPost.id < before).order_by(BlogPost.id.desc())
+    else:
+        if after is not None:
+            query = query.where(BlogPost.id > after)
+        query = query.order_by(BlogPost.id)
+    # Ask for one extra row so we know if there is another page in that direction
+    posts = db.session.execute(query.limit(page_size + 1)).all()
+    has_more = len(posts) > page_size
+    posts = posts[:page_size]
+    if before is not None:
+        posts.reverse()
+    if not posts:
+        return posts, None, None
+    if before is not None:
+        previous_cursor = posts[0].id if has_more else None
+        next_cursor = posts[-1].id
+    else:
+        previous_cursor = posts[0].id if after is not None else None
+        next_cursor = posts[-1].id if has_more else None
+    return posts, previous_cursor, next_cursor
+
+
+def posts_last_modified():
+    # Deleted posts don't move anyone's updated_at, so the time of the last delete counts too
+    # (for Last-Modified), and so does the post count (for the ETag)
+    deleted_at = db.select(Site_Change.changed_at).where(Site_Change.name == "posts_deleted").scalar_subquery()
+    last_modified, last_deleted, count = db.session.execute(
+        db.select(db.func.max(BlogPost.updated_at), deleted_at, db.func.count(BlogPost.id))).one()
+    return max(filter(None, (last_modified, last_deleted)), default=None), count
+
+
+# Atom/RSS feeds and the sitemap, made again whenever the home page is
+app.config['FEED_MAX_ENTRIES'] = int(os.environ.get('FEED_MAX_ENTRIES', 20))
+app.config['SITEMAP_MAX_URLS'] = int(os.environ.get('SITEMAP_MAX_URLS', 50000))
+feeds = Feeds(app, db, BlogPost, User, page_cache, validator=posts_last_modified)
+
 
-quotes = ["You miss 100% of the shots you don't take - Wayne Gretzky", "I can is 100 times more important than I.Q - Albert Einstein", "A winner is a dreamer who never gives up. - Nelson Mandela", "Don't cry because it'a over, smile because it happened"]
-import random
 @app.route('/')
+@page_cache.cached("posts", "quotes", validator=posts_last_modified)
 def get_all_posts():
-    quote_to_display = random.choice(quotes)
-    result = db.session.execute(db.select(BlogPost))
-    posts = result.scalars().all()
-    return render_template("index.html", all_posts=posts, quote=quote_to_display)
+    quote_to_display = quote_pool.choice()
+    posts, previous_cursor, next_cursor = get_post_page(
+        after=request.args.get('after', type=int),
+        before=request.args.get('before', type=int),
+        page_size=app.config['POSTS_PER_PAGE']
+    )
+    # Only logged in users see delete buttons, and making the form gives the visitor a session
+    delete_form = forms.DeletePost() if current_user.is_authenticated else None
+    return render_template("index.html", all_posts=posts, quote=quote_to_display, delete_form=delete_form,
+                           previous_cursor=previous_cursor, next_cursor=next_cursor)
+
+
+def get_comment_page(post_id, after=None, page_size=20):
+    # One query for a page of comments with their authors (only the columns the comment list uses)
+    query = db.select(Comment).where(Comment.post_id == post_id).options(
+        joinedload(Comment.comment_author).load_only(User.id, User.name, User.avatar_hash)
+    ).order_by(Comment.id)
+    if after is not None:
+        query = query.where(Comment.id > after)
+    comments = db.session.execute(query.limit(page_size + 1)).scalars().all()
+    if any(comment.text_html is None for comment in comments):
+        # Saved before renditions existed and "flask render-posts" hasn't been run yet
+        for comment in comments:
+            if comment.text_html is None:
+                comment.set_text(comment.text)
+        db.session.commit()
+    next_cursor = comments[page_size - 1].id if len(comments) > page_size else None
+    return comments[:page_size], next_cursor
 
 
 # TODO: Allow logged-in users to comment on posts
+def post_last_modified(post_id):
+    updated_at = db.session.execute(db.select(BlogPost.updated_at).where(BlogPost.id == post_id)).first()
+    return None if updated_at is None else (updated_at[0], "")
+
+
 @app.route("/post/<int:post_id>", methods=["GET", "POST"])
+@rate_limiter.limit("comment", "10/minute;200/day", keys=("ip", "user"))
+@page_cache.cached("post:{post_id}", validator=post_last_modified)
 def show_post(post_id):
-    requested_post = db.get_or_404(BlogPost, post_id)
+    requested_post = db.session.execute(
+        db.select(BlogPost).where(BlogPost.id == post_id).options(joinedload(BlogPost.author))
+    ).scalar()
+    if requested_post is None:
+        abort(404)
+    if requested_post.body_html is None:
+        # Saved before renditions existed and "flask render-posts" hasn't been run yet
+        requested_post.set_body(requested_post.body)
+        db.session.commit()
     form = forms.CommentForm()
     if form.validate_on_submit():
         if current_user.is_authenticated:
             text = form.comment.data
-            comment = Comment(text=text, comment_author=current_user, parent_post=requested_post)
+            comment = Comment(author_id=current_user.id, parent_post=requested_post)
+            comment.set_text(text)
             db.session.add(comment)
+            requested_post.comment_count = BlogPost.comment_count + 1
             db.session.commit()
+            page_cache.invalidate(f"post:{post_id}")
         else:
             flash('You need to login in or sign up to continue')
             return redirect(url_for('login'))
-    return render_template("post.html", post=requested_post, form=form)
+    comments, next_cursor = get_comment_page(post_id, page_size=app.config['COMMENTS_PER_PAGE'])
+    return render_template("post.html", post=requested_post, form=form, comments=comments, next_cursor=next_cursor)
+
+
+@app.route("/post/<int:post_id>/comments")
+def more_comments(post_id):
+    # Used by the "Load more comments" button on the post page
+    comments, next_cursor = get_comment_page(post_id, after=request.args.get('after', type=int),
+                                             page_size=app.config['COMMENTS_PER_PAGE'])
+    return jsonify(html=render_template("comments.html", comments=comments, post_id=post_id),
+                   next_cursor=next_cursor)
 
 
 # TODO: Use a decorator so only an admin user can create a new post
-@admin_only
 @app.route("/new-post", methods=["GET", "POST"])
+@admin_only
 def add_new_post():
     form = forms.CreatePostForm()
     if form.validate_on_submit():
         new_post = BlogPost(
             title=form.title.data,
             subtitle=form.subtitle.data,
-            body=form.body.data,
             img_url=form.img_url.data,
-            author=current_user,
+            author_id=current_user.id,
             date=date.today().strftime("%B %d, %Y")
         )
+        new_post.set_body(form.body.data)
         db.session.add(new_post)
+        # Flush first so the new post has an id for the search index
+        db.session.flush()
+        search_index.index_post(new_post)
         db.session.commit()
+        page_cache.invalidate("posts")
         return redirect(url_for("get_all_posts"))
     return render_template("make-post.html", form=form)
 
 # TODO: Use a decorator so only an admin user can edit a post
-@admin_only
 @app.route("/edit-post/<int:post_id>", methods=["GET", "POST"])
+@admin_only
 def edit_post(post_id):
     post = db.get_or_404(BlogPost, post_id)
     edit_form = CreatePostForm(
@@ -289,31 +711,43 @@ def edit_post(post_id):
         post.title = edit_form.title.data
         post.subtitle = edit_form.subtitle.data
         post.img_url = edit_form.img_url.data
-        post.author = current_user
-        post.body = edit_form.body.data
+        post.author_id = current_user.id
+        post.set_body(edit_form.body.data)
+        search_index.index_post(post)
         db.session.commit()
+        page_cache.invalidate("posts", f"post:{post_id}")
         return redirect(url_for("show_post", post_id=post.id))
     return render_template("make-post.html", form=edit_form, is_edit=True)
 
 
 
 # TODO: Use a decorator so only an admin user can delete a post
+@app.route("/delete/<int:post_id>", methods=["POST"])
 @admin_only
-@app.route("/delete/<int:post_id>")
 def delete_post(post_id):
+    if not forms.DeletePost().validate_on_submit():
+        return abort(400)
     if post_id == 1:
         post_to_delete = db.get_or_404(BlogPost, 1)
     else:
         post_to_delete = db.get_or_404(BlogPost, post_id)
-    db.session.delete(post_to_delete)
-    db.session.commit()
+    search_index.remove_post(post_to_delete.id)
+    # Its comments go with it
+    purger.delete("post", [post_to_delete.id])
     return redirect(url_for('get_all_posts'))
 
 @app.route("/remove-comment/<int:comment_id>/<post_id>")
 def remove_comment(comment_id, post_id):
     comment_to_delete = db.get_or_404(Comment, comment_id)
+    # Only the comment's author or the admin. Comments of deleted users have no author.
+    if not current_user.is_authenticated or (
+            comment_to_delete.author_id != current_user.id and current_user.id != 1):
+        return abort(403)
+    db.session.execute(db.update(BlogPost).where(BlogPost.id == comment_to_delete.post_id)
+                       .values(comment_count=BlogPost.comment_count - 1))
     db.session.delete(comment_to_delete)
     db.session.commit()
+    page_cache.invalidate(f"post:{post_id}")
     return redirect(url_for('show_post', post_id=post_id))
 
 @app.route("/suggest-edit", methods=["GET", "POST"])
@@ -329,15 +763,15 @@ def suggest_an_edit():
         return redirect(url_for('get_all_posts'))
     return render_template('suggest_edit.html', form=form)
 
-@admin_only
 @app.route('/view_suggested_edits')
+@admin_only
 def view_edits():
     result = db.session.execute(db.select(Suggested_Edits))
     edits = result.scalars().all()
     return render_template('see_all_edits.html', edits=edits)
 
-@admin_only
 @app.route("/remove_suggestion/<suggestion_id>", methods=["GET", "POST"])
+@admin_only
 def remove_suggestion(suggestion_id):
     suggestion_to_remove = db.get_or_404(Suggested_Edits, suggestion_id)
     db.session.delete(suggestion_to_remove)
@@ -345,110 +779,107 @@ def remove_suggestion(suggestion_id):
     return redirect(url_for('view_edits'))
 
 
+@app.route("/search")
+def search():
+    query = request.args.get('q', '').strip()
+    page = max(request.args.get('page', 1, type=int), 1)
+    results, has_more = search_index.search(query, page) if query else ([], False)
+    return render_template("search.html", query=query, results=results, page=page, has_more=has_more)
+
+
+@app.route("/quotes", methods=["GET", "POST"])
+@admin_only
+def manage_quotes():
+    form = forms.QuoteForm()
+    if form.validate_on_submit():
+        db.session.add(Quote(text=form.text.data, author=form.author.data or None, weight=form.weight.data))
+        db.session.commit()
+        quote_pool.changed()
+        return redirect(url_for('manage_quotes'))
+    all_quotes = db.session.execute(db.select(Quote).order_by(Quote.id)).scalars().all()
+    return render_template('quotes.html', form=form, all_quotes=all_quotes)
+
+
+@app.route("/edit-quote/<int:quote_id>", methods=["GET", "POST"])
+@admin_only
+def edit_quote(quote_id):
+    quote = db.get_or_404(Quote, quote_id)
+    form = forms.QuoteForm(obj=quote)
+    if form.validate_on_submit():
+        quote.text = form.text.data
+        quote.author = form.author.data or None
+        quote.weight = form.weight.data
+        db.session.commit()
+        quote_pool.changed()
+        return redirect(url_for('manage_quotes'))
+    return render_template('quotes.html', form=form, is_edit=True)
+
+
+@app.route("/delete-quote/<int:quote_id>")
+@admin_only
+def delete_quote(quote_id):
+    quote = db.get_or_404(Quote, quote_id)
+    db.session.delete(quote)
+    db.session.commit()
+    quote_pool.changed()
+    return redirect(url_for('manage_quotes'))
+
+
 @app.route("/about")
 def about():
     return render_template("about.html")
 
 
 @app.route("/contact", methods=['GET', "POST"])
+@rate_limiter.limit("contact", "5/hour", keys=("ip", "user"))
 def contact():
     form = forms.ContactMe()
     if form.validate_on_submit():
         name = form.name.data
         email = form.email_address.data
         message = form.message.data
-        msg = Message('Request from user', sender=my_email, recipients=[my_email])
+        msg = Email('Request from user', sender=my_email, recipients=[my_email])
         msg.body = f"This email is by: {name} from {email}. This is what they want you to read: {message}. If this message was not appropriate here are the details of the person who sent it: {current_user.email}, {current_user.name}. If there is an issue please deal with it according. For now, take action on the email!"
-        mail.send(msg)
+        mail_queue.enqueue(msg)
         return redirect(url_for('get_all_posts'))
 
     return render_template("contact.html", form=form)
 
 @app.route("/reset_password", methods=['GET', "POST"])
+@rate_limiter.limit("reset_password", "5/hour", keys=("ip", submitted_email))
 def reset_pass():
     form = forms.Change_Password()
     if form.validate_on_submit():
-        result = db.session.execute(db.select(User).where(User.email == form.email.data))
-        user = result.scalar()
-        if user:
-            import random
-            letters = ['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h', 'i', 'j', 'k', 'l', 'm', 'n', 'o', 'p', 'q', 'r', 's',
-                       't', 'u', 'v', 'w', 'x', 'y', 'z', 'A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'J', 'K', 'L',
-                       'M', 'N', 'O', 'P', 'Q', 'R', 'S', 'T', 'U', 'V', 'W', 'X', 'Y', 'Z']
-            numbers = ['0', '1', '2', '3', '4', '5', '6', '7', '8', '9']
-            symbols = ['!', '$', '&', '+']
-            nr_letters = 17
-            nr_symbols = 5
-            nr_numbers = 7
-            password_list = []
-            letters_pass = [random.choice(letters) for char in range(1, nr_letters + 1)]
-            symbols_pass = [random.choice(symbols) for char in range(1, nr_symbols + 1)]
-            numbers_pass = [random.choice(numbers) for char in range(1, nr_numbers + 1)]
-            password_list = letters_pass + symbols_pass + numbers_pass
-            random.shuffle(password_list)
-            token_reset = ""
-            for char in password_list:
-                token_reset += char
-
-            result = db.session.execute(db.select(Reset_Password).where(Reset_Password.email == form.email.data))
-            user = result.scalar()
-            if user:
-                # if user.last_reset == date.today().strftime("%B %d, %Y"):
-                #     flash("You've reset your password already today! Please submit another request tomorrow.")
-                #     return redirect(url_for('reset_pass'))
-                result = db.session.execute(db.select(Reset_Password).where(Reset_Password.email == form.email.data)).scalar()
-                result.reset_token = token_reset
-                user.last_reset = date.today().strftime("%B %d, %Y")
-            else:
-                new_user_pass = Reset_Password(email=form.email.data, reset_token=token_reset, last_reset=date.today().strftime("%B %d, %Y"))
-                db.session.add(new_user_pass)
-            db.session.commit()
-            print("Test")
-            result = db.session.execute(db.select(Reset_Password).where(Reset_Password.email == form.email.data))
-            user = result.scalar()
-            print(user)
-            user_user = db.session.execute(db.select(User).where(User.email == Reset_Password.email)).scalar()
-            if user_user == None:
-                flash("You do not have a valid account with that email. Create an account or enter a correct email instead")
-                return redirect(url_for('register'))
-            else:
-                user_user.reset_password_token = token_reset
-                db.session.commit()
-                print(user_user.reset_password_token)
-
-            msg = Message('Reset Password Key', sender=my_email, recipients=[form.email.data])
-            msg.body = f"This message has been automatically sent by the reset password request using your account. If you did not request a password reset, you may reset your password as someone likely knows your password. Here is your token: {user.reset_token}. If you add this in the website address /confirm_reset/{user.reset_token} it will reset your password by filling out the form specified. Thanks, hope this helps!"
-            mail.send(msg)
-            return redirect(url_for('get_all_posts'))
+        issued = reset_tokens.issue(form.email.data)
+        if issued is None:
+            flash("You do not have a valid account with that email. Create an account or enter a correct email instead")
+            return redirect(url_for('register'))
+        email, token = issued
+        link = url_for('confirm_reset', token=token, _external=True)
+        msg = Email('Reset Password Key', sender=my_email, recipients=[email])
+        msg.body = f"This message has been automatically sent by the reset password request using your account. If you did not request a password reset, you may reset your password as someone likely knows your password. Open {link} to reset your password by filling out the form there. The link works once, for the next {app.config['RESET_TOKEN_MAX_AGE'] // 60} minutes. Thanks, hope this helps!"
+        mail_queue.enqueue(msg)
+        return redirect(url_for('get_all_posts'))
 
     return render_template('reset_pass_step_1.html', form=form)
 
 @app.route("/confirm_reset/<token>", methods=['GET', "POST"])
 def confirm_reset(token):
-    # Check if it has been more than one hour
-    print(token)
-    user = db.session.execute(db.select(User).where(User.reset_password_token == token)).scalar()
-    if user == None:
+    try:
+        user = reset_tokens.verify(token)
+    except ExpiredResetToken:
+        flash('This reset link has expired, ask for a new one')
+        return redirect(url_for('reset_pass'))
+    except InvalidResetToken:
         flash('Invalid Token')
-    else:
-        form = forms.Change_Password_Step_2()
-        if form.validate_on_submit():
-            print(user.password)
-            print(form.new_password.data)
-            hash_and_salted_password = generate_password_hash(
-                form.new_password.data,
-                method='pbkdf2:sha256',
-                salt_length=8
-            )
-            user.password = hash_and_salted_password
-            user.reset_password_token = ""
-            db.session.commit()
-            print(user.password)
-            return redirect(url_for('login'))
-
-
-        return render_template('Reset_Password_Step2.html', form=form)
-    return redirect(url_for('get_all_posts'))
+        return redirect(url_for('reset_pass'))
+    form = forms.Change_Password_Step_2()
+    if form.validate_on_submit():
+        # Changing the hash is what makes the link stop working
+        user.password = password_hasher.hash(form.new_password.data)
+        db.session.commit()
+        return redirect(url_for('login'))
+    return render_template('Reset_Password_Step2.html', form=form)
 
 @app.route("/delete_account", methods=['GET', "POST"])
 def delete_account():
@@ -456,128 +887,289 @@ def delete_account():
     if form.validate_on_submit():
         if current_user.is_authenticated:
             if form.confirmation.data == "I confirm that I would like to delete my account and I understand that this action cannot be undone" and form.double_confirmation.data == "I confirm that I would like to delete my account and I understand that this action cannot be undone":
-                user = db.session.execute(db.select(User).where(User.email == current_user.email)).scalar()
-                db.session.delete(user)
-                db.session.commit()
+                user_id = current_user.id
+                # Logged out first, a user with lots of posts or comments is deleted in the background
+                logout_user()
+                purger.delete("user", [user_id])
         return redirect(url_for('get_all_posts'))
     return render_template('confirm_delete_account.html', form=form)
-@admin_only
+def get_user_page(role=None, newsletter=False, email_prefix=None, after=None, before=None, page_size=50):
+    # Keyset pagination on User.id like get_post_page, with each filter served by an index:
+    # role by ix_users_permission_status_id, newsletter by the subscriber partial index, and
+    # the email prefix by a range scan of the unique email index
+    query = db.select(
+        User.id,
+        User.name,
+        User.email,
+        User.permission_status,
+        (User.interests != None).label('subscribed')
+    )
+    if role:
+        query = query.where(User.permission_status == role)
+    if newsletter:
+        query = query.where(User.interests != None)
+    if email_prefix:
+        query = query.where(User.email >= email_prefix, User.email < email_prefix + "\U0010ffff",
+                            User.email.startswith(email_prefix, autoescape=True))
+    if before is not None:
+        query = query.where(User.id < before).order_by(User.id.desc())
+    else:
+        if after is not None:
+            query = query.where(User.id > after)
+        query = query.order_by(User.id)
+    users = db.session.execute(query.limit(page_size + 1)).all()
+    has_more = len(users) > page_size
+    users = users[:page_size]
+    if before is not None:
+        users.reverse()
+    if not users:
+        return users, None, None
+    if before is not None:
+        previous_cursor = users[0].id if has_more else None
+        next_cursor = users[-1].id
+    else:
+        previous_cursor = users[0].id if after is not None else None
+        next_cursor = users[-1].id if has_more else None
+    return users, previous_cursor, next_cursor
+
+
+def user_filters():
+    # The filters of the user list, kept in the pager and bulk action links
+    return {key: value for key, value in (('role', request.args.get('role', '').strip()),
+                                          ('newsletter', request.args.get('newsletter', '')),
+                                          ('email', request.args.get('email', '').strip())) if value}
+
+
 @app.route("/edit_user_permissions")
+@admin_only
 def edit_user_permissions():
-    all_users = User.query.all()
-    return render_template('change_users_status.html', all_users=all_users)
+    filters = user_filters()
+    users, previous_cursor, next_cursor = get_user_page(
+        role=filters.get('role'),
+        newsletter=filters.get('newsletter') == '1',
+        email_prefix=filters.get('email'),
+        after=request.args.get('after', type=int),
+        before=request.args.get('before', type=int),
+        page_size=app.config['ADMIN_USERS_PER_PAGE']
+    )
+    return render_template('change_users_status.html', all_users=users, filters=filters,
+                           previous_cursor=previous_cursor, next_cursor=next_cursor,
+                           form=forms.BulkUserAction(), roles=USER_ROLES)
+
+
+def bulk_user_action(action, user_ids):
+    # One UPDATE or DELETE per chunk of ids instead of loading and changing users one at a time.
+    # The logged in admin is left out so they can't lock themselves out.
+    user_ids = sorted({user_id for user_id in user_ids if user_id != current_user.id})
+    changed = queued = 0
+    for start in range(0, len(user_ids), 500):
+        chunk = user_ids[start:start + 500]
+        if action == 'delete':
+            # Their posts and comments stay, without an author. Users with lots of them are
+            # deleted by a background purge.
+            deleted, purging = purger.delete("user", chunk)
+            changed += deleted
+            queued += purging
+        else:
+            changed += db.session.execute(db.update(User).where(User.id.in_(chunk))
+                                          .values(permission_status=action)).rowcount
+    if action != 'delete':
+        db.session.commit()
+        for user_id in user_ids:
+            user_cache.invalidate(user_id)
+        page_cache.invalidate(*[f"user:{user_id}" for user_id in user_ids])
+    return changed, queued
+
 
+@app.route("/edit_user_permissions/bulk", methods=["POST"])
 @admin_only
+def bulk_edit_users():
+    form = forms.BulkUserAction()
+    if form.validate_on_submit():
+        user_ids = request.form.getlist('user_ids', type=int)[:app.config['ADMIN_USERS_PER_PAGE']]
+        changed, queued = bulk_user_action(form.action.data, user_ids)
+        if form.action.data == 'delete':
+            flash(f"Deleted {changed} users." + (f" {queued} more are being deleted in the background." if queued else ""))
+        else:
+            flash(f"Changed {changed} users.")
+    return redirect(url_for('edit_user_permissions', **user_filters()))
+
+# Distinct interests/locations fetched at the same time for the personalized emails
+app.config['PERSONALIZED_EMAIL_FETCH_WORKERS'] = int(os.environ.get('PERSONALIZED_EMAIL_FETCH_WORKERS', 8))
+_personalized_email_job = None
+_personalized_email_job_lock = threading.Lock()
+
+
+def personalized_email_job():
+    # news_weather (and requests with it) is only imported once the emails are sent
+    global _personalized_email_job
+    with _personalized_email_job_lock:
+        if _personalized_email_job is None:
+            from news_weather import PersonalizedEmailJob
+            _personalized_email_job = PersonalizedEmailJob(response_hook=metrics.requests_hook)
+    return _personalized_email_job
+
+# How long (seconds) lookups are cached. Geocoding a place name never changes, so it's kept forever.
+lookup_cache = LookupCache(
+    ttls={
+        'news': int(os.environ.get('NEWS_CACHE_TTL', 6 * 60 * 60)),
+        'forecast': int(os.environ.get('FORECAST_CACHE_TTL', 60 * 60)),
+        'geocode': None
+    },
+    # Places OpenWeather doesn't know are remembered for a day
+    negative_ttls={'geocode': int(os.environ.get('GEOCODE_NEGATIVE_CACHE_TTL', 24 * 60 * 60))}
+)
+if os.environ.get('LOOKUP_CACHE_PERSIST', '1') == '1':
+    with app.app_context():
+        lookup_cache.store = DatabaseStore(db.engine, Api_Cache.__table__)
+
+
 @app.route('/send_personalized_emails')
+@admin_only
 def personalized_emails():
-    result = db.session.execute(db.select(User).where(User.interests != None)).scalars()
-    result_list = result.fetchall()
-    for user in result_list:
-        api_key_new = os.environ.get('news_api_key')
-        app_id = os.environ.get('app_id')
-        data = requests.get((f'https://newsapi.org/v2/everything?qInTitle={user.interests}&sortBy=popularity&apiKey={api_key_new}'))
-        data = html.unescape(data.json())
-        start_point = data["articles"]
-        first_three = start_point[:3]
-        articles = [html.unescape(f"{article['title']} Description: {article['description']}").encode('ascii', 'ignore') for article in first_three]
-        response = requests.get(f"http://api.openweathermap.org/geo/1.0/direct?q={user.approx_location}&limit=2&appid={app_id}")
-        response.raise_for_status()
-        data = response.json()
-        lat = data[0]["lat"]
-        lon = data[0]['lon']
-        response = requests.get(f"https://api.openweathermap.org/data/2.5/forecast?lat={lat}&lon={lon}&appid={app_id}&cnt=8")
-        response.raise_for_status()
-        data = response.json()
-        will_rain = False
-        is_sunny = False
-        temperatures = []
-        temp_feels = []
-        for hour_data in data["list"]:
-            current_type = hour_data["weather"][0]["main"]
-            wind_speed = hour_data["wind"]["speed"]
-            current_id = hour_data["weather"][0]["id"]
-            temperature_as_fahrenheit_min = round((((hour_data["main"]["temp_min"]) - 273.15) * 9 / 5) + 32)
-            temperatures.append(temperature_as_fahrenheit_min)
-            temperature_as_fahrenheit_max = round((((hour_data["main"]["temp_max"]) - 273.15) * 9 / 5) + 32)
-            temperatures.append(temperature_as_fahrenheit_max)
-            temperature_feel = round((((hour_data["main"]["feels_like"]) - 273.15) * 9 / 5) + 32)
-            temp_feels.append(temperature_feel)
-            if int(current_id) < 700:
-                will_rain = True
-            if int(current_id) >= 800:
-                is_sunny = True
-        low = min(temperatures)
-        high = max(temperatures)
-        average_feel = round(statistics.mean(temp_feels), 2)
-        if will_rain and is_sunny:
-            subject = "Mixed weather Today"
-            msgs = f'The weather will be somewhat rainy but also sunny at the same time today. You might want to bring an umbrella with you! The low will be {low} degrees with the high being {high}. It will feel on average {average_feel} degrees. It will be {current_type}y and {wind_speed} MPH wind.'
-        elif will_rain:
-            subject = "Rain Today!"
-            msgs = f"It will likely rain today! Bring an umbrella to work or school. It will be a low of {low} degrees with a high of {high} degrees. The temperature feels like {average_feel}. It will be {current_type}y and {wind_speed} mph wind."
-        elif is_sunny:
-            subject = "Sunny Weather Today!"
-            msgs = f"It is pretty sunny weather for the next 24 hours! There will be a low of {low} degrees and a high of {high} degrees. The temperature feels like {average_feel}. It will be {current_type}y and {wind_speed} MPH wind."
-
-        msg = Message("Your news and Local weather", sender=my_email, recipients=[user.email])
-        msg.body = f"Here are some articles that you might like! 1{articles[0]} \n 2{articles[1]} \n 3{articles[2]}. I hope you enjoy! \n Here is the weather near you: {subject}: {msgs}"
-        mail.send(msg)
-    return render_template('index.html')
+    # The emails are built in a background thread, follow along on the status page
+    personalized_email_job().start(app, db, User, mail_queue, my_email, cache=lookup_cache)
+    return redirect(url_for('personalized_emails_status'))
+
 
+@app.route('/send_personalized_emails/status')
 @admin_only
+def personalized_emails_status():
+    return jsonify(personalized_email_job().progress)
+
+
+@app.cli.command("send-personalized-emails")
+def send_personalized_emails_command():
+    """Build and queue the personalized news and weather emails."""
+    last_state = None
+
+    def report(progress):
+        nonlocal last_state
+        done = progress.get("fetched", 0) + progress.get("enqueued", 0) + progress.get("skipped", 0)
+        if progress["state"] != last_state or done % 100 == 0:
+            last_state = progress["state"]
+            print(f"{progress['state']}: fetched {progress.get('fetched', 0)}, enqueued {progress.get('enqueued', 0)}, skipped {progress.get('skipped', 0)} of {progress.get('total_users', 0)} users")
+
+    progress = personalized_email_job().run(app, db, User, mail_queue, my_email, cache=lookup_cache, report=report)
+    for error in progress["errors"]:
+        print(error)
+    print(f"Lookup cache: {progress['cache']}")
+
+
+@app.cli.command("render-posts")
+@click.option("--all", "render_all", is_flag=True, help="Render every post and comment again, not just ones never rendered.")
+def render_posts_command(render_all):
+    """Make the sanitized HTML, excerpt and table of contents of saved posts and comments."""
+    for model, column in ((BlogPost, BlogPost.body_html), (Comment, Comment.text_html)):
+        count = 0
+        last_id = 0
+        while True:
+            # A batch at a time in id order, so big tables aren't loaded at once
+            query = db.select(model).where(model.id > last_id).order_by(model.id).limit(200)
+            if not render_all:
+                query = query.where(column == None)
+            rows = db.session.execute(query).scalars().all()
+            if not rows:
+                break
+            for row in rows:
+                if model is BlogPost:
+                    values = render_post(row.body)
+                else:
+                    values = {"text_html": render_comment(row.text)}
+                if all(getattr(row, name) == value for name, value in values.items()):
+                    continue
+                if model is BlogPost:
+                    # Rendering again isn't an edit, so updated_at (Last-Modified and the ETags)
+                    # stays where it was instead of onupdate moving it
+                    values["updated_at"] = BlogPost.updated_at
+                db.session.execute(db.update(model).where(model.id == row.id).values(**values))
+                count += 1
+            db.session.commit()
+            last_id = rows[-1].id
+        print(f"Rendered {count} {model.__tablename__}")
+    page_cache.clear()
+
+
 @app.route("/new_newsletter_email", methods=['GET', "POST"])
+@admin_only
 def new_newsletter_email():
     form = forms.NewsletterEmail()
     if form.validate_on_submit():
-        result = db.session.execute(db.select(User).where(User.interests != None)).scalars()
-        result_list = result.fetchall()
-        emails = [email.email for email in result_list]
-        subject = form.subject.data
-        body = form.body.data
-        msg = Message(subject, sender=my_email, bcc=emails)
-        msg.body = body
-        mail.send(msg)
-    return render_template('new_newsletter_email.html', form=form)
+        # Batches are queued in the background, the page shows how far the send has got
+        newsletter_sender.create(form.subject.data, form.body.data, my_email)
+        return redirect(url_for('new_newsletter_email'))
+    recent_newsletters = db.session.execute(
+        db.select(Newsletter.id).order_by(Newsletter.id.desc()).limit(5)).scalars().all()
+    return render_template('new_newsletter_email.html', form=form, recent_newsletters=recent_newsletters)
+
+
+@app.route("/password_hashing_stats")
+@admin_only
+def password_hashing_stats():
+    # How many hashes are waiting, use it to size PASSWORD_HASH_WORKERS and PASSWORD_HASH_MAX_PENDING
+    return jsonify(password_hasher.stats())
+
 
+@app.route("/newsletter_progress/<int:newsletter_id>")
 @admin_only
+def newsletter_progress(newsletter_id):
+    return jsonify(newsletter_sender.progress(newsletter_id, Outgoing_Email))
+
 @app.route("/become_blog_writer/<id>")
+@admin_only
 def become_blog_writer(id):
     user = db.session.execute(db.select(User).where(User.id == id)).scalar()
     user.permission_status = "Blog-Writer"
     db.session.commit()
+    user_cache.invalidate(id)
+    page_cache.invalidate(f"user:{user.id}")
     return redirect(url_for('edit_user_permissions'))
 
-@admin_only
 @app.route("/become_community_member/<id>")
+@admin_only
 def become_community_member(id):
     user = db.session.execute(db.select(User).where(User.id == id)).scalar()
     user.permission_status = "Community_Member"
     db.session.commit()
+    user_cache.invalidate(id)
+    page_cache.invalidate(f"user:{user.id}")
     return redirect(url_for('edit_user_permissions'))
 
-@admin_only
 @app.route("/delete_user/<id>")
+@admin_only
 def delete_user(id):
-    user = db.session.execute(db.select(User).where(User.id == id)).scalar()
-    db.session.delete(user)
-    db.session.commit()
+    purger.delete("user", [int(id)])
     return redirect(url_for('edit_user_permissions'))
 
 @app.route('/newsletter_management', methods=['GET', "POST"])
 def newsletter_management():
     form = forms.Signup_for_Newletter()
     if form.validate_on_submit():
-        user = current_user
+        user = db.session.get(User, current_user.id)
         user.interests = form.interest.data
         user.approx_location = form.approx_location.data
         user.receive_additional_information = form.other_info
         db.session.commit()
-        msg = Message('Welcome to my Newsletter!', sender=my_email, recipients=[current_user.email])
+        msg = Email('Welcome to my Newsletter!', sender=my_email, recipients=[current_user.email])
         msg.body = "Thank you for signing up for my newletter. I greatly appreciate it! I hope you enjoy learning more about my website and getting more information from me too. You should be recieving another email soon that will give you your first update. Thanks! Enjoy!"
-        mail.send(msg)
+        mail_queue.enqueue(msg)
         return redirect(url_for('get_all_posts'))
     return render_template('newsletter_management.html', form=form)
 
 
+def create_app():
+    # What gunicorn serves ("main:create_app()" in the Procfile). The routes are registered on
+    # the module's app while main is imported, so this returns that app, after compiling every
+    # template (or loading it from the bytecode cache). With preload_app gunicorn calls it in the
+    # master process, so the workers share the compiled templates instead of each compiling its
+    # own.
+    for name in app.jinja_env.list_templates(extensions=["html"]):
+        app.jinja_env.get_template(name)
+    return app
+
+
 if __name__ == "__main__":
+    # Deployments run "db upgrade" on release (see the Procfile), a local run does it here
+    with app.app_context():
+        migrations.upgrade()
     app.run(debug=True, port=5002)
\ No newline at end of file
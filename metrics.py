@@ -0,0 +1,205 @@
+import hmac
+import threading
+import time
+from urllib.parse import urlparse
+from flask import abort, g, has_request_context, request
+from flask_login import current_user
+from sqlalchemy import event
+
+# Request instrumentation: how long each route takes, how many SQL queries it runs and how long
+# they take, and how long the outbound HTTP (news/weather APIs) and SMTP calls take. Shown at
+# /metrics in the Prometheus text format. Every process keeps its own numbers, so with several
+# gunicorn workers each scrape only sees the worker that answered it.
+#
+# With SLOW_REQUEST_SECONDS or SLOW_REQUEST_QUERIES set, requests past either limit are logged
+# with every SQL statement they ran, which makes N+1 query loops easy to spot.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 250)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels_text(labels):
+    if not labels:
+        return ""
+    escaped = (f'{name}="{_escape(value)}"' for name, value in labels)
+    return "{" + ",".join(escaped) + "}"
+
+
+class Histogram:
+    def __init__(self, name, help_text, label_names, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._values = {}
+
+    def observe(self, value, *label_values):
+        series = self._values.get(label_values)
+        if series is None:
+            series = self._values.setdefault(label_values, {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0})
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                series["buckets"][index] += 1
+        series["sum"] += value
+        series["count"] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for label_values, series in sorted(self._values.items()):
+            labels = list(zip(self.label_names, label_values))
+            for bound, count in zip(self.buckets, series["buckets"]):
+                lines.append(f"{self.name}_bucket{_labels_text(labels + [('le', bound)])} {count}")
+            lines.append(f"{self.name}_bucket{_labels_text(labels + [('le', '+Inf')])} {series['count']}")
+            lines.append(f"{self.name}_sum{_labels_text(labels)} {series['sum']}")
+            lines.append(f"{self.name}_count{_labels_text(labels)} {series['count']}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help_text, label_names):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._values = {}
+
+    def inc(self, *label_values, amount=1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for label_values, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_labels_text(list(zip(self.label_names, label_values)))} {value}")
+        return lines
+
+
+class Metrics:
+    def __init__(self, app=None, db=None):
+        self._lock = threading.Lock()
+        self._gauges = []
+        self.request_duration = Histogram(
+            "http_request_duration_seconds", "Time spent handling each request.",
+            ("endpoint", "method", "status"), LATENCY_BUCKETS)
+        self.request_queries = Histogram(
+            "http_request_db_queries", "SQL queries run by each request.",
+            ("endpoint",), QUERY_COUNT_BUCKETS)
+        self.request_query_duration = Histogram(
+            "http_request_db_query_duration_seconds", "Total time each request spent waiting on SQL queries.",
+            ("endpoint",), LATENCY_BUCKETS)
+        self.background_queries = Counter(
+            "background_db_queries_total", "SQL queries run outside of a request (mail queue, jobs).", ())
+        self.external_duration = Histogram(
+            "external_request_duration_seconds", "Time spent on outbound HTTP requests.",
+            ("service", "status"), LATENCY_BUCKETS)
+        self.smtp_duration = Histogram(
+            "smtp_send_duration_seconds", "Time spent sending each queued email.",
+            ("result",), LATENCY_BUCKETS)
+        self.rate_limit_decisions = Counter(
+            "rate_limit_decisions_total", "Requests checked against a rate limit.", ("limit", "result"))
+        self.slow_requests = Counter(
+            "slow_requests_total", "Requests over SLOW_REQUEST_SECONDS or SLOW_REQUEST_QUERIES.", ("endpoint",))
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db):
+        self.app = app
+        # Off unless set
+        app.config.setdefault('SLOW_REQUEST_SECONDS', None)
+        app.config.setdefault('SLOW_REQUEST_QUERIES', None)
+        # Lets a Prometheus server scrape /metrics with "Authorization: Bearer <token>"
+        app.config.setdefault('METRICS_TOKEN', None)
+        app.extensions['metrics'] = self
+
+        def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+            connection.info.setdefault("query_started", []).append(time.perf_counter())
+
+        def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+            elapsed = time.perf_counter() - connection.info["query_started"].pop()
+            if has_request_context() and "metrics_queries" in g:
+                g.metrics_queries.append((statement, elapsed))
+            else:
+                with self._lock:
+                    self.background_queries.inc()
+
+        # The primary and the read replica, if there is one
+        with app.app_context():
+            for engine in db.engines.values():
+                event.listen(engine, "before_cursor_execute", before_cursor_execute)
+                event.listen(engine, "after_cursor_execute", after_cursor_execute)
+
+        @app.before_request
+        def start_request_timer():
+            g.metrics_started = time.perf_counter()
+            g.metrics_queries = []
+
+        @app.after_request
+        def record_request(response):
+            if "metrics_started" not in g:
+                return response
+            elapsed = time.perf_counter() - g.metrics_started
+            endpoint = request.endpoint or "unknown"
+            queries = g.metrics_queries
+            query_time = sum(seconds for _, seconds in queries)
+            with self._lock:
+                self.request_duration.observe(elapsed, endpoint, request.method, response.status_code)
+                self.request_queries.observe(len(queries), endpoint)
+                self.request_query_duration.observe(query_time, endpoint)
+            self._log_if_slow(endpoint, elapsed, queries, query_time)
+            return response
+
+        @app.route("/metrics")
+        def metrics():
+            self._check_access()
+            return "\n".join(self.render()) + "\n", 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+    def _check_access(self):
+        token = self.app.config['METRICS_TOKEN']
+        if token and hmac.compare_digest(request.headers.get("Authorization", "").encode(), f"Bearer {token}".encode()):
+            return
+        if current_user.is_authenticated and current_user.id == 1:
+            return
+        abort(403)
+
+    def _log_if_slow(self, endpoint, elapsed, queries, query_time):
+        slow_seconds = self.app.config['SLOW_REQUEST_SECONDS']
+        slow_queries = self.app.config['SLOW_REQUEST_QUERIES']
+        if not ((slow_seconds is not None and elapsed >= slow_seconds) or
+                (slow_queries is not None and len(queries) >= slow_queries)):
+            return
+        with self._lock:
+            self.slow_requests.inc(endpoint)
+        statements = "\n".join(f"  {seconds * 1000:.1f}ms {' '.join(statement.split())[:300]}" for statement, seconds in queries)
+        self.app.logger.warning("Slow request %s %s (%s): %.3fs, %d queries taking %.3fs\n%s",
+                                request.method, request.full_path, endpoint, elapsed, len(queries), query_time, statements)
+
+    def requests_hook(self, response, *args, **kwargs):
+        # Response hook for requests.Session, records every outbound HTTP call
+        with self._lock:
+            self.external_duration.observe(response.elapsed.total_seconds(), urlparse(response.url).hostname,
+                                           response.status_code)
+
+    def observe_smtp(self, seconds, ok):
+        with self._lock:
+            self.smtp_duration.observe(seconds, "sent" if ok else "failed")
+
+    def observe_rate_limit(self, name, allowed):
+        with self._lock:
+            self.rate_limit_decisions.inc(name, "allowed" if allowed else "limited")
+
+    def gauge(self, name, help_text, function):
+        # A value worked out when /metrics is read, e.g. how many password hashes are waiting
+        self._gauges.append((name, help_text, function))
+
+    def render(self):
+        with self._lock:
+            lines = []
+            for metric in (self.request_duration, self.request_queries, self.request_query_duration,
+                           self.background_queries, self.external_duration, self.smtp_duration,
+                           self.rate_limit_decisions, self.slow_requests):
+                lines.extend(metric.render())
+        for name, help_text, function in self._gauges:
+            lines.extend([f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {function()}"])
+        return lines
@@ -0,0 +1,287 @@
+from datetime import datetime
+import click
+from sqlalchemy import MetaData, Table, inspect, text
+from sqlalchemy.schema import CreateTable
+from avatars import avatar_hash
+
+# Versioned schema changes for databases that already exist. db.create_all() only makes
+# missing tables, it never changes a table that is already there, so every change to an
+# existing table (new column, new index) gets a revision here.
+#
+#   flask --app main db upgrade    make missing tables, then apply every revision that hasn't run yet
+#   flask --app main db current    show the revision the database is at
+#   flask --app main db history    list all revisions
+#
+# Revisions run in order, each in its own transaction, and are written so running one on a
+# database that already has the change (for example one made by create_all) does nothing.
+
+REVISIONS = []
+
+
+def revision(revision_id, description):
+    def decorator(function):
+        REVISIONS.append((revision_id, description, function))
+        return function
+    return decorator
+
+
+def _columns(connection, table):
+    return [column['name'] for column in inspect(connection).get_columns(table)]
+
+
+def _rebuild_sqlite_table(connection, table, on_delete):
+    # SQLite can't change a foreign key or a NOT NULL, so the table is made again with them
+    # changed, the rows copied over, the old table dropped and the new one renamed, and then
+    # the indexes made again (https://www.sqlite.org/lang_altertable.html#otheralter)
+    metadata = MetaData()
+    old = Table(table, metadata, autoload_with=connection)
+    new = old.to_metadata(metadata, name=f"{table}_rebuild")
+    for constraint in new.foreign_key_constraints:
+        column = constraint.column_keys[0]
+        if len(constraint.column_keys) == 1 and column in on_delete:
+            constraint.ondelete = on_delete[column]
+            if on_delete[column] == "SET NULL":
+                new.c[column].nullable = True
+    indexes = connection.execute(text(
+        "SELECT sql FROM sqlite_master WHERE type = 'index' AND tbl_name = :table AND sql IS NOT NULL"),
+        {"table": table}).scalars().all()
+    columns = ", ".join(f'"{column.name}"' for column in old.columns)
+    connection.execute(CreateTable(new))
+    connection.execute(text(f'INSERT INTO "{new.name}" ({columns}) SELECT {columns} FROM "{table}"'))
+    connection.execute(text(f'DROP TABLE "{table}"'))
+    connection.execute(text(f'ALTER TABLE "{new.name}" RENAME TO "{table}"'))
+    for index in indexes:
+        connection.execute(text(index))
+
+
+def _set_on_delete(connection, table, on_delete):
+    # on_delete is {column: "CASCADE" or "SET NULL"}, SET NULL columns also become nullable
+    foreign_keys = {tuple(key['constrained_columns']): key for key in inspect(connection).get_foreign_keys(table)}
+    changes = {column: action for column, action in on_delete.items()
+               if (foreign_keys[(column,)].get('options') or {}).get('ondelete', '').upper() != action}
+    if not changes:
+        return
+    if connection.dialect.name == 'sqlite':
+        _rebuild_sqlite_table(connection, table, changes)
+        return
+    for column, action in changes.items():
+        key = foreign_keys[(column,)]
+        connection.execute(text(f'ALTER TABLE {table} DROP CONSTRAINT "{key["name"]}"'))
+        connection.execute(text(
+            f'ALTER TABLE {table} ADD CONSTRAINT "{key["name"]}" FOREIGN KEY ({column}) '
+            f'REFERENCES {key["referred_table"]} ({key["referred_columns"][0]}) ON DELETE {action}'))
+        if action == "SET NULL":
+            connection.execute(text(f"ALTER TABLE {table} ALTER COLUMN {column} DROP NOT NULL"))
+
+
+@revision("0001", "Add blog_posts.comment_count")
+def add_comment_count(connection):
+    if 'comment_count' in _columns(connection, 'blog_posts'):
+        return
+    connection.execute(text("ALTER TABLE blog_posts ADD COLUMN comment_count INTEGER NOT NULL DEFAULT 0"))
+    connection.execute(text(
+        "UPDATE blog_posts SET comment_count = "
+        "(SELECT COUNT(*) FROM comments WHERE comments.post_id = blog_posts.id)"))
+
+
+@revision("0002", "Index the columns the login, reset password, comment and newsletter queries filter on")
+def add_lookup_indexes(connection):
+    # confirm_reset looks users up by their reset token
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_users_reset_password_token ON users (reset_password_token)"))
+    # reset_pass looks up the reset bookkeeping by email
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_reset_password_email ON reset_password (email)"))
+    # Loading the comments of a post, and the posts/comments of a user
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_comments_post_id ON comments (post_id)"))
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_comments_author_id ON comments (author_id)"))
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_blog_posts_author_id ON blog_posts (author_id)"))
+
+
+@revision("0003", "Partial index of newsletter subscribers")
+def add_newsletter_subscriber_index(connection):
+    # Only users who signed up for the newsletter (interests filled in) are in this index, and it
+    # includes their email, so the newsletter queries never touch the rest of the users table
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_users_newsletter_subscribers ON users (id, email) "
+        "WHERE interests IS NOT NULL"))
+
+
+@revision("0004", "Link queued emails to the newsletter they belong to")
+def add_outgoing_email_newsletter_id(connection):
+    if 'outgoing_emails' not in inspect(connection).get_table_names():
+        # Made by create_all with the column already in it
+        return
+    if 'newsletter_id' not in _columns(connection, 'outgoing_emails'):
+        connection.execute(text("ALTER TABLE outgoing_emails ADD COLUMN newsletter_id INTEGER REFERENCES newsletters (id)"))
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_outgoing_emails_newsletter_id ON outgoing_emails (newsletter_id)"))
+
+
+@revision("0005", "Make users.password long enough for hashes with longer salts or scrypt")
+def widen_user_password(connection):
+    # SQLite doesn't enforce VARCHAR lengths, so only Postgres needs the change
+    if connection.dialect.name == "postgresql":
+        connection.execute(text("ALTER TABLE users ALTER COLUMN password TYPE VARCHAR(255)"))
+
+
+@revision("0006", "Add blog_posts.created_at and updated_at")
+def add_post_timestamps(connection):
+    columns = _columns(connection, 'blog_posts')
+    for column in ('created_at', 'updated_at'):
+        if column not in columns:
+            connection.execute(text(f"ALTER TABLE blog_posts ADD COLUMN {column} TIMESTAMP"))
+    # Best guess for existing posts: the day in the date they show
+    posts = connection.execute(text("SELECT id, date FROM blog_posts WHERE created_at IS NULL")).all()
+    for post_id, shown_date in posts:
+        try:
+            created_at = datetime.strptime(shown_date, "%B %d, %Y")
+        except (TypeError, ValueError):
+            created_at = datetime.utcnow()
+        connection.execute(text("UPDATE blog_posts SET created_at = :created_at, "
+                                "updated_at = COALESCE(updated_at, :created_at) WHERE id = :id"),
+                           {"created_at": created_at, "id": post_id})
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_blog_posts_updated_at ON blog_posts (updated_at)"))
+
+
+@revision("0007", "Add the sanitized renditions of posts and comments")
+def add_renditions(connection):
+    # Filled in by "flask --app main render-posts"
+    post_columns = _columns(connection, 'blog_posts')
+    for column, column_type in (("body_html", "TEXT"), ("excerpt", "TEXT"), ("word_count", "INTEGER"),
+                                ("reading_minutes", "INTEGER"), ("toc", "JSON")):
+        if column not in post_columns:
+            connection.execute(text(f"ALTER TABLE blog_posts ADD COLUMN {column} {column_type}"))
+    if 'text_html' not in _columns(connection, 'comments'):
+        connection.execute(text("ALTER TABLE comments ADD COLUMN text_html TEXT"))
+
+
+@revision("0008", "Move the home page quotes into the quotes table")
+def seed_quotes(connection):
+    # The quotes that used to be hardcoded in main.py, unless some were already added
+    if connection.execute(text("SELECT COUNT(*) FROM quotes")).scalar():
+        return
+    for quote, author in (("You miss 100% of the shots you don't take", "Wayne Gretzky"),
+                          ("I can is 100 times more important than I.Q", "Albert Einstein"),
+                          ("A winner is a dreamer who never gives up.", "Nelson Mandela"),
+                          ("Don't cry because it'a over, smile because it happened", None)):
+        connection.execute(text("INSERT INTO quotes (text, author, weight, created_at) "
+                                "VALUES (:text, :author, 1, :created_at)"),
+                           {"text": quote, "author": author, "created_at": datetime.utcnow()})
+
+
+@revision("0009", "Index users by role for the admin user list")
+def add_user_role_index(connection):
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_users_permission_status_id ON users (permission_status, id)"))
+
+
+@revision("0010", "Let the database delete comments with their post and unlink posts and comments from deleted users")
+def add_on_delete_actions(connection):
+    if connection.dialect.name == 'sqlite':
+        # Has to come before anything else in the transaction to work. Dropping the old tables
+        # would otherwise hit the other tables' foreign keys.
+        connection.execute(text("PRAGMA foreign_keys=OFF"))
+    _set_on_delete(connection, 'blog_posts', {'author_id': "SET NULL"})
+    _set_on_delete(connection, 'comments', {'author_id': "SET NULL", 'post_id': "CASCADE"})
+    if connection.dialect.name == 'sqlite':
+        # SQLite didn't check the foreign keys before, rows left pointing at deleted users or
+        # posts are fixed the way the new foreign keys would have
+        connection.execute(text("UPDATE blog_posts SET author_id = NULL WHERE author_id NOT IN (SELECT id FROM users)"))
+        connection.execute(text("UPDATE comments SET author_id = NULL WHERE author_id NOT IN (SELECT id FROM users)"))
+        connection.execute(text("DELETE FROM comments WHERE post_id NOT IN (SELECT id FROM blog_posts)"))
+
+
+@revision("0011", "Add users.avatar_hash")
+def add_avatar_hash(connection):
+    if 'avatar_hash' not in _columns(connection, 'users'):
+        connection.execute(text("ALTER TABLE users ADD COLUMN avatar_hash VARCHAR(32)"))
+    # Gravatar's hash of every email, a batch of users at a time
+    last_id = 0
+    while True:
+        rows = connection.execute(text(
+            "SELECT id, email FROM users WHERE id > :last_id AND avatar_hash IS NULL ORDER BY id LIMIT 1000"),
+            {"last_id": last_id}).all()
+        if not rows:
+            break
+        connection.execute(text("UPDATE users SET avatar_hash = :hash WHERE id = :id"),
+                           [{"hash": avatar_hash(row.email), "id": row.id} for row in rows])
+        last_id = rows[-1].id
+
+
+@revision("0012", "Add quotes.updated_at")
+def add_quote_updated_at(connection):
+    if 'updated_at' not in _columns(connection, 'quotes'):
+        connection.execute(text("ALTER TABLE quotes ADD COLUMN updated_at TIMESTAMP"))
+    connection.execute(text("UPDATE quotes SET updated_at = created_at WHERE updated_at IS NULL"))
+
+
+class Migrations:
+    def __init__(self, app=None, db=None):
+        # Called with no arguments at the end of every upgrade, for schema that isn't in the models
+        # (e.g. the search index table)
+        self.after_upgrade = []
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db):
+        self.db = db
+
+        @app.cli.group("db")
+        def db_group():
+            """Database schema migrations."""
+
+        @db_group.command("upgrade")
+        def upgrade_command():
+            """Apply every migration that hasn't run yet."""
+            applied = self.upgrade()
+            for revision_id, description in applied:
+                click.echo(f"Applied {revision_id}: {description}")
+            click.echo(f"Database is at revision {self.current() or 'none'}")
+
+        @db_group.command("current")
+        def current_command():
+            """Show the revision the database is at."""
+            click.echo(self.current() or "none")
+
+        @db_group.command("history")
+        def history_command():
+            """List every migration."""
+            applied = self.applied()
+            for revision_id, description, _ in REVISIONS:
+                click.echo(f"{revision_id} {'applied' if revision_id in applied else 'pending'}  {description}")
+
+    def _ensure_version_table(self, connection):
+        connection.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations "
+            "(version VARCHAR(32) PRIMARY KEY, applied_at TIMESTAMP NOT NULL)"))
+
+    def applied(self):
+        with self.db.engine.begin() as connection:
+            self._ensure_version_table(connection)
+            return {row.version for row in connection.execute(text("SELECT version FROM schema_migrations"))}
+
+    def current(self):
+        applied = self.applied()
+        done = [revision_id for revision_id, _, _ in REVISIONS if revision_id in applied]
+        return done[-1] if done else None
+
+    def upgrade(self):
+        # Makes any tables that don't exist yet, then runs the pending revisions in order
+        self.db.create_all()
+        applied = self.applied()
+        newly_applied = []
+        for revision_id, description, function in REVISIONS:
+            if revision_id in applied:
+                continue
+            with self.db.engine.begin() as connection:
+                function(connection)
+                connection.execute(text("INSERT INTO schema_migrations (version, applied_at) VALUES (:version, :applied_at)"),
+                                   {"version": revision_id, "applied_at": datetime.utcnow()})
+            newly_applied.append((revision_id, description))
+        if newly_applied:
+            # Revisions can change settings of the connection they ran on (SQLite's foreign_keys),
+            # don't hand it out again
+            self.db.engine.dispose()
+        for callback in self.after_upgrade:
+            callback()
+        return newly_applied
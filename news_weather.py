@@ -0,0 +1,231 @@
+import html
+import os
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from mail_queue import Email
+from lookup_cache import CachedNewsWeatherClient
+
+# Personalized newsletter: news for each user's interests and the weather near them.
+# Many users share an interest or a location, so every distinct interest/location is only
+# fetched once, the fetches run in a small thread pool sharing one requests.Session, and the
+# finished emails are handed to the mail queue.
+
+NEWS_API_URL = 'https://newsapi.org/v2/everything'
+GEOCODING_API_URL = 'http://api.openweathermap.org/geo/1.0/direct'
+FORECAST_API_URL = 'https://api.openweathermap.org/data/2.5/forecast'
+
+
+class NewsWeatherClient:
+    def __init__(self, news_api_key=None, app_id=None, max_workers=8, timeout=10,
+                 news_url=NEWS_API_URL, geocoding_url=GEOCODING_API_URL, forecast_url=FORECAST_API_URL,
+                 response_hook=None):
+        self.news_api_key = news_api_key
+        self.app_id = app_id
+        self.timeout = timeout
+        self.news_url = news_url
+        self.geocoding_url = geocoding_url
+        self.forecast_url = forecast_url
+        self.session = requests.Session()
+        # Keep one connection per thread open to each API host
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if response_hook is not None:
+            # Lets the app time every call (see metrics.py)
+            self.session.hooks['response'].append(response_hook)
+
+    def news(self, interest):
+        response = self.session.get(self.news_url, timeout=self.timeout, params={
+            'qInTitle': interest,
+            'sortBy': 'popularity',
+            'apiKey': self.news_api_key
+        })
+        response.raise_for_status()
+        first_three = response.json()["articles"][:3]
+        return [html.unescape(f"{article['title']} Description: {article['description']}").encode('ascii', 'ignore').decode()
+                for article in first_three]
+
+    def geocode(self, location):
+        # Returns (lat, lon), or None when OpenWeather doesn't know the location
+        response = self.session.get(self.geocoding_url, timeout=self.timeout, params={
+            'q': location,
+            'limit': 2,
+            'appid': self.app_id
+        })
+        response.raise_for_status()
+        data = response.json()
+        if not data:
+            return None
+        return data[0]["lat"], data[0]["lon"]
+
+    def forecast(self, lat, lon):
+        response = self.session.get(self.forecast_url, timeout=self.timeout, params={
+            'lat': lat,
+            'lon': lon,
+            'appid': self.app_id,
+            'cnt': 8
+        })
+        response.raise_for_status()
+        return response.json()
+
+    def close(self):
+        self.session.close()
+
+
+def weather_summary(data):
+    # Turns a forecast response into the (subject, text) used in the email
+    will_rain = False
+    is_sunny = False
+    temperatures = []
+    temp_feels = []
+    for hour_data in data["list"]:
+        current_type = hour_data["weather"][0]["main"]
+        wind_speed = hour_data["wind"]["speed"]
+        current_id = hour_data["weather"][0]["id"]
+        temperature_as_fahrenheit_min = round((((hour_data["main"]["temp_min"]) - 273.15) * 9 / 5) + 32)
+        temperatures.append(temperature_as_fahrenheit_min)
+        temperature_as_fahrenheit_max = round((((hour_data["main"]["temp_max"]) - 273.15) * 9 / 5) + 32)
+        temperatures.append(temperature_as_fahrenheit_max)
+        temperature_feel = round((((hour_data["main"]["feels_like"]) - 273.15) * 9 / 5) + 32)
+        temp_feels.append(temperature_feel)
+        if int(current_id) < 700:
+            will_rain = True
+        if int(current_id) >= 800:
+            is_sunny = True
+    low = min(temperatures)
+    high = max(temperatures)
+    average_feel = round(statistics.mean(temp_feels), 2)
+    if will_rain and is_sunny:
+        subject = "Mixed weather Today"
+        msgs = f'The weather will be somewhat rainy but also sunny at the same time today. You might want to bring an umbrella with you! The low will be {low} degrees with the high being {high}. It will feel on average {average_feel} degrees. It will be {current_type}y and {wind_speed} MPH wind.'
+    elif will_rain:
+        subject = "Rain Today!"
+        msgs = f"It will likely rain today! Bring an umbrella to work or school. It will be a low of {low} degrees with a high of {high} degrees. The temperature feels like {average_feel}. It will be {current_type}y and {wind_speed} mph wind."
+    elif is_sunny:
+        subject = "Sunny Weather Today!"
+        msgs = f"It is pretty sunny weather for the next 24 hours! There will be a low of {low} degrees and a high of {high} degrees. The temperature feels like {average_feel}. It will be {current_type}y and {wind_speed} MPH wind."
+    else:
+        subject = "Today's Weather"
+        msgs = f"There will be a low of {low} degrees and a high of {high} degrees. The temperature feels like {average_feel}. It will be {current_type} and {wind_speed} MPH wind."
+    return subject, msgs
+
+
+def email_body(articles, subject, msgs):
+    numbered = " \n ".join(f"{number}{article}" for number, article in enumerate(articles, start=1))
+    return f"Here are some articles that you might like! {numbered}. I hope you enjoy! \n Here is the weather near you: {subject}: {msgs}"
+
+
+class PersonalizedEmailJob:
+    # Runs the personalized newsletter in a background thread and keeps track of its progress
+    def __init__(self, response_hook=None):
+        self.response_hook = response_hook
+        self._lock = threading.Lock()
+        self._thread = None
+        self.progress = {"state": "idle"}
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, app, *args, **kwargs):
+        with self._lock:
+            if self.is_running():
+                return False
+            self.progress = {"state": "starting"}
+
+            def run():
+                with app.app_context():
+                    try:
+                        self.run(app, *args, **kwargs)
+                    except Exception as error:
+                        app.logger.exception("Personalized emails failed")
+                        self._update(state="failed", error=str(error))
+
+            self._thread = threading.Thread(target=run, name="personalized-emails", daemon=True)
+            self._thread.start()
+            return True
+
+    def _update(self, report=None, **changes):
+        with self._lock:
+            self.progress.update(changes)
+            progress = dict(self.progress)
+        if report is not None:
+            report(progress)
+
+    def _count(self, key, report=None):
+        with self._lock:
+            self.progress[key] += 1
+            progress = dict(self.progress)
+        if report is not None:
+            report(progress)
+
+    def run(self, app, db, user_model, mail_queue, sender, client=None, cache=None, report=None):
+        config = app.config
+        max_workers = config.get('PERSONALIZED_EMAIL_FETCH_WORKERS', 8)
+        own_client = client is None
+        if own_client:
+            client = NewsWeatherClient(news_api_key=os.environ.get('news_api_key'),
+                                       app_id=os.environ.get('app_id'),
+                                       max_workers=max_workers,
+                                       response_hook=self.response_hook)
+        if cache is not None:
+            client = CachedNewsWeatherClient(client, cache)
+        started = time.time()
+        users = db.session.execute(
+            db.select(user_model.email, user_model.interests, user_model.approx_location)
+            .where(user_model.interests != None)
+        ).all()
+        interests = {user.interests for user in users}
+        locations = {user.approx_location for user in users if user.approx_location}
+        self._update(report, state="fetching", total_users=len(users), distinct_interests=len(interests),
+                     distinct_locations=len(locations), fetched=0, enqueued=0, skipped=0, errors=[],
+                     started_at=started)
+
+        def fetch(function, key):
+            try:
+                return function(key)
+            except Exception as error:
+                with self._lock:
+                    self.progress["errors"].append(f"{function.__name__} {key!r}: {error}")
+                return None
+            finally:
+                self._count("fetched", report)
+
+        def weather_for(point):
+            return weather_summary(client.forecast(*point))
+
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                news_futures = {interest: pool.submit(fetch, client.news, interest) for interest in interests}
+                geo_futures = {location: pool.submit(fetch, client.geocode, location) for location in locations}
+                coordinates = {location: future.result() for location, future in geo_futures.items()}
+                forecast_futures = {point: pool.submit(fetch, weather_for, point)
+                                    for point in set(coordinates.values()) if point is not None}
+                news = {interest: future.result() for interest, future in news_futures.items()}
+                weather = {point: future.result() for point, future in forecast_futures.items()}
+        finally:
+            if own_client:
+                client.close()
+
+        self._update(report, state="enqueueing")
+        for number, user in enumerate(users, start=1):
+            articles = news.get(user.interests)
+            point = coordinates.get(user.approx_location)
+            summary = weather.get(point) if point is not None else None
+            if not articles or summary is None:
+                self._count("skipped", report)
+                continue
+            msg = Email("Your news and Local weather", sender=sender, recipients=[user.email])
+            msg.body = email_body(articles, *summary)
+            mail_queue.enqueue(msg, commit=False)
+            self._count("enqueued", report)
+            if number % 500 == 0:
+                db.session.commit()
+        db.session.commit()
+        mail_queue.notify()
+        self._update(report, state="finished", finished_at=time.time(), seconds=round(time.time() - started, 2),
+                     cache=cache.stats() if cache is not None else None)
+        return self.progress
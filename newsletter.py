@@ -0,0 +1,141 @@
+import os
+import threading
+from datetime import datetime, timedelta
+from mail_queue import Email
+
+# Sends a newsletter to every subscriber in batches. Subscriber emails are read a batch at a
+# time in id order (a keyset scan of the newsletter subscriber index), and every batch becomes
+# one job in the mail queue, so sending, retries and rate limiting are handled there. The id
+# of the last subscriber queued is saved with each batch, in the same transaction, so a send
+# that gets interrupted carries on from where it stopped without emailing anyone twice.
+
+QUEUEING = "queueing"
+QUEUED = "queued"
+
+
+class NewsletterSender:
+    def __init__(self, app=None, db=None, user_model=None, newsletter_model=None, mail_queue=None):
+        self._pid = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app, db, user_model, newsletter_model, mail_queue)
+
+    def init_app(self, app, db, user_model, newsletter_model, mail_queue):
+        self.app = app
+        self.db = db
+        self.user_model = user_model
+        self.newsletter_model = newsletter_model
+        self.mail_queue = mail_queue
+        app.config.setdefault('NEWSLETTER_BATCH_SIZE', 50)
+        # A newsletter whose queueing thread hasn't saved a batch for this long is taken over
+        app.config.setdefault('NEWSLETTER_STALE_AFTER', 300)
+
+        @app.before_request
+        def resume_newsletters():
+            # Once per worker process, pick up newsletters a previous process didn't finish
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self.resume()
+
+        @app.cli.command("resume-newsletters")
+        def resume_newsletters_command():
+            """Finish queueing newsletters that were interrupted."""
+            for newsletter_id in self._stale_newsletters():
+                self.queue_batches(newsletter_id)
+                print(f"Queued newsletter {newsletter_id}")
+
+    def create(self, subject, body, sender):
+        newsletter = self.newsletter_model(subject=subject, body=body, sender=sender, status=QUEUEING,
+                                           total_recipients=0, batch_count=0, last_user_id=0,
+                                           locked_at=datetime.utcnow(), created_at=datetime.utcnow())
+        self.db.session.add(newsletter)
+        self.db.session.commit()
+        self.start(newsletter.id)
+        return newsletter
+
+    def start(self, newsletter_id):
+        def run():
+            with self.app.app_context():
+                try:
+                    self.queue_batches(newsletter_id)
+                except Exception:
+                    self.app.logger.exception("Queueing newsletter %s failed", newsletter_id)
+
+        threading.Thread(target=run, name=f"newsletter-{newsletter_id}", daemon=True).start()
+
+    def _stale_newsletters(self):
+        newsletter = self.newsletter_model
+        stale = datetime.utcnow() - timedelta(seconds=self.app.config['NEWSLETTER_STALE_AFTER'])
+        return self.db.session.execute(
+            self.db.select(newsletter.id)
+            .where(newsletter.status == QUEUEING, newsletter.locked_at < stale)
+        ).scalars().all()
+
+    def resume(self):
+        for newsletter_id in self._stale_newsletters():
+            self.start(newsletter_id)
+
+    def _claim(self, newsletter_id, locked_at):
+        # Only one thread (in any process) gets to queue a newsletter. Every batch moves
+        # locked_at forward, so a thread that finds it changed knows someone else took over.
+        newsletter = self.newsletter_model
+        now = datetime.utcnow()
+        result = self.db.session.execute(
+            self.db.update(newsletter)
+            .where(newsletter.id == newsletter_id, newsletter.status == QUEUEING, newsletter.locked_at == locked_at)
+            .values(locked_at=now)
+        )
+        return now if result.rowcount == 1 else None
+
+    def queue_batches(self, newsletter_id):
+        user = self.user_model
+        batch_size = self.app.config['NEWSLETTER_BATCH_SIZE']
+        newsletter = self.db.session.get(self.newsletter_model, newsletter_id)
+        locked_at = self._claim(newsletter_id, newsletter.locked_at)
+        self.db.session.commit()
+        if locked_at is None:
+            return
+        last_user_id = newsletter.last_user_id
+        while True:
+            emails = self.db.session.execute(
+                self.db.select(user.id, user.email)
+                .where(user.interests != None, user.id > last_user_id)
+                .order_by(user.id)
+                .limit(batch_size)
+            ).all()
+            if not emails:
+                break
+            last_user_id = emails[-1].id
+            msg = Email(newsletter.subject, sender=newsletter.sender, bcc=[row.email for row in emails])
+            msg.body = newsletter.body
+            self.mail_queue.enqueue(msg, commit=False, newsletter_id=newsletter_id)
+            new_locked_at = self._claim(newsletter_id, locked_at)
+            if new_locked_at is None:
+                # Another process took over this newsletter, drop this batch
+                self.db.session.rollback()
+                return
+            locked_at = new_locked_at
+            newsletter.last_user_id = last_user_id
+            newsletter.total_recipients += len(emails)
+            newsletter.batch_count += 1
+            self.db.session.commit()
+            self.mail_queue.notify()
+        newsletter.status = QUEUED
+        self.db.session.commit()
+
+    def progress(self, newsletter_id, email_model):
+        newsletter = self.db.get_or_404(self.newsletter_model, newsletter_id)
+        batches = dict(self.db.session.execute(
+            self.db.select(email_model.status, self.db.func.count(email_model.id))
+            .where(email_model.newsletter_id == newsletter_id)
+            .group_by(email_model.status)
+        ).all())
+        return {
+            "id": newsletter.id,
+            "subject": newsletter.subject,
+            "status": newsletter.status,
+            "total_recipients": newsletter.total_recipients,
+            "batch_count": newsletter.batch_count,
+            "batches": batches,
+            "finished": newsletter.status == QUEUED and batches.get("sent", 0) + batches.get("dead", 0) == newsletter.batch_count
+        }
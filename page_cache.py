@@ -0,0 +1,367 @@
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from functools import wraps
+from flask import current_app, g, has_app_context, make_response, request, session
+from flask_login import current_user
+from flask_wtf.csrf import generate_csrf
+from werkzeug.http import is_resource_modified
+
+# Rendered page cache for the read heavy routes (home page and posts).
+# Every cached page belongs to one or more "groups" (for example "post:5"). Each group has a
+# version token and the token is part of the cache key, so invalidating a group just swaps
+# its token and every page built from the old one stops being used.
+#
+# Views can also pass a validator, a cheap query giving the time the page's content last changed.
+# Responses then carry an ETag (built from the cache key, so it changes with everything the key
+# does) and Last-Modified, and a browser or proxy revalidating a page it already has gets a 304
+# before the page is looked up or rendered.
+#
+# Version tokens are kept in small files under PAGE_CACHE_DIR for both backends, so a write
+# handled by one gunicorn worker stops the pages cached by every other worker on the machine too.
+# (Machines don't share them; run one machine per cache directory, or PAGE_CACHE_TYPE=null.)
+#
+# Pages with a form carry the visitor's CSRF token. It's swapped for a placeholder before a page
+# is saved and the token of whoever gets the page is put back in, so no one is ever sent
+# someone else's token.
+
+CSRF_PLACEHOLDER = b"__page_cache_csrf_token__"
+
+
+def _write_atomic(directory, path, data):
+    # Write to a temp file first so other workers never read half a file
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class FileVersions:
+    # Group version tokens, one file per group, shared by every process using the directory
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, group):
+        return os.path.join(self.directory, "version-" + hashlib.sha1(group.encode()).hexdigest())
+
+    def get(self, group):
+        try:
+            with open(self._path(group), "r") as file:
+                return file.read()
+        except OSError:
+            return "0"
+
+    def bump(self, group):
+        _write_atomic(self.directory, self._path(group), uuid.uuid4().hex.encode())
+
+    def clear(self):
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith("version-"):
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+
+
+class MemoryCache:
+    # In process LRU cache. Each gunicorn worker has its own copy of the entries. With a
+    # version_dir the versions are shared through files, otherwise they're per process too.
+    def __init__(self, max_entries=500, timeout=300, version_dir=None):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._shared_versions = FileVersions(version_dir) if version_dir else None
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.timeout, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._versions.clear()
+        if self._shared_versions is not None:
+            self._shared_versions.clear()
+
+    def get_version(self, group):
+        if self._shared_versions is not None:
+            return self._shared_versions.get(group)
+        return self._versions.get(group, "0")
+
+    def bump_version(self, group):
+        if self._shared_versions is not None:
+            self._shared_versions.bump(group)
+            return
+        with self._lock:
+            self._versions[group] = uuid.uuid4().hex
+
+
+class FileSystemCache:
+    # Cache stored as files in a directory so every gunicorn worker on the machine shares it.
+    def __init__(self, directory, max_entries=2000, timeout=300):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._sets_since_prune = 0
+        self._versions = FileVersions(directory)
+
+    def _path(self, prefix, key):
+        return os.path.join(self.directory, prefix + hashlib.sha1(key.encode()).hexdigest())
+
+    def get(self, key):
+        path = self._path("page-", key)
+        try:
+            with open(path, "rb") as file:
+                expires, value = pickle.load(file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if expires < time.time():
+            self.delete(key)
+            return None
+        try:
+            # Touch the file so pruning removes the least recently used pages first
+            os.utime(path)
+        except OSError:
+            pass
+        return value
+
+    def set(self, key, value):
+        _write_atomic(self.directory, self._path("page-", key), pickle.dumps((time.time() + self.timeout, value)))
+        self._sets_since_prune += 1
+        if self._sets_since_prune >= 50:
+            self._sets_since_prune = 0
+            self.prune()
+
+    def delete(self, key):
+        try:
+            os.remove(self._path("page-", key))
+        except OSError:
+            pass
+
+    def prune(self):
+        pages = []
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith("page-"):
+                try:
+                    pages.append((entry.stat().st_mtime, entry.path))
+                except OSError:
+                    pass
+        if len(pages) <= self.max_entries:
+            return
+        pages.sort()
+        for _, path in pages[:len(pages) - self.max_entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def clear(self):
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith("page-"):
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+        self._versions.clear()
+
+    def get_version(self, group):
+        return self._versions.get(group)
+
+    def bump_version(self, group):
+        self._versions.bump(group)
+
+
+class NullCache:
+    # Used when PAGE_CACHE_TYPE is "null" (turns the cache off, handy while developing)
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+    def get_version(self, group):
+        return "0"
+
+    def bump_version(self, group):
+        pass
+
+
+class PageCache:
+    def __init__(self, app=None):
+        self.backend = NullCache()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('PAGE_CACHE_TYPE', 'memory')
+        app.config.setdefault('PAGE_CACHE_DIR', os.path.join(app.instance_path, 'page_cache'))
+        app.config.setdefault('PAGE_CACHE_MAX_ENTRIES', 500)
+        app.config.setdefault('PAGE_CACHE_TIMEOUT', 300)
+        # Cache-Control of pages for logged out visitors, e.g. "public, max-age=60" lets a CDN or
+        # reverse proxy answer them. Logged in pages are always private.
+        app.config.setdefault('PAGE_CACHE_CONTROL', 'no-cache')
+        # Anything else that changes the HTML between deploys (the static file build sets it)
+        app.config.setdefault('PAGE_CACHE_RELEASE', '')
+        self._template_hash = self._hash_templates(app)
+        cache_type = app.config['PAGE_CACHE_TYPE']
+        if cache_type == 'filesystem':
+            self.backend = FileSystemCache(app.config['PAGE_CACHE_DIR'],
+                                           max_entries=app.config['PAGE_CACHE_MAX_ENTRIES'],
+                                           timeout=app.config['PAGE_CACHE_TIMEOUT'])
+        elif cache_type == 'memory':
+            self.backend = MemoryCache(max_entries=app.config['PAGE_CACHE_MAX_ENTRIES'],
+                                       timeout=app.config['PAGE_CACHE_TIMEOUT'],
+                                       version_dir=app.config['PAGE_CACHE_DIR'])
+        else:
+            self.backend = NullCache()
+
+    def _hash_templates(self, app):
+        # Part of every key, so pages cached or sent to browsers before a deploy that changed a
+        # template aren't used after it
+        digest = hashlib.sha1()
+        template_folder = os.path.join(app.root_path, app.template_folder or "templates")
+        for root, directories, files in sorted(os.walk(template_folder)):
+            directories.sort()
+            for name in sorted(files):
+                with open(os.path.join(root, name), "rb") as file:
+                    digest.update(name.encode() + file.read())
+        return digest.hexdigest()
+
+    def _auth_state(self):
+        if not current_user.is_authenticated:
+            return "anonymous", []
+        return f"user:{current_user.id}", [f"user:{current_user.id}"]
+
+    def _csrf_token(self):
+        # The CSRF token rendered into this request's page, if any (flask_wtf keeps it in g)
+        return g.get(self.app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token'))
+
+    def _page_to_store(self, body, token):
+        # The token becomes the placeholder
+        if token:
+            body = body.replace(token.encode(), CSRF_PLACEHOLDER)
+        return body
+
+    def _page_to_send(self, body):
+        if CSRF_PLACEHOLDER in body:
+            body = body.replace(CSRF_PLACEHOLDER, generate_csrf().encode())
+        return body
+
+    def make_key(self, groups):
+        auth_state, auth_groups = self._auth_state()
+        versions = [f"{group}={self.backend.get_version(group)}" for group in ["all"] + groups + auth_groups]
+        args = sorted(request.args.items(multi=True))
+        release = f"release={self._template_hash}:{self.app.config['PAGE_CACHE_RELEASE']}"
+        return "|".join([request.endpoint, request.path, repr(args), auth_state, release] + versions)
+
+    def _add_http_caching(self, response, etag, last_modified):
+        if etag is not None:
+            response.set_etag(etag)
+        if last_modified is not None:
+            response.last_modified = last_modified
+        if current_user.is_authenticated:
+            response.headers['Cache-Control'] = 'private, no-cache'
+        else:
+            response.headers['Cache-Control'] = self.app.config['PAGE_CACHE_CONTROL']
+        response.vary.add('Cookie')
+        return response
+
+    def cached(self, *groups, validator=None):
+        # groups can use the view's arguments, e.g. @page_cache.cached("post:{post_id}").
+        # validator is called with the view's arguments and returns (last_modified, state), where
+        # state is anything else that changes the page (e.g. the number of posts), or None when
+        # there's nothing to show (the view then runs and gives its own 404).
+        def decorator(function):
+            @wraps(function)
+            def wrapper_function(*args, **kwargs):
+                if request.method not in ("GET", "HEAD") or session.get('_flashes'):
+                    # Flashed messages are shown once, so those pages can't be reused
+                    return function(*args, **kwargs)
+                key = self.make_key([group.format(**kwargs) for group in groups])
+                etag = last_modified = None
+                if validator is not None:
+                    validated = validator(**kwargs)
+                    if validated is not None:
+                        last_modified, state = validated
+                        etag = hashlib.sha1(f"{key}|{last_modified}|{state}".encode()).hexdigest()
+                        if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+                            response = current_app.response_class(status=304)
+                            return self._add_http_caching(response, etag, last_modified)
+                cached_page = self.backend.get(key)
+                if cached_page is not None:
+                    body, status, content_type = cached_page
+                    response = current_app.response_class(self._page_to_send(body), status=status, content_type=content_type)
+                    response.headers['X-Page-Cache'] = 'HIT'
+                    return self._add_http_caching(response, etag, last_modified)
+                response = make_response(function(*args, **kwargs))
+                if response.status_code == 200 and not response.direct_passthrough:
+                    if response.is_streamed:
+                        # Send it as it's made and save it once the last chunk has gone out
+                        response.response = self._store_when_done(key, response.response, response.content_type,
+                                                                  self._csrf_token())
+                    else:
+                        self.backend.set(key, (self._page_to_store(response.get_data(), self._csrf_token()),
+                                               response.status_code, response.content_type))
+                    response.headers['X-Page-Cache'] = 'MISS'
+                    self._add_http_caching(response, etag, last_modified)
+                return response
+            return wrapper_function
+        return decorator
+
+    def _store_when_done(self, key, chunks, content_type, token):
+        # Runs after the view returned. With stream_with_context the request context is there
+        # between chunks (a token made while streaming is picked up), but not once the last chunk
+        # is out, so the token is only looked at while chunks are coming.
+        body = []
+        for chunk in chunks:
+            body.append(chunk.encode() if isinstance(chunk, str) else chunk)
+            if has_app_context():
+                token = self._csrf_token() or token
+            yield chunk
+        self.backend.set(key, (self._page_to_store(b"".join(body), token), 200, content_type))
+
+    def invalidate(self, *groups):
+        for group in groups:
+            self.backend.bump_version(group)
+
+    def clear(self):
+        self.backend.bump_version("all")
+
@@ -0,0 +1,123 @@
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
+
+# Password hashing is slow on purpose, so it runs in a small pool of worker processes instead
+# of on the request thread. Only PASSWORD_HASH_MAX_PENDING hashes can be waiting at once, a
+# burst of logins past that gets a 503 instead of tying up every web worker. That needs threaded
+# web workers (gunicorn.conf.py uses gthread): a sync worker serves one request at a time anyway.
+# Stored hashes made with older settings are rehashed with the current ones when the user
+# logs in (the only time the plain password is available).
+
+
+class HashingBusy(Exception):
+    pass
+
+
+def _normalize_method(method):
+    # Spell out the defaults the same way werkzeug writes them at the start of a hash
+    parts = method.split(":")
+    if parts[0] == "pbkdf2":
+        hash_name = parts[1] if len(parts) > 1 else "sha256"
+        iterations = parts[2] if len(parts) > 2 else DEFAULT_PBKDF2_ITERATIONS
+        return f"pbkdf2:{hash_name}:{iterations}"
+    if parts[0] == "scrypt":
+        n, r, p = (parts[1:] + ["32768", "8", "1"][len(parts) - 1:])[:3]
+        return f"scrypt:{n}:{r}:{p}"
+    return method
+
+
+class PasswordHasher:
+    def __init__(self, app=None):
+        self._pid = None
+        self._pool = None
+        self._slots = None
+        self._lock = threading.Lock()
+        self._stats = {"pending": 0, "completed": 0, "rejected": 0, "seconds": 0.0, "max_seen_pending": 0}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        # Any method werkzeug understands, e.g. "pbkdf2:sha256:600000" or "scrypt:32768:8:1"
+        app.config.setdefault('PASSWORD_HASH_METHOD', 'pbkdf2:sha256')
+        app.config.setdefault('PASSWORD_SALT_LENGTH', 16)
+        # 0 hashes on the request thread (no worker processes)
+        app.config.setdefault('PASSWORD_HASH_WORKERS', 2)
+        app.config.setdefault('PASSWORD_HASH_MAX_PENDING', 32)
+        # Seconds to wait for a free spot before answering 503
+        app.config.setdefault('PASSWORD_HASH_QUEUE_TIMEOUT', 10)
+        app.extensions['password_hasher'] = self
+
+        @app.errorhandler(HashingBusy)
+        def hashing_busy(error):
+            return "The server is busy, please try again in a moment.", 503, {"Retry-After": "5"}
+
+    def _executor(self):
+        # Worker processes and the pending limit belong to one process, make new ones after a fork
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._slots = threading.BoundedSemaphore(self.app.config['PASSWORD_HASH_MAX_PENDING'])
+                    self._pool = None
+                    if self.app.config['PASSWORD_HASH_WORKERS']:
+                        # "spawn" so the worker processes don't inherit the web worker's threads and locks.
+                        # Spawned processes import the __main__ script again, which is why app.run()
+                        # in main.py has to stay under if __name__ == "__main__".
+                        self._pool = ProcessPoolExecutor(max_workers=self.app.config['PASSWORD_HASH_WORKERS'],
+                                                         mp_context=multiprocessing.get_context("spawn"))
+                    self._pid = os.getpid()
+        return self._pool
+
+    def _run(self, function, *args):
+        pool = self._executor()
+        slots = self._slots
+        if not slots.acquire(timeout=self.app.config['PASSWORD_HASH_QUEUE_TIMEOUT']):
+            with self._lock:
+                self._stats["rejected"] += 1
+            raise HashingBusy()
+        with self._lock:
+            self._stats["pending"] += 1
+            self._stats["max_seen_pending"] = max(self._stats["max_seen_pending"], self._stats["pending"])
+        started = time.perf_counter()
+        try:
+            if pool is None:
+                return function(*args)
+            return pool.submit(function, *args).result()
+        except BrokenProcessPool:
+            # A worker process died, start a fresh pool next time
+            self._pid = None
+            raise
+        finally:
+            slots.release()
+            with self._lock:
+                self._stats["pending"] -= 1
+                self._stats["completed"] += 1
+                self._stats["seconds"] += time.perf_counter() - started
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password,
+                         self.app.config['PASSWORD_HASH_METHOD'], self.app.config['PASSWORD_SALT_LENGTH'])
+
+    def verify(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        try:
+            method, salt, _ = pwhash.split("$", 2)
+        except ValueError:
+            return True
+        return (method != _normalize_method(self.app.config['PASSWORD_HASH_METHOD'])
+                or len(salt) != self.app.config['PASSWORD_SALT_LENGTH'])
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["workers"] = self.app.config['PASSWORD_HASH_WORKERS']
+        stats["max_pending"] = self.app.config['PASSWORD_HASH_MAX_PENDING']
+        stats["average_seconds"] = round(stats["seconds"] / stats["completed"], 4) if stats["completed"] else None
+        return stats
@@ -0,0 +1,151 @@
+import os
+import threading
+from datetime import datetime, timedelta
+
+# Deletes users and posts. The foreign keys do the work: deleting a post deletes its comments
+# (ON DELETE CASCADE) and deleting a user leaves their posts and comments without an author
+# (ON DELETE SET NULL), so a delete is one statement and the ORM never loads the child rows.
+#
+# One statement still touches every child row in one transaction, which for a post with
+# thousands of comments or a user who wrote thousands holds locks for a long time. Past
+# PURGE_INLINE_LIMIT child rows the delete becomes a purge job instead: a background thread
+# deletes or detaches the children PURGE_BATCH_SIZE rows per transaction, then deletes the row
+# itself. Jobs are saved in the database, so one interrupted by a restart is picked up again.
+
+PENDING = "pending"
+DONE = "done"
+
+
+class Purger:
+    def __init__(self, app=None, db=None, job_model=None, user_model=None, post_model=None, comment_model=None):
+        self._pid = None
+        # Called with (kind, ids) once rows are deleted, e.g. to clear caches
+        self.on_deleted = None
+        if app is not None:
+            self.init_app(app, db, job_model, user_model, post_model, comment_model)
+
+    def init_app(self, app, db, job_model, user_model, post_model, comment_model):
+        self.app = app
+        self.db = db
+        self.job_model = job_model
+        self.models = {"user": user_model, "post": post_model}
+        # Child rows of each kind of row: (model, column pointing at the row, delete or detach)
+        self.children = {
+            "user": [(post_model, post_model.author_id, "detach"), (comment_model, comment_model.author_id, "detach")],
+            "post": [(comment_model, comment_model.post_id, "delete")],
+        }
+        app.config.setdefault('PURGE_INLINE_LIMIT', 1000)
+        app.config.setdefault('PURGE_BATCH_SIZE', 500)
+        # A job whose thread hasn't finished a batch for this long is taken over
+        app.config.setdefault('PURGE_STALE_AFTER', 300)
+
+        @app.before_request
+        def resume_purges():
+            # Once per worker process, pick up purges a previous process didn't finish
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self.resume()
+
+        @app.cli.command("resume-purges")
+        def resume_purges_command():
+            """Finish purge jobs that were interrupted."""
+            for job_id in self._stale_jobs():
+                self.purge(job_id)
+                print(f"Finished purge job {job_id}")
+
+    def _child_counts(self, kind, ids):
+        counts = dict.fromkeys(ids, 0)
+        for model, column, _ in self.children[kind]:
+            rows = self.db.session.execute(
+                self.db.select(column, self.db.func.count(model.id)).where(column.in_(ids)).group_by(column))
+            for target_id, count in rows:
+                counts[target_id] += count
+        return counts
+
+    def delete(self, kind, ids):
+        # Returns (rows deleted now, rows left to a purge job)
+        ids = sorted(set(ids))
+        if not ids:
+            return 0, 0
+        model = self.models[kind]
+        counts = self._child_counts(kind, ids)
+        large = [target_id for target_id in ids if counts[target_id] > self.app.config['PURGE_INLINE_LIMIT']]
+        small = [target_id for target_id in ids if counts[target_id] <= self.app.config['PURGE_INLINE_LIMIT']]
+        deleted = 0
+        if small:
+            deleted = self.db.session.execute(self.db.delete(model).where(model.id.in_(small))).rowcount
+        now = datetime.utcnow()
+        jobs = [self.job_model(kind=kind, target_id=target_id, status=PENDING, removed=0, locked_at=now, created_at=now)
+                for target_id in large]
+        self.db.session.add_all(jobs)
+        self.db.session.commit()
+        if small and self.on_deleted is not None:
+            self.on_deleted(kind, small)
+        for job in jobs:
+            self.start(job.id)
+        return deleted, len(jobs)
+
+    def start(self, job_id):
+        def run():
+            with self.app.app_context():
+                try:
+                    self.purge(job_id)
+                except Exception:
+                    self.app.logger.exception("Purge job %s failed", job_id)
+
+        threading.Thread(target=run, name=f"purge-{job_id}", daemon=True).start()
+
+    def _stale_jobs(self):
+        job = self.job_model
+        stale = datetime.utcnow() - timedelta(seconds=self.app.config['PURGE_STALE_AFTER'])
+        return self.db.session.execute(
+            self.db.select(job.id).where(job.status == PENDING, job.locked_at < stale)
+        ).scalars().all()
+
+    def resume(self):
+        for job_id in self._stale_jobs():
+            self.start(job_id)
+
+    def _claim(self, job_id, locked_at):
+        # Only one thread (in any process) works on a job, like NewsletterSender._claim
+        job = self.job_model
+        now = datetime.utcnow()
+        result = self.db.session.execute(
+            self.db.update(job)
+            .where(job.id == job_id, job.status == PENDING, job.locked_at == locked_at)
+            .values(locked_at=now)
+        )
+        return now if result.rowcount == 1 else None
+
+    def purge(self, job_id):
+        job = self.db.session.get(self.job_model, job_id)
+        locked_at = self._claim(job_id, job.locked_at)
+        self.db.session.commit()
+        if locked_at is None:
+            return
+        batch_size = self.app.config['PURGE_BATCH_SIZE']
+        for model, column, action in self.children[job.kind]:
+            while True:
+                child_ids = self.db.session.execute(
+                    self.db.select(model.id).where(column == job.target_id).limit(batch_size)).scalars().all()
+                if not child_ids:
+                    break
+                if action == "delete":
+                    self.db.session.execute(self.db.delete(model).where(model.id.in_(child_ids)))
+                else:
+                    self.db.session.execute(self.db.update(model).where(model.id.in_(child_ids))
+                                            .values({column.key: None}))
+                new_locked_at = self._claim(job_id, locked_at)
+                if new_locked_at is None:
+                    # Another process took over this job
+                    self.db.session.rollback()
+                    return
+                locked_at = new_locked_at
+                job.removed += len(child_ids)
+                self.db.session.commit()
+        model = self.models[job.kind]
+        self.db.session.execute(self.db.delete(model).where(model.id == job.target_id))
+        job.status = DONE
+        self.db.session.commit()
+        if self.on_deleted is not None:
+            self.on_deleted(job.kind, [job.target_id])
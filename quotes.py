@@ -0,0 +1,92 @@
+import random
+import threading
+import time
+
+# The home page quote is picked from a pool kept in each process, so the home page doesn't
+# query the quotes table. The pool is two flat lists (the quote texts, and Walker's alias table
+# for their weights), so picking one is O(1) however many quotes there are: pick a slot at
+# random, then keep its quote or take its alias.
+#
+# Changing a quote calls changed(), which bumps the "quotes" version in the page cache backend.
+# Every process reloads its pool the next time it sees a version it didn't build from (versions
+# are shared by all workers, see page_cache.py), and at least every QUOTE_POOL_TTL seconds.
+# With PAGE_CACHE_TYPE=null there are no versions, so the version is the number of quotes and
+# their last updated_at instead, one small query per home page.
+
+
+def _alias_table(weights):
+    # Vose's alias method: every slot holds its own quote with probability[slot], else alias[slot]
+    count = len(weights)
+    total = sum(weights)
+    scaled = [weight * count / total for weight in weights]
+    probability = [1.0] * count
+    alias = list(range(count))
+    small = [index for index, weight in enumerate(scaled) if weight < 1]
+    large = [index for index, weight in enumerate(scaled) if weight >= 1]
+    while small and large:
+        less, more = small.pop(), large.pop()
+        probability[less] = scaled[less]
+        alias[less] = more
+        scaled[more] -= 1 - scaled[less]
+        (small if scaled[more] < 1 else large).append(more)
+    return probability, alias
+
+
+class QuotePool:
+    def __init__(self, app=None, db=None, quote_model=None, page_cache=None):
+        # (texts, probability, alias), replaced as a whole
+        self._pool = ([], [], [])
+        self._version = None
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app, db, quote_model, page_cache)
+
+    def init_app(self, app, db, quote_model, page_cache):
+        self.app = app
+        self.db = db
+        self.quote_model = quote_model
+        self.page_cache = page_cache
+        app.config.setdefault('QUOTE_POOL_TTL', 300)
+        app.extensions['quote_pool'] = self
+
+    def _current_version(self):
+        if self.app.config['PAGE_CACHE_TYPE'] != 'null':
+            return self.page_cache.backend.get_version("quotes")
+        quote = self.quote_model
+        count, updated_at = self.db.session.execute(
+            self.db.select(self.db.func.count(quote.id), self.db.func.max(quote.updated_at))).one()
+        return f"{count}:{updated_at}"
+
+    def _stale(self):
+        if self._version != self._current_version():
+            return True
+        return time.monotonic() - self._loaded_at > self.app.config['QUOTE_POOL_TTL']
+
+    def load(self):
+        version = self._current_version()
+        quote = self.quote_model
+        rows = self.db.session.execute(
+            self.db.select(quote.text, quote.author, quote.weight).where(quote.weight > 0).order_by(quote.id)
+        ).all()
+        texts = [f"{row.text} - {row.author}" if row.author else row.text for row in rows]
+        probability, alias = _alias_table([row.weight for row in rows]) if rows else ([], [])
+        # One assignment, so a request picking at the same time never sees half a pool
+        self._pool = (texts, probability, alias)
+        self._version = version
+        self._loaded_at = time.monotonic()
+
+    def choice(self):
+        if self._stale():
+            with self._lock:
+                if self._stale():
+                    self.load()
+        texts, probability, alias = self._pool
+        if not texts:
+            return None
+        slot = random.randrange(len(texts))
+        return texts[slot] if random.random() < probability[slot] else texts[alias[slot]]
+
+    def changed(self):
+        # Also makes the cached home page (in the "quotes" group) stop being used
+        self.page_cache.invalidate("quotes")
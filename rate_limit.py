@@ -0,0 +1,228 @@
+import hashlib
+import math
+import threading
+import time
+from functools import wraps
+from flask import request
+from flask_login import current_user
+from sqlalchemy import and_, delete, insert, or_, select, update
+from sqlalchemy.exc import IntegrityError
+
+# Rate limits for the routes that send email, hash passwords or write to the database, so one
+# client can't tie up every worker with them. Each limit is a sliding window: the count of the
+# current fixed window plus the previous window's count, weighted by how much of it still
+# overlaps the last `window` seconds. A request over any of its limits gets a 429 with
+# Retry-After and isn't counted.
+#
+# A request is counted first and checked against the counts that come back, so concurrent
+# requests can't all see room under the limit and all go through. A rejected request takes its
+# count back out.
+#
+#   @rate_limiter.limit("comment", "10/minute;100/day", keys=("ip", "user"))
+#
+# The limits can be changed per route name with the RATE_LIMITS config, e.g.
+# {"comment": "5/minute"}. Keys are "ip", "user" (logged in user, skipped when logged out), or
+# a function returning a string (or None to skip), e.g. the email a reset link is asked for.
+# Values are hashed in the counter keys, so a long email still fits the key column.
+#
+# The memory backend counts per process. The database backend keeps the counters in a table,
+# shared by every gunicorn worker (and machine) using the database.
+
+PERIODS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+
+def parse_limits(text):
+    # "10/minute;100/day" -> [(10, 60), (100, 86400)]
+    limits = []
+    for part in text.split(";"):
+        if not part.strip():
+            continue
+        count, _, period = part.strip().partition("/")
+        limits.append((int(count), PERIODS[period.strip().rstrip("s")]))
+    return limits
+
+
+class MemoryBackend:
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+        self._hits_since_prune = 0
+
+    def get(self, keys):
+        with self._lock:
+            return {key: self._counts.get(key, 0) for key in keys}
+
+    def increment(self, keys):
+        # Returns the new counts
+        with self._lock:
+            for key in keys:
+                self._counts[key] = self._counts.get(key, 0) + 1
+            self._hits_since_prune += 1
+            if self._hits_since_prune >= 1000:
+                self._hits_since_prune = 0
+                self._prune()
+            return {key: self._counts[key] for key in keys}
+
+    def decrement(self, keys):
+        with self._lock:
+            for key in keys:
+                if self._counts.get(key):
+                    self._counts[key] -= 1
+
+    def _prune(self):
+        # Counters for windows that ended over a day ago can't matter to any limit anymore
+        cutoff = time.time() - 2 * PERIODS["day"]
+        for key in [key for key in self._counts if key[1] < cutoff]:
+            del self._counts[key]
+
+
+class DatabaseBackend:
+    # Uses the engine directly (not db.session) so counting never mixes with the route's own
+    # transaction
+    def __init__(self, engine, table):
+        self.engine = engine
+        self.table = table
+        self._hits_since_prune = 0
+
+    def get(self, keys):
+        table = self.table
+        with self.engine.connect() as connection:
+            rows = connection.execute(
+                select(table.c.key, table.c.window_start, table.c.count)
+                .where(or_(*[and_(table.c.key == key, table.c.window_start == window_start)
+                             for key, window_start in keys]))
+            ).all()
+        counts = {key: 0 for key in keys}
+        counts.update({(row.key, row.window_start): row.count for row in rows})
+        return counts
+
+    def _add(self, connection, key, window_start, amount):
+        # Adds amount to one counter and returns its new count. The UPDATE locks the row until the
+        # transaction ends, so the count read back includes every request counted before this one.
+        table = self.table
+        where = (table.c.key == key, table.c.window_start == window_start)
+        statement = update(table).where(*where).values(count=table.c.count + amount)
+        if connection.dialect.update_returning:
+            count = connection.execute(statement.returning(table.c.count)).scalar()
+        elif connection.execute(statement).rowcount:
+            count = connection.execute(select(table.c.count).where(*where)).scalar()
+        else:
+            count = None
+        if count is not None or amount < 0:
+            return count or 0
+        try:
+            with connection.begin_nested():
+                connection.execute(insert(table).values(key=key, window_start=window_start, count=amount))
+            return amount
+        except IntegrityError:
+            # Another worker made the row first
+            return self._add(connection, key, window_start, amount)
+
+    def increment(self, keys):
+        # Returns the new counts. Rows are always updated in the same order so two requests
+        # can't deadlock on each other's counters.
+        with self.engine.begin() as connection:
+            counts = {key: self._add(connection, *key, 1) for key in sorted(keys)}
+        self._hits_since_prune += 1
+        if self._hits_since_prune >= 1000:
+            self._hits_since_prune = 0
+            self.prune()
+        return counts
+
+    def decrement(self, keys):
+        with self.engine.begin() as connection:
+            for key in sorted(keys):
+                self._add(connection, *key, -1)
+
+    def prune(self):
+        with self.engine.begin() as connection:
+            result = connection.execute(delete(self.table).where(
+                self.table.c.window_start < int(time.time()) - 2 * PERIODS["day"]))
+        return result.rowcount
+
+
+class RateLimiter:
+    def __init__(self, app=None, backend=None):
+        self.backend = backend or MemoryBackend()
+        # Called with (route name, allowed) for every decision, e.g. to count them in /metrics
+        self.observer = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('RATE_LIMIT_ENABLED', True)
+        app.config.setdefault('RATE_LIMITS', {})
+        app.extensions['rate_limiter'] = self
+
+        @app.errorhandler(RateLimited)
+        def rate_limited(error):
+            return (f"Too many requests, please try again in {error.retry_after} seconds.", 429,
+                    {"Retry-After": str(error.retry_after)})
+
+    def _key_values(self, keys):
+        for key in keys:
+            if key == "ip":
+                yield "ip", request.remote_addr or "unknown"
+            elif key == "user":
+                if current_user.is_authenticated:
+                    yield "user", str(current_user.id)
+            else:
+                value = key()
+                if value:
+                    yield key.__name__, value
+
+    def _counter(self, name, key_name, value, window):
+        return f"{name}:{key_name}:{hashlib.sha256(value.encode()).hexdigest()}:{window}"
+
+    def check(self, name, default, keys):
+        if not self.app.config['RATE_LIMIT_ENABLED']:
+            return
+        limits = parse_limits(self.app.config['RATE_LIMITS'].get(name, default))
+        now = time.time()
+        windows = []
+        for key_name, value in self._key_values(keys):
+            for limit, window in limits:
+                current_start = int(now // window) * window
+                counter = self._counter(name, key_name, value, window)
+                windows.append((limit, window, now - current_start, (counter, current_start),
+                                (counter, current_start - window)))
+        if not windows:
+            return
+        counts = self.backend.get([previous for *_, previous in windows])
+        # Counts this request, the current counts below include it
+        currents = [current for *_, current, previous in windows]
+        counts.update(self.backend.increment(currents))
+        retry_after = 0
+        for limit, window, elapsed, current, previous in windows:
+            current_count, previous_count = counts[current], counts[previous]
+            if previous_count * (window - elapsed) / window + current_count <= limit:
+                continue
+            if current_count > limit or not previous_count:
+                # Only the next window helps
+                wait = window - elapsed
+            else:
+                # Wait for enough of the previous window to slide out
+                wait = window - elapsed - (limit - current_count) * window / previous_count
+            retry_after = max(retry_after, math.ceil(wait), 1)
+        if self.observer is not None:
+            self.observer(name, not retry_after)
+        if retry_after:
+            self.backend.decrement(currents)
+            raise RateLimited(retry_after)
+
+    def limit(self, name, default, keys=("ip",), methods=("POST",)):
+        def decorator(function):
+            @wraps(function)
+            def wrapper_function(*args, **kwargs):
+                if request.method in methods:
+                    self.check(name, default, keys)
+                return function(*args, **kwargs)
+            return wrapper_function
+        return decorator
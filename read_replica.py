@@ -0,0 +1,73 @@
+import time
+from flask import request, session
+from flask_sqlalchemy.session import Session
+
+# Read-only pages can be served from a read replica. With DB_REPLICA_URI set the replica is the
+# "replica" bind, and GET requests to the endpoints in REPLICA_ENDPOINTS run their SELECTs on it.
+# Everything else uses the primary: writes, raw SQL, other routes and background threads.
+#
+# A replica lags behind the primary, so right after a write its data can be old:
+#   - within a request, once the session writes, its reads go to the primary too
+#   - after a request that wrote, that browser's reads stay on the primary for
+#     REPLICA_STICKY_SECONDS (the time is kept in its Flask session), so people see their own
+#     comment or edit on the page they're sent to
+#   - so do the reads of the worker process that handled it, since the write cleared its page
+#     cache and the next page it renders is the one that gets cached
+# Pages cached by other workers with the filesystem page cache can still be rendered from the
+# replica during that window, keep REPLICA_STICKY_SECONDS above the replica's usual lag.
+
+REPLICA = "replica"
+
+
+class RoutingSession(Session):
+    # db.session's class. Sends SELECTs to the replica while the request allows it.
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if self._flushing or getattr(clause, "is_dml", False):
+            self.info["wrote"] = True
+            self.info.pop("use_replica", None)
+        elif bind is None and self.info.get("use_replica") and getattr(clause, "is_select", False):
+            return self._db.engines[REPLICA]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+class ReadReplica:
+    def __init__(self, app=None, db=None):
+        # When a request in this process last wrote (time.monotonic())
+        self._last_write = 0
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db):
+        self.app = app
+        self.db = db
+        app.config.setdefault('REPLICA_ENDPOINTS',
+                              ("get_all_posts", "show_post", "about", "view_edits", "edit_user_permissions"))
+        app.config.setdefault('REPLICA_STICKY_SECONDS', 10)
+        app.extensions['read_replica'] = self
+        if REPLICA not in app.config.get('SQLALCHEMY_BINDS', {}):
+            return
+
+        @app.before_request
+        def route_reads():
+            if self.use_replica():
+                db.session.info["use_replica"] = True
+
+        @app.after_request
+        def remember_writes(response):
+            # Writes made while showing a read-only page (like saving a post's rendered HTML)
+            # don't change what the visitor sees, and shouldn't give a cached page a cookie
+            if db.session.info.get("wrote") and not self.read_only_request():
+                session["db_written_at"] = time.time()
+                self._last_write = time.monotonic()
+            return response
+
+    def read_only_request(self):
+        return request.method in ("GET", "HEAD") and request.endpoint in self.app.config['REPLICA_ENDPOINTS']
+
+    def use_replica(self):
+        if not self.read_only_request():
+            return False
+        sticky = self.app.config['REPLICA_STICKY_SECONDS']
+        if time.monotonic() - self._last_write < sticky:
+            return False
+        return time.time() - session.get("db_written_at", 0) >= sticky
@@ -0,0 +1,170 @@
+import html
+import math
+import re
+from html.parser import HTMLParser
+
+# Everything shown from a post body or comment is worked out once, when it's saved, instead of
+# on every view. Post bodies and comments are CKEditor HTML typed in by users, so they're run
+# through an allow list: only the tags and attributes below are kept, links and images only
+# keep http(s)/mailto/relative URLs, and the contents of script, style and similar are dropped.
+# Post bodies also get an excerpt, a word count, a reading time and a table of contents (the
+# headings get ids to link to).
+#
+# Changing the rules here doesn't touch saved posts, run "flask --app main render-posts --all".
+
+ALLOWED_TAGS = {
+    "a": {"href", "title"},
+    "img": {"src", "alt", "title", "width", "height"},
+    "td": {"colspan", "rowspan"},
+    "th": {"colspan", "rowspan", "scope"},
+    "ol": {"start"},
+}
+for _tag in ("p", "br", "hr", "div", "span", "strong", "b", "em", "i", "u", "s", "sub", "sup", "small",
+             "h1", "h2", "h3", "h4", "h5", "h6", "ul", "li", "blockquote", "pre", "code",
+             "table", "thead", "tbody", "tfoot", "tr", "caption", "figure", "figcaption"):
+    ALLOWED_TAGS.setdefault(_tag, set())
+
+VOID_TAGS = {"br", "hr", "img"}
+# Dropped along with everything inside them
+DROP_CONTENT_TAGS = {"script", "style", "iframe", "object", "embed", "template", "noscript", "textarea",
+                     "select", "svg", "math", "head", "title"}
+BLOCK_TAGS = {"p", "div", "br", "li", "h1", "h2", "h3", "h4", "h5", "h6", "blockquote", "pre", "tr", "td", "th"}
+# Starting one of these ends an open <p>, like browsers do
+CLOSES_PARAGRAPH = {"p", "div", "ul", "ol", "h1", "h2", "h3", "h4", "h5", "h6", "blockquote", "pre", "table",
+                    "hr", "figure"}
+TOC_TAGS = {"h2": 2, "h3": 3, "h4": 4}
+URL_SCHEMES = {"a": {"http", "https", "mailto"}, "img": {"http", "https"}}
+
+EXCERPT_LENGTH = 300
+WORDS_PER_MINUTE = 200
+
+
+def _safe_url(tag, url):
+    # Strip what browsers ignore, so "java\tscript:" can't sneak past the scheme check
+    cleaned = re.sub(r"[\x00-\x20]", "", url)
+    scheme = re.match(r"^([a-zA-Z][a-zA-Z0-9+.-]*):", cleaned)
+    if scheme is None:
+        # Relative URL
+        return True
+    return scheme.group(1).lower() in URL_SCHEMES[tag]
+
+
+def _slugify(text):
+    return re.sub(r"[^a-z0-9]+", "-", text.lower()).strip("-") or "section"
+
+
+class _Sanitizer(HTMLParser):
+    def __init__(self, user_content):
+        super().__init__(convert_charrefs=True)
+        self.user_content = user_content
+        self.parts = []
+        self.text = []
+        self.toc = []
+        self._open = []
+        self._drop = 0
+        self._heading = None
+        self._slugs = set()
+
+    def handle_starttag(self, tag, attrs):
+        if tag in DROP_CONTENT_TAGS:
+            self._drop += 1
+            return
+        if self._drop or tag not in ALLOWED_TAGS:
+            return
+        if self._open and ((tag in CLOSES_PARAGRAPH and self._open[-1] == "p") or
+                           (tag == "li" and self._open[-1] == "li")):
+            self._close(self._open.pop())
+        kept = []
+        for name, value in attrs:
+            if name not in ALLOWED_TAGS[tag] or value is None:
+                continue
+            if name in ("href", "src") and not _safe_url(tag, value):
+                continue
+            kept.append(f' {name}="{html.escape(value, quote=True)}"')
+        if tag == "a" and self.user_content:
+            kept.append(' rel="nofollow ugc noopener"')
+        if tag in TOC_TAGS and not self.user_content and self._heading is None:
+            # The id needs the heading's text, filled in when the heading ends
+            self._heading = (tag, len(self.parts), len(self.text))
+            self.parts.append(None)
+        else:
+            self.parts.append(f"<{tag}{''.join(kept)}>")
+        if tag in VOID_TAGS:
+            if tag == "br":
+                self.text.append(" ")
+        else:
+            self._open.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_TAGS:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if tag in DROP_CONTENT_TAGS:
+            self._drop = max(0, self._drop - 1)
+            return
+        if self._drop or tag not in self._open:
+            return
+        # Close anything left open inside this tag too, so the output is always balanced
+        while self._open:
+            open_tag = self._open.pop()
+            self._close(open_tag)
+            if open_tag == tag:
+                break
+
+    def _close(self, tag):
+        if self._heading is not None and self._heading[0] == tag:
+            _, part_index, text_index = self._heading
+            title = " ".join("".join(self.text[text_index:]).split())
+            slug = base = _slugify(title)
+            number = 2
+            while slug in self._slugs:
+                slug = f"{base}-{number}"
+                number += 1
+            self._slugs.add(slug)
+            self.parts[part_index] = f'<{tag} id="{slug}">'
+            self.toc.append({"level": TOC_TAGS[tag], "id": slug, "title": title})
+            self._heading = None
+        self.parts.append(f"</{tag}>")
+        if tag in BLOCK_TAGS:
+            self.text.append(" ")
+
+    def handle_data(self, data):
+        if self._drop:
+            return
+        self.parts.append(html.escape(data, quote=False))
+        self.text.append(data)
+
+    def close(self):
+        super().close()
+        while self._open:
+            self._close(self._open.pop())
+
+
+def _sanitize(body, user_content):
+    sanitizer = _Sanitizer(user_content)
+    sanitizer.feed(body or "")
+    sanitizer.close()
+    return "".join(sanitizer.parts), " ".join("".join(sanitizer.text).split()), sanitizer.toc
+
+
+def render_post(body):
+    # Column values for BlogPost, see BlogPost.set_body
+    body_html, text, toc = _sanitize(body, user_content=False)
+    excerpt = text
+    if len(excerpt) > EXCERPT_LENGTH:
+        excerpt = excerpt[:EXCERPT_LENGTH].rsplit(" ", 1)[0] + "…"
+    word_count = len(text.split())
+    return {
+        "body_html": body_html,
+        "excerpt": excerpt,
+        "word_count": word_count,
+        "reading_minutes": max(1, math.ceil(word_count / WORDS_PER_MINUTE)),
+        "toc": toc,
+    }
+
+
+def render_comment(text):
+    # Links in comments get rel="nofollow ugc" and headings no ids
+    return _sanitize(text, user_content=True)[0]
@@ -0,0 +1,97 @@
+import hashlib
+import hmac
+from itsdangerous import BadSignature, SignatureExpired, URLSafeTimedSerializer
+
+# Password reset links carry a signed token instead of one saved in the database. The token
+# holds the user's id and a fingerprint of their current password hash, signed with the app's
+# SECRET_KEY and timestamped, so:
+#   - it can't be made or changed without the secret key
+#   - it stops working after RESET_TOKEN_MAX_AGE seconds
+#   - it only works once: setting the new password changes the hash, so the fingerprint no
+#     longer matches (and any other links sent before it stop working too)
+# Issuing a token is one lookup by email and checking one is one lookup by id.
+#
+# The reset_password table and users.reset_password_token aren't used anymore,
+# "flask --app main cleanup-reset-tokens" empties them (run it from a scheduler until they are).
+
+SALT = "password-reset"
+
+
+class InvalidResetToken(Exception):
+    pass
+
+
+class ExpiredResetToken(InvalidResetToken):
+    pass
+
+
+def _fingerprint(password_hash):
+    # Only a short hash of the password hash goes in the token, tokens are signed, not encrypted
+    return hashlib.sha256(password_hash.encode()).hexdigest()[:16]
+
+
+class ResetTokens:
+    def __init__(self, app=None, db=None, user_model=None, reset_model=None):
+        if app is not None:
+            self.init_app(app, db, user_model, reset_model)
+
+    def init_app(self, app, db, user_model, reset_model):
+        self.app = app
+        self.db = db
+        self.user_model = user_model
+        self.reset_model = reset_model
+        app.config.setdefault('RESET_TOKEN_MAX_AGE', 3600)
+        app.extensions['reset_tokens'] = self
+
+        @app.cli.command("cleanup-reset-tokens")
+        def cleanup_command():
+            """Empty the old reset_password table and users.reset_password_token."""
+            rows, tokens = self.cleanup()
+            print(f"Deleted {rows} reset_password rows and cleared {tokens} saved tokens")
+
+    def _serializer(self):
+        return URLSafeTimedSerializer(self.app.config['SECRET_KEY'], salt=SALT)
+
+    def issue(self, email):
+        # Returns (email address, token), or None when nobody has that email
+        user = self.user_model
+        row = self.db.session.execute(
+            self.db.select(user.id, user.email, user.password).where(user.email == email)).first()
+        if row is None:
+            return None
+        return row.email, self._serializer().dumps({"id": row.id, "fp": _fingerprint(row.password)})
+
+    def verify(self, token):
+        # Returns the User the token is for, or raises InvalidResetToken/ExpiredResetToken
+        try:
+            data = self._serializer().loads(token, max_age=self.app.config['RESET_TOKEN_MAX_AGE'])
+        except SignatureExpired:
+            raise ExpiredResetToken()
+        except BadSignature:
+            raise InvalidResetToken()
+        user = self.db.session.get(self.user_model, data.get("id"))
+        if user is None or not hmac.compare_digest(_fingerprint(user.password), str(data.get("fp"))):
+            # Deleted, or the password was changed since (the token was already used)
+            raise InvalidResetToken()
+        return user
+
+    def cleanup(self, batch_size=1000):
+        # A batch per transaction, so the tables aren't locked for long
+        deleted = cleared = 0
+        reset = self.reset_model
+        user = self.user_model
+        while True:
+            ids = self.db.session.execute(self.db.select(reset.id).limit(batch_size)).scalars().all()
+            if not ids:
+                break
+            deleted += self.db.session.execute(self.db.delete(reset).where(reset.id.in_(ids))).rowcount
+            self.db.session.commit()
+        while True:
+            ids = self.db.session.execute(
+                self.db.select(user.id).where(user.reset_password_token != None).limit(batch_size)).scalars().all()
+            if not ids:
+                break
+            cleared += self.db.session.execute(
+                self.db.update(user).where(user.id.in_(ids)).values(reset_password_token=None)).rowcount
+            self.db.session.commit()
+        return deleted, cleared
@@ -0,0 +1,197 @@
+import html
+from html.parser import HTMLParser
+from markupsafe import Markup, escape
+from sqlalchemy import text
+
+# Full text search over the blog posts. Uses the database's own full text index:
+# an FTS5 virtual table on SQLite and a tsvector column with a GIN index on Postgres.
+# Post bodies are CKEditor HTML, so the tags are stripped before anything is indexed.
+
+# Markers put around matches by the database, swapped for <mark> after the snippet is escaped
+MATCH_START = "\x02"
+MATCH_END = "\x03"
+
+
+class _TextExtractor(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self._skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ("script", "style"):
+            self._skip += 1
+
+    def handle_endtag(self, tag):
+        if tag in ("script", "style") and self._skip:
+            self._skip -= 1
+        elif tag in ("p", "div", "br", "li", "h1", "h2", "h3", "h4", "h5", "h6", "blockquote"):
+            self.parts.append(" ")
+
+    def handle_data(self, data):
+        if not self._skip:
+            self.parts.append(data)
+
+
+def html_to_text(body):
+    extractor = _TextExtractor()
+    extractor.feed(body or "")
+    extractor.close()
+    return " ".join(html.unescape("".join(extractor.parts)).split())
+
+
+def _highlight(snippet):
+    return Markup(str(escape(snippet or "")).replace(MATCH_START, "<mark>").replace(MATCH_END, "</mark>"))
+
+
+class SQLiteBackend:
+    def __init__(self, db):
+        self.db = db
+
+    def create(self):
+        # Returns True when the index table didn't exist yet (so it still needs to be filled)
+        exists = self.db.session.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'post_search'")).scalar()
+        if exists:
+            return False
+        self.db.session.execute(text(
+            "CREATE VIRTUAL TABLE post_search USING fts5(title, subtitle, body, tokenize = 'porter unicode61')"))
+        return True
+
+    def remove(self, post_id):
+        self.db.session.execute(text("DELETE FROM post_search WHERE rowid = :id"), {"id": post_id})
+
+    def add(self, post_id, title, subtitle, body):
+        self.remove(post_id)
+        self.db.session.execute(
+            text("INSERT INTO post_search (rowid, title, subtitle, body) VALUES (:id, :title, :subtitle, :body)"),
+            {"id": post_id, "title": title, "subtitle": subtitle, "body": body})
+
+    def clear(self):
+        self.db.session.execute(text("DELETE FROM post_search"))
+
+    def search(self, query, limit, offset):
+        # Quote every word so characters like - or : in the search box aren't read as FTS5 syntax
+        terms = " ".join('"{}"'.format(word.replace('"', '""')) for word in query.split())
+        if not terms:
+            return []
+        return self.db.session.execute(text(
+            "SELECT rowid AS id, title, subtitle, "
+            f"snippet(post_search, 2, '{MATCH_START}', '{MATCH_END}', '...', 16) AS snippet "
+            "FROM post_search WHERE post_search MATCH :terms "
+            # Title matches count the most, then the subtitle, then the body
+            "ORDER BY bm25(post_search, 10.0, 5.0, 1.0) LIMIT :limit OFFSET :offset"),
+            {"terms": terms, "limit": limit, "offset": offset}).all()
+
+
+class PostgresBackend:
+    def __init__(self, db):
+        self.db = db
+
+    def create(self):
+        exists = self.db.session.execute(text("SELECT to_regclass('post_search')")).scalar()
+        if exists:
+            return False
+        self.db.session.execute(text(
+            "CREATE TABLE post_search ("
+            "post_id INTEGER PRIMARY KEY REFERENCES blog_posts (id) ON DELETE CASCADE, "
+            "title TEXT NOT NULL, subtitle TEXT NOT NULL, body TEXT NOT NULL, document TSVECTOR NOT NULL)"))
+        self.db.session.execute(text("CREATE INDEX post_search_document_idx ON post_search USING GIN (document)"))
+        return True
+
+    def remove(self, post_id):
+        self.db.session.execute(text("DELETE FROM post_search WHERE post_id = :id"), {"id": post_id})
+
+    def add(self, post_id, title, subtitle, body):
+        self.db.session.execute(text(
+            "INSERT INTO post_search (post_id, title, subtitle, body, document) VALUES ("
+            ":id, :title, :subtitle, :body, "
+            "setweight(to_tsvector('english', :title), 'A') || "
+            "setweight(to_tsvector('english', :subtitle), 'B') || "
+            "setweight(to_tsvector('english', :body), 'C')) "
+            "ON CONFLICT (post_id) DO UPDATE SET title = EXCLUDED.title, subtitle = EXCLUDED.subtitle, "
+            "body = EXCLUDED.body, document = EXCLUDED.document"),
+            {"id": post_id, "title": title, "subtitle": subtitle, "body": body})
+
+    def clear(self):
+        self.db.session.execute(text("DELETE FROM post_search"))
+
+    def search(self, query, limit, offset):
+        return self.db.session.execute(text(
+            "SELECT post_id AS id, title, subtitle, "
+            "ts_headline('english', body, query, "
+            f"'StartSel={MATCH_START}, StopSel={MATCH_END}, MaxWords=35, MinWords=15') AS snippet "
+            "FROM post_search, websearch_to_tsquery('english', :query) AS query "
+            "WHERE document @@ query "
+            "ORDER BY ts_rank(document, query) DESC LIMIT :limit OFFSET :offset"),
+            {"query": query, "limit": limit, "offset": offset}).all()
+
+
+class SearchIndex:
+    def __init__(self, app=None, db=None, post_model=None):
+        self._backend = None
+        if app is not None:
+            self.init_app(app, db, post_model)
+
+    def init_app(self, app, db, post_model):
+        self.app = app
+        self.db = db
+        self.post_model = post_model
+        app.config.setdefault('SEARCH_RESULTS_PER_PAGE', 20)
+
+        @app.cli.command("rebuild-search-index")
+        def rebuild_search_index_command():
+            """Index every blog post again from scratch."""
+            print(f"Indexed {self.rebuild()} posts")
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            dialect = self.db.engine.dialect.name
+            if dialect == "sqlite":
+                self._backend = SQLiteBackend(self.db)
+            elif dialect == "postgresql":
+                self._backend = PostgresBackend(self.db)
+            else:
+                raise RuntimeError(f"Search isn't supported on {dialect}")
+        return self._backend
+
+    def create(self):
+        # Makes the index table if needed, filling it from the existing posts the first time
+        if self.backend.create():
+            self.rebuild()
+        else:
+            self.db.session.commit()
+
+    def index_post(self, post):
+        # Called before the route commits, so the post and its index entry are saved together
+        self.backend.add(post.id, post.title, post.subtitle, html_to_text(post.body))
+
+    def remove_post(self, post_id):
+        self.backend.remove(post_id)
+
+    def rebuild(self, batch_size=500):
+        post = self.post_model
+        self.backend.clear()
+        count = 0
+        last_id = 0
+        while True:
+            # Work through the posts in id order, a batch at a time, so big archives aren't loaded at once
+            rows = self.db.session.execute(
+                self.db.select(post.id, post.title, post.subtitle, post.body)
+                .where(post.id > last_id).order_by(post.id).limit(batch_size)).all()
+            if not rows:
+                break
+            for row in rows:
+                self.backend.add(row.id, row.title, row.subtitle, html_to_text(row.body))
+            count += len(rows)
+            last_id = rows[-1].id
+        self.db.session.commit()
+        return count
+
+    def search(self, query, page=1):
+        per_page = self.app.config['SEARCH_RESULTS_PER_PAGE']
+        rows = self.backend.search(query, per_page + 1, (page - 1) * per_page)
+        results = [{"id": row.id, "title": row.title, "subtitle": row.subtitle, "snippet": _highlight(row.snippet)}
+                   for row in rows[:per_page]]
+        return results, len(rows) > per_page
@@ -0,0 +1,199 @@
+import gzip
+import hashlib
+from fnmatch import fnmatch
+from io import BytesIO
+import json
+import mimetypes
+import os
+from flask import abort, request, send_file, url_for
+from markupsafe import Markup
+from werkzeug.security import safe_join
+
+# Build step for everything in static/. "flask --app main assets build" writes into static/dist:
+#   - a copy of every file with a hash of its contents in the name (css/styles.3f9a1c02b4.css),
+#     served from /dist with a one year "immutable" Cache-Control, so returning visitors don't
+#     ask for them again, and a changed file gets a new name
+#   - gzip and brotli versions of text files (css, js, ...), served to browsers that accept them
+#   - smaller WebP, AVIF and JPEG versions of the page header backgrounds, at a few widths,
+#     for the <picture> srcset made by responsive_background()
+# Old builds are left in place, so pages still cached with the previous names keep working.
+# The Procfile builds in the release phase, so web processes start straight into gunicorn.
+# Where the release phase runs in a container of its own, point STATIC_BUILD_DIR at storage the
+# web processes can read.
+#
+# In templates, asset_url('css/styles.css') gives the hashed URL, or the plain /static URL
+# when nothing has been built yet. Brotli and Pillow are only needed for the build, without
+# them the brotli versions or the resized images are skipped.
+
+MANIFEST = "manifest.json"
+COMPRESSIBLE = {".css", ".js", ".svg", ".ico", ".json", ".txt"}
+
+
+def _hashed_name(path, data, suffix=""):
+    stem, extension = os.path.splitext(path)
+    return f"{stem}{suffix}.{hashlib.sha256(data).hexdigest()[:10]}{extension}"
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as file:
+        file.write(data)
+
+
+class StaticAssets:
+    def __init__(self, app=None):
+        self.manifest = {"files": {}, "images": {}}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('STATIC_BUILD_DIR', os.path.join(app.static_folder, "dist"))
+        app.config.setdefault('STATIC_BUILD_MAX_AGE', 365 * 24 * 3600)
+        # Widths of the resized background images, in pixels
+        app.config.setdefault('RESPONSIVE_IMAGE_WIDTHS', (640, 1280, 1920))
+        # Which images get resized versions, relative to static/
+        app.config.setdefault('RESPONSIVE_IMAGES', "assets/img/*-bg.jpg")
+        app.extensions['static_assets'] = self
+        self.load_manifest()
+
+        app.add_url_rule("/dist/<path:filename>", "asset", self.send)
+        app.jinja_env.globals["asset_url"] = self.url
+        app.jinja_env.globals["responsive_background"] = self.responsive_background
+
+        @app.cli.group("assets")
+        def assets_group():
+            """Static file build."""
+
+        @assets_group.command("build")
+        def build_command():
+            """Fingerprint, compress and resize everything in static/."""
+            self.build()
+            print(f"Built {len(self.manifest['files'])} files and {len(self.manifest['images'])} responsive images "
+                  f"into {self.app.config['STATIC_BUILD_DIR']}")
+
+    def load_manifest(self):
+        try:
+            with open(os.path.join(self.app.config['STATIC_BUILD_DIR'], MANIFEST)) as file:
+                self.manifest = json.load(file)
+        except FileNotFoundError:
+            self.manifest = {"files": {}, "images": {}}
+
+    @property
+    def version(self):
+        # Changes whenever a build changes any file name
+        return hashlib.sha1(json.dumps(self.manifest, sort_keys=True).encode()).hexdigest()
+
+    def url(self, filename):
+        hashed = self.manifest["files"].get(filename)
+        if hashed is None:
+            return url_for("static", filename=filename)
+        return url_for("asset", filename=hashed)
+
+    def responsive_background(self, filename):
+        # Page header background as a <picture>, the browser picks the best format it supports
+        # and the smallest width that covers the screen
+        sources = []
+        for image_type, variants in self.manifest["images"].get(filename, {}).items():
+            srcset = ", ".join(f"{url_for('asset', filename=name)} {width}w" for name, width in variants)
+            sources.append(Markup('<source type="{}" srcset="{}" sizes="100vw" />').format(image_type, srcset))
+        return Markup('<picture class="masthead-picture">{}<img src="{}" alt="" fetchpriority="high" /></picture>').format(
+            Markup("").join(sources), self.url(filename))
+
+    def send(self, filename):
+        build_dir = self.app.config['STATIC_BUILD_DIR']
+        path = safe_join(build_dir, filename)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+        mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        encoding = None
+        for candidate, extension in (("br", ".br"), ("gzip", ".gz")):
+            if request.accept_encodings[candidate] and os.path.isfile(path + extension):
+                encoding = candidate
+                path += extension
+                break
+        response = send_file(path, mimetype=mimetype, conditional=True,
+                             max_age=self.app.config['STATIC_BUILD_MAX_AGE'])
+        if encoding:
+            response.headers["Content-Encoding"] = encoding
+        response.vary.add("Accept-Encoding")
+        response.cache_control.immutable = True
+        return response
+
+    def build(self):
+        static_dir = self.app.static_folder
+        build_dir = self.app.config['STATIC_BUILD_DIR']
+        manifest = {"files": {}, "images": {}}
+        for root, directories, files in os.walk(static_dir):
+            # Don't build the build output
+            directories[:] = [name for name in directories
+                              if os.path.abspath(os.path.join(root, name)) != os.path.abspath(build_dir)]
+            for name in files:
+                source = os.path.join(root, name)
+                filename = os.path.relpath(source, static_dir).replace(os.sep, "/")
+                with open(source, "rb") as file:
+                    data = file.read()
+                hashed = _hashed_name(filename, data)
+                self._write_with_compression(os.path.join(build_dir, hashed), data)
+                manifest["files"][filename] = hashed
+        for filename in sorted(manifest["files"]):
+            if self._is_responsive(filename):
+                variants = self._resize(filename)
+                if variants:
+                    manifest["images"][filename] = variants
+        _write(os.path.join(build_dir, MANIFEST), json.dumps(manifest, indent=2, sort_keys=True).encode())
+        self.manifest = manifest
+        return manifest
+
+    def _is_responsive(self, filename):
+        return fnmatch(filename, self.app.config['RESPONSIVE_IMAGES'])
+
+    def _write_with_compression(self, path, data):
+        _write(path, data)
+        if os.path.splitext(path)[1] not in COMPRESSIBLE:
+            return
+        compressed = {".gz": gzip.compress(data, compresslevel=9, mtime=0)}
+        try:
+            import brotli
+            compressed[".br"] = brotli.compress(data, quality=11)
+        except ImportError:
+            pass
+        for extension, compressed_data in compressed.items():
+            # Not worth it for files that barely shrink
+            if len(compressed_data) < len(data) * 0.9:
+                _write(path + extension, compressed_data)
+
+    def _resize(self, filename):
+        try:
+            from PIL import Image, features
+        except ImportError:
+            self.app.logger.warning("Pillow isn't installed, skipping resized versions of %s", filename)
+            return {}
+        formats = [("image/avif", "AVIF", ".avif", {"quality": 50})] if features.check("avif") else []
+        formats += [("image/webp", "WEBP", ".webp", {"quality": 75, "method": 6}),
+                    ("image/jpeg", "JPEG", ".jpg", {"quality": 75, "optimize": True, "progressive": True})]
+        build_dir = self.app.config['STATIC_BUILD_DIR']
+        stem = os.path.splitext(filename)[0]
+        with open(os.path.join(self.app.static_folder, filename), "rb") as file:
+            source_data = file.read()
+        variants = {}
+        with Image.open(BytesIO(source_data)) as original:
+            original = original.convert("RGB")
+            widths = sorted({min(width, original.width) for width in self.app.config['RESPONSIVE_IMAGE_WIDTHS']})
+            for width in widths:
+                resized = None
+                for image_type, pillow_format, extension, options in formats:
+                    # Named after the source image and settings, so rebuilding an unchanged image
+                    # skips the (slow) encoding
+                    name = _hashed_name(stem + extension, source_data + repr((width, options)).encode(),
+                                        suffix=f"-{width}")
+                    path = os.path.join(build_dir, name)
+                    if not os.path.isfile(path):
+                        if resized is None:
+                            height = round(original.height * width / original.width)
+                            resized = original.resize((width, height), Image.LANCZOS) if width < original.width else original
+                        buffer = BytesIO()
+                        resized.save(buffer, pillow_format, **options)
+                        _write(path, buffer.getvalue())
+                    variants.setdefault(image_type, []).append([name, width])
+        return variants
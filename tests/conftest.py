@@ -0,0 +1,49 @@
+import os
+import tempfile
+import pytest
+
+# main reads its settings from the environment when it's imported, so the app used by these tests
+# gets a database and caches of its own in a temporary directory.
+
+
+@pytest.fixture(scope="session")
+def main_module():
+    directory = tempfile.mkdtemp()
+    os.environ.update({
+        "FLASK_KEY": "test",
+        "DB_URI": f"sqlite:///{os.path.join(directory, 'posts.db')}",
+        "PAGE_CACHE_DIR": os.path.join(directory, "page_cache"),
+        "JINJA_CACHE_DIR": "off",
+        "MAIL_QUEUE_AUTOSTART": "0",
+        "RATE_LIMIT_ENABLED": "0",
+        "PASSWORD_HASH_WORKERS": "0",
+    })
+    import main
+    with main.app.app_context():
+        main.migrations.upgrade()
+    return main
+
+
+@pytest.fixture
+def app(main_module):
+    # Requests are made without an app context around them, as a server would
+    return main_module.app
+
+
+@pytest.fixture
+def users(app, main_module):
+    # The admin (id 1) and a community member (id 2)
+    db, User = main_module.db, main_module.User
+    with app.app_context():
+        for user_id, role in ((1, "Blog-Writer"), (2, "Community_Member")):
+            if db.session.get(User, user_id) is None:
+                db.session.add(User(id=user_id, email=f"user{user_id}@example.com", password="unused",
+                                    name=f"User {user_id}", permission_status=role))
+        db.session.commit()
+    return 1, 2
+
+
+def log_in(client, user_id):
+    with client.session_transaction() as session:
+        session["_user_id"] = str(user_id)
+        session["_fresh"] = True
@@ -0,0 +1,81 @@
+import re
+import pytest
+from tests.conftest import log_in
+
+
+@pytest.fixture
+def post_id(app, main_module):
+    db, BlogPost = main_module.db, main_module.BlogPost
+    with app.app_context():
+        db.session.execute(db.delete(BlogPost))
+        post = BlogPost(title="To delete", subtitle="Subtitle", date="October 18, 2026", author_id=1,
+                        img_url="https://example.com/image.jpg")
+        post.set_body("<p>Body</p>")
+        db.session.add(post)
+        db.session.commit()
+        main_module.page_cache.clear()
+        return post.id
+
+
+def post_exists(app, main_module, post_id):
+    with app.app_context():
+        return main_module.db.session.get(main_module.BlogPost, post_id) is not None
+
+
+def delete_token(client):
+    page = client.get("/").get_data(as_text=True)
+    return re.search(r'name="csrf_token" type="hidden" value="([^"]+)"', page).group(1)
+
+
+def test_delete_needs_post(app, main_module, users, post_id):
+    client = app.test_client()
+    log_in(client, 1)
+    assert client.get(f"/delete/{post_id}").status_code == 405
+    assert post_exists(app, main_module, post_id)
+
+
+def test_only_the_admin_can_delete(app, main_module, users, post_id):
+    client = app.test_client()
+    assert client.post(f"/delete/{post_id}").status_code == 403
+    log_in(client, 2)
+    assert client.post(f"/delete/{post_id}").status_code == 403
+    assert post_exists(app, main_module, post_id)
+
+
+def test_delete_needs_the_csrf_token(app, main_module, users, post_id):
+    client = app.test_client()
+    log_in(client, 1)
+    assert client.post(f"/delete/{post_id}").status_code == 400
+    assert client.post(f"/delete/{post_id}", data={"csrf_token": "forged"}).status_code == 400
+    assert post_exists(app, main_module, post_id)
+
+
+def test_admin_deletes_from_the_home_page(app, main_module, users, post_id):
+    client = app.test_client()
+    log_in(client, 1)
+    response = client.post(f"/delete/{post_id}", data={"csrf_token": delete_token(client)})
+    assert response.status_code == 302
+    assert not post_exists(app, main_module, post_id)
+
+
+def test_visitors_get_no_delete_form(app, users, post_id):
+    page = app.test_client().get("/")
+    assert "csrf_token" not in page.get_data(as_text=True)
+    assert "Set-Cookie" not in page.headers
+
+
+@pytest.mark.parametrize("path", ["/new-post", "/edit-post/{post_id}", "/view_suggested_edits",
+                                  "/remove_suggestion/1"])
+def test_admin_pages_are_checked(app, users, post_id, path):
+    path = path.format(post_id=post_id)
+    client = app.test_client()
+    assert client.get(path).status_code == 403
+    log_in(client, 2)
+    assert client.get(path).status_code == 403
+
+
+@pytest.mark.parametrize("path", ["/new-post", "/edit-post/{post_id}", "/view_suggested_edits"])
+def test_admin_pages_open_for_the_admin(app, users, post_id, path):
+    client = app.test_client()
+    log_in(client, 1)
+    assert client.get(path.format(post_id=post_id)).status_code == 200
@@ -0,0 +1,121 @@
+import os
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+import pytest
+from flask import Flask
+from avatars import AvatarProxy, avatar_hash
+
+# Runs the avatar proxy against a small local stand-in for Gravatar.
+
+Image = pytest.importorskip("PIL.Image")
+
+STATIC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "static")
+KNOWN = avatar_hash("known@example.com")
+MISSING = avatar_hash("missing@example.com")
+BROKEN = avatar_hash("broken@example.com")
+
+
+def png(size, color):
+    buffer = BytesIO()
+    Image.new("RGB", (size, size), color).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+class GravatarHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        hash_value = self.path.split("?")[0].rsplit("/", 1)[-1]
+        with self.server.lock:
+            self.server.calls[hash_value] += 1
+        if hash_value == KNOWN:
+            status, body = 200, png(200, "red")
+        elif hash_value == BROKEN:
+            status, body = 500, b"down"
+        else:
+            status, body = 404, b"not found"
+        self.send_response(status)
+        self.send_header("Content-Type", "image/png" if status == 200 else "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def gravatar():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), GravatarHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.calls = Counter()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def app(gravatar, tmp_path):
+    app = Flask(__name__, static_folder=STATIC)
+    app.config.update(AVATAR_UPSTREAM=f"http://127.0.0.1:{gravatar.server_address[1]}/avatar/",
+                      AVATAR_CACHE_DIR=str(tmp_path / "avatars"))
+    AvatarProxy(app)
+    return app
+
+
+def image_size(response):
+    with Image.open(BytesIO(response.get_data())) as image:
+        return image.size
+
+
+def test_avatar_is_resized_and_cached(app, gravatar):
+    client = app.test_client()
+    small = client.get(f"/avatar/{KNOWN}?s=50")
+    assert small.status_code == 200
+    assert small.content_type == "image/jpeg"
+    assert image_size(small) == (50, 50)
+    assert small.cache_control.max_age == app.config["AVATAR_MAX_AGE"]
+
+    # Every size was made from the one fetch
+    large = client.get(f"/avatar/{KNOWN}?s=150")
+    assert image_size(large) == (200, 200)
+    assert gravatar.calls[KNOWN] == 1
+
+
+def test_etag_gives_304(app):
+    client = app.test_client()
+    first = client.get(f"/avatar/{KNOWN}")
+    again = client.get(f"/avatar/{KNOWN}", headers={"If-None-Match": first.headers["ETag"]})
+    assert again.status_code == 304
+    assert again.get_data() == b""
+
+
+def test_missing_gravatar_gets_the_default_image(app, gravatar):
+    client = app.test_client()
+    response = client.get(f"/avatar/{MISSING}?s=100")
+    assert response.status_code == 200
+    assert image_size(response) == (100, 100)
+    assert response.cache_control.max_age == app.config["AVATAR_MAX_AGE"]
+    # Cached, Gravatar isn't asked again
+    client.get(f"/avatar/{MISSING}?s=200")
+    assert gravatar.calls[MISSING] == 1
+    # The same image as for anyone else without one
+    other = client.get(f"/avatar/{avatar_hash('nobody@example.com')}?s=100")
+    assert other.get_data() == response.get_data()
+
+
+def test_failed_fetch_is_tried_again(app, gravatar):
+    client = app.test_client()
+    response = client.get(f"/avatar/{BROKEN}")
+    assert response.status_code == 200
+    assert response.cache_control.max_age == 300
+    client.get(f"/avatar/{BROKEN}")
+    assert gravatar.calls[BROKEN] == 2
+
+
+def test_bad_hash_is_404(app, gravatar):
+    assert app.test_client().get("/avatar/not-a-hash").status_code == 404
+    assert sum(gravatar.calls.values()) == 0
@@ -0,0 +1,89 @@
+import math
+from datetime import datetime
+import pytest
+
+# The feeds and sitemaps are streamed, and saved in the page cache once the last chunk is out.
+
+
+@pytest.fixture
+def posts(app, main_module):
+    db, BlogPost = main_module.db, main_module.BlogPost
+    with app.app_context():
+        db.session.execute(db.delete(BlogPost))
+        for number in range(1, 6):
+            post = BlogPost(title=f"Post {number}", subtitle=f"Subtitle {number}", date="October 18, 2026",
+                            img_url="https://example.com/image.jpg", created_at=datetime(2026, 10, number))
+            post.set_body(f"<p>Body of post {number}</p>")
+            db.session.add(post)
+        db.session.commit()
+        main_module.page_cache.clear()
+        return db.session.execute(db.select(BlogPost.id).order_by(BlogPost.id)).scalars().all()
+
+
+def fetch_twice(client, path):
+    first = client.get(path)
+    first_body = first.get_data()
+    second = client.get(path)
+    assert first.status_code == second.status_code == 200
+    assert first.headers["X-Page-Cache"] == "MISS"
+    assert second.headers["X-Page-Cache"] == "HIT"
+    assert second.get_data() == first_body
+    assert second.headers["ETag"] == first.headers["ETag"]
+
+    not_modified = client.get(path, headers={"If-None-Match": first.headers["ETag"]})
+    assert not_modified.status_code == 304
+    assert not_modified.get_data() == b""
+    return first_body.decode()
+
+
+def test_atom_feed(app, posts):
+    body = fetch_twice(app.test_client(), "/feed.xml")
+    assert body.startswith('<?xml version="1.0" encoding="utf-8"?>')
+    assert body.count("<entry>") == 5
+    assert body.rstrip().endswith("</feed>")
+    assert "__page_cache_csrf_token__" not in body
+
+
+def test_rss_feed(app, posts):
+    body = fetch_twice(app.test_client(), "/rss.xml")
+    assert body.count("<item>") == 5
+    assert body.rstrip().endswith("</rss>")
+
+
+def test_sitemap(app, posts):
+    body = fetch_twice(app.test_client(), "/sitemap.xml")
+    assert "<urlset" in body
+    for post_id in posts:
+        assert f"/post/{post_id}</loc>" in body
+
+
+def test_sitemap_index_and_shards(app, posts, monkeypatch):
+    # Three static pages, so each shard holds two posts
+    monkeypatch.setitem(app.config, "SITEMAP_MAX_URLS", 5)
+    client = app.test_client()
+    index = fetch_twice(client, "/sitemap.xml")
+    assert "<sitemapindex" in index
+    shards = index.count("<sitemap>")
+    assert shards == math.ceil(max(posts) / 2)
+
+    listed = []
+    for shard in range(1, shards + 1):
+        body = fetch_twice(client, f"/sitemap-{shard}.xml")
+        listed += [post_id for post_id in posts if f"/post/{post_id}</loc>" in body]
+    assert sorted(listed) == posts
+    assert client.get(f"/sitemap-{shards + 1}.xml").status_code == 404
+
+
+def test_new_post_changes_the_feed(app, posts, main_module):
+    client = app.test_client()
+    first = client.get("/feed.xml")
+    first.get_data()
+    with app.app_context():
+        post = main_module.db.session.get(main_module.BlogPost, posts[0])
+        post.title = "Renamed"
+        main_module.db.session.commit()
+        main_module.page_cache.invalidate("posts")
+    second = client.get("/feed.xml", headers={"If-None-Match": first.headers["ETag"]})
+    assert second.status_code == 200
+    assert second.headers["X-Page-Cache"] == "MISS"
+    assert "<title>Renamed</title>" in second.get_data(as_text=True)
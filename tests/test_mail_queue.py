@@ -0,0 +1,182 @@
+import socketserver
+import threading
+from datetime import datetime, timedelta
+import pytest
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DateTime, Integer, String, Text
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
+from mail_queue import DEAD, PENDING, SENT, Email, MailQueue
+
+# Runs the mail queue against a small local SMTP server (in the spirit of aiosmtpd's
+# Controller) and an in-memory SQLite database. Run with "python -m pytest tests" (needs pytest).
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        server = self.server
+        self.reply("220 localhost test SMTP")
+        while True:
+            line = self.rfile.readline().decode()
+            if not line:
+                return
+            command = line[:4].upper()
+            if command in ("EHLO", "HELO"):
+                self.reply("250 localhost")
+            elif command == "MAIL":
+                if server.failing:
+                    self.reply("451 Try again later")
+                else:
+                    self.reply("250 OK")
+            elif command == "RCPT":
+                self.reply("250 OK")
+            elif command == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                data = []
+                while True:
+                    data_line = self.rfile.readline().decode()
+                    if data_line in (".\r\n", ""):
+                        break
+                    data.append(data_line)
+                server.messages.append("".join(data))
+                self.reply("250 OK")
+            elif command == "RSET" or command == "NOOP":
+                self.reply("250 OK")
+            elif command == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Not implemented")
+
+
+class SMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), SMTPHandler)
+        self.messages = []
+        self.failing = False
+
+
+@pytest.fixture
+def smtp_server():
+    server = SMTPServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def queue(smtp_server):
+    class Base(DeclarativeBase):
+        pass
+
+    db = SQLAlchemy(model_class=Base)
+
+    class Outgoing_Email(db.Model):
+        __tablename__ = 'outgoing_emails'
+        id: Mapped[int] = mapped_column(Integer, primary_key=True)
+        subject: Mapped[str] = mapped_column(String(250), nullable=False)
+        sender: Mapped[str] = mapped_column(String(250), nullable=True)
+        recipients: Mapped[str] = mapped_column(Text, nullable=False, default="")
+        bcc: Mapped[str] = mapped_column(Text, nullable=False, default="")
+        body: Mapped[str] = mapped_column(Text, nullable=False)
+        status: Mapped[str] = mapped_column(String(20), nullable=False, default="pending")
+        attempts: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+        last_error: Mapped[str] = mapped_column(Text, nullable=True)
+        next_attempt_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+        locked_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+        created_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+        sent_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+
+    app = Flask(__name__)
+    app.config.update(
+        SQLALCHEMY_DATABASE_URI="sqlite://",
+        MAIL_SERVER="127.0.0.1",
+        MAIL_PORT=smtp_server.server_address[1],
+        MAIL_USE_TLS=False,
+        MAIL_USE_SSL=False,
+        MAIL_QUEUE_AUTOSTART=False,
+        MAIL_QUEUE_MAX_ATTEMPTS=3,
+        MAIL_QUEUE_RETRY_DELAY=30,
+    )
+    db.init_app(app)
+    mail_queue = MailQueue(app, db, model=Outgoing_Email)
+    with app.app_context():
+        db.create_all()
+        yield mail_queue
+
+
+def enqueue(queue):
+    return queue.enqueue(Email("Hello", sender="blog@example.com", recipients=["reader@example.com"], body="Hi!"))
+
+
+def make_due(queue, job):
+    # Skip the backoff wait
+    job.next_attempt_at = datetime.utcnow() - timedelta(seconds=1)
+    queue.db.session.commit()
+
+
+def test_sends_queued_email(queue, smtp_server):
+    job = enqueue(queue)
+    queue.drain()
+    queue.db.session.refresh(job)
+    assert job.status == SENT
+    assert job.attempts == 1
+    assert job.sent_at is not None
+    assert len(smtp_server.messages) == 1
+    assert "Subject: Hello" in smtp_server.messages[0]
+
+
+def test_failed_send_is_retried_with_backoff(queue, smtp_server):
+    smtp_server.failing = True
+    job = enqueue(queue)
+    queue.drain()
+    queue.db.session.refresh(job)
+    assert job.status == PENDING
+    assert job.attempts == 1
+    assert job.last_error
+    first_delay = (job.next_attempt_at - datetime.utcnow()).total_seconds()
+    assert 25 < first_delay <= 30
+
+    # Not due yet, so nothing is tried
+    queue.drain()
+    queue.db.session.refresh(job)
+    assert job.attempts == 1
+
+    make_due(queue, job)
+    queue.drain()
+    queue.db.session.refresh(job)
+    assert job.attempts == 2
+    second_delay = (job.next_attempt_at - datetime.utcnow()).total_seconds()
+    assert 55 < second_delay <= 60
+
+    smtp_server.failing = False
+    make_due(queue, job)
+    queue.drain()
+    queue.db.session.refresh(job)
+    assert job.status == SENT
+    assert len(smtp_server.messages) == 1
+
+
+def test_gives_up_after_max_attempts(queue, smtp_server):
+    smtp_server.failing = True
+    job = enqueue(queue)
+    for _ in range(3):
+        make_due(queue, job)
+        queue.drain()
+        queue.db.session.refresh(job)
+    assert job.status == DEAD
+    assert job.attempts == 3
+
+    make_due(queue, job)
+    queue.drain()
+    queue.db.session.refresh(job)
+    assert job.attempts == 3
+    assert smtp_server.messages == []
@@ -0,0 +1,84 @@
+import threading
+import pytest
+from flask import Flask
+from werkzeug.security import generate_password_hash
+from password_hashing import HashingBusy, PasswordHasher
+
+
+def make_hasher(**config):
+    app = Flask(__name__)
+    app.config.update(PASSWORD_HASH_METHOD="pbkdf2:sha256:1000", **config)
+    return app, PasswordHasher(app)
+
+
+@pytest.mark.parametrize("workers", [0, 1])
+def test_hash_and_verify(workers):
+    _, hasher = make_hasher(PASSWORD_HASH_WORKERS=workers)
+    pwhash = hasher.hash("secret")
+    assert pwhash.startswith("pbkdf2:sha256:1000$")
+    assert hasher.verify(pwhash, "secret")
+    assert not hasher.verify(pwhash, "wrong")
+    assert not hasher.needs_rehash(pwhash)
+    assert hasher.stats()["completed"] == 3
+    # Hashed in a worker process, or on this thread when there are none
+    assert (hasher._pool is not None) == bool(workers)
+    if hasher._pool is not None:
+        hasher._pool.shutdown()
+
+
+def test_older_settings_need_a_rehash():
+    _, hasher = make_hasher(PASSWORD_HASH_WORKERS=0)
+    assert hasher.needs_rehash(generate_password_hash("secret", "pbkdf2:sha256:500", 16))
+    assert hasher.needs_rehash(generate_password_hash("secret", "pbkdf2:sha256:1000", 8))
+    assert hasher.needs_rehash("not a hash")
+
+
+def test_full_queue_answers_503():
+    app, hasher = make_hasher(PASSWORD_HASH_WORKERS=0, PASSWORD_HASH_MAX_PENDING=1,
+                              PASSWORD_HASH_QUEUE_TIMEOUT=0.1)
+
+    @app.route("/hash")
+    def hash_view():
+        return hasher.hash("secret")
+
+    # Hold the only slot
+    release = threading.Event()
+    holding = threading.Thread(target=hasher._run, args=(release.wait,))
+    holding.start()
+    try:
+        while hasher.stats()["pending"] == 0:
+            release.wait(0.01)
+        with pytest.raises(HashingBusy):
+            hasher.hash("secret")
+        response = app.test_client().get("/hash")
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "5"
+        assert hasher.stats()["rejected"] == 2
+    finally:
+        release.set()
+        holding.join()
+    assert app.test_client().get("/hash").status_code == 200
+
+
+def test_login_rehashes_old_hashes(app, main_module, monkeypatch):
+    db, User = main_module.db, main_module.User
+    monkeypatch.setitem(app.config, "WTF_CSRF_ENABLED", False)
+    with app.app_context():
+        old_hash = generate_password_hash("secret", "pbkdf2:sha256:1000", 8)
+        db.session.execute(db.delete(User).where(User.email == "rehash@example.com"))
+        user = User(email="rehash@example.com", password=old_hash, name="Rehash", permission_status="Community_Member")
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+
+    client = app.test_client()
+    client.post("/login", data={"email": "rehash@example.com", "password": "wrong"})
+    with app.app_context():
+        assert db.session.get(User, user_id).password == old_hash
+
+    client.post("/login", data={"email": "rehash@example.com", "password": "secret"})
+    with app.app_context():
+        new_hash = db.session.get(User, user_id).password
+    assert new_hash != old_hash
+    assert not main_module.password_hasher.needs_rehash(new_hash)
+    assert main_module.password_hasher.verify(new_hash, "secret")
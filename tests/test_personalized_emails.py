@@ -0,0 +1,173 @@
+import json
+import threading
+from collections import Counter
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import pytest
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DateTime, Integer, String, Text
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
+from lookup_cache import LookupCache
+from mail_queue import MailQueue
+from news_weather import NewsWeatherClient, PersonalizedEmailJob
+
+# Runs the personalized emails against a small local stand-in for NewsAPI and OpenWeather, and
+# checks that every distinct interest, location and forecast point is fetched once.
+
+PLACES = {"Boston": (42.36, -71.06), "Cambridge": (42.37, -71.11), "Cambridge MA": (42.37, -71.11)}
+
+
+class APIHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {name: values[0] for name, values in parse_qs(url.query).items()}
+        with self.server.lock:
+            self.server.calls[(url.path, query.get("qInTitle") or query.get("q") or query.get("lat"))] += 1
+        if url.path == "/news":
+            if query["qInTitle"] in self.server.failing:
+                return self.send_json(500, {"status": "error"})
+            articles = [{"title": f"{query['qInTitle']} story {number}", "description": "Description"}
+                        for number in range(5)]
+            return self.send_json(200, {"articles": articles})
+        if url.path == "/geo":
+            place = PLACES.get(query["q"])
+            return self.send_json(200, [{"lat": place[0], "lon": place[1]}] if place else [])
+        if url.path == "/forecast":
+            hour = {"weather": [{"main": "Cloud", "id": 801}], "wind": {"speed": 3},
+                    "main": {"temp_min": 280, "temp_max": 285, "feels_like": 281}}
+            return self.send_json(200, {"list": [hour] * 8})
+        self.send_json(404, {})
+
+
+@pytest.fixture
+def api_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), APIHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.calls = Counter()
+    server.failing = set()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def client(api_server):
+    url = f"http://127.0.0.1:{api_server.server_address[1]}"
+    client = NewsWeatherClient(news_url=f"{url}/news", geocoding_url=f"{url}/geo", forecast_url=f"{url}/forecast",
+                               timeout=5)
+    yield client
+    client.close()
+
+
+@pytest.fixture
+def setup():
+    class Base(DeclarativeBase):
+        pass
+
+    db = SQLAlchemy(model_class=Base)
+
+    class User(db.Model):
+        __tablename__ = 'users'
+        id: Mapped[int] = mapped_column(Integer, primary_key=True)
+        email: Mapped[str] = mapped_column(String(100))
+        interests: Mapped[str] = mapped_column(Text, nullable=True)
+        approx_location: Mapped[str] = mapped_column(Text, nullable=True)
+
+    class Outgoing_Email(db.Model):
+        __tablename__ = 'outgoing_emails'
+        id: Mapped[int] = mapped_column(Integer, primary_key=True)
+        subject: Mapped[str] = mapped_column(String(250), nullable=False)
+        sender: Mapped[str] = mapped_column(String(250), nullable=True)
+        recipients: Mapped[str] = mapped_column(Text, nullable=False, default="")
+        bcc: Mapped[str] = mapped_column(Text, nullable=False, default="")
+        body: Mapped[str] = mapped_column(Text, nullable=False)
+        status: Mapped[str] = mapped_column(String(20), nullable=False, default="pending")
+        attempts: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+        last_error: Mapped[str] = mapped_column(Text, nullable=True)
+        next_attempt_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+        locked_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+        created_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+        sent_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+
+    app = Flask(__name__)
+    app.config.update(SQLALCHEMY_DATABASE_URI="sqlite://", MAIL_QUEUE_AUTOSTART=False,
+                      PERSONALIZED_EMAIL_FETCH_WORKERS=4)
+    db.init_app(app)
+    mail_queue = MailQueue(app, db, model=Outgoing_Email)
+    with app.app_context():
+        db.create_all()
+        users = [("a@example.com", "python", "Boston"), ("b@example.com", "python", "Boston"),
+                 ("c@example.com", "flask", "Cambridge"), ("d@example.com", "flask", "Cambridge MA"),
+                 ("e@example.com", "python", "Atlantis"), ("f@example.com", None, "Boston")]
+        db.session.add_all(User(email=email, interests=interests, approx_location=location)
+                           for email, interests, location in users)
+        db.session.commit()
+        yield app, db, User, mail_queue, Outgoing_Email
+
+
+def run_job(setup, client, cache=None):
+    app, db, User, mail_queue, _ = setup
+    return PersonalizedEmailJob().run(app, db, User, mail_queue, "blog@example.com", client=client, cache=cache)
+
+
+def queued(setup):
+    app, db, _, _, Outgoing_Email = setup
+    return {email.recipients: email.body for email in db.session.execute(db.select(Outgoing_Email)).scalars()}
+
+
+def test_fetches_each_interest_location_and_point_once(setup, client, api_server):
+    progress = run_job(setup, client)
+    assert progress["state"] == "finished"
+    assert progress["total_users"] == 5
+    assert progress["enqueued"] == 4
+    # Nobody at Atlantis, OpenWeather doesn't know it
+    assert progress["skipped"] == 1
+    assert progress["errors"] == []
+
+    calls = api_server.calls
+    assert calls[("/news", "python")] == calls[("/news", "flask")] == 1
+    assert sum(count for (path, _), count in calls.items() if path == "/geo") == 4
+    # Cambridge and Cambridge MA are the same point
+    assert sum(count for (path, _), count in calls.items() if path == "/forecast") == 2
+
+    emails = queued(setup)
+    assert sorted(emails) == ["a@example.com", "b@example.com", "c@example.com", "d@example.com"]
+    assert "python story 0" in emails["a@example.com"]
+    assert "flask story 2" in emails["d@example.com"]
+    assert "story 3" not in emails["a@example.com"]
+    assert "Sunny Weather Today!" in emails["c@example.com"]
+
+
+def test_failed_lookup_skips_its_users(setup, client, api_server):
+    api_server.failing.add("flask")
+    progress = run_job(setup, client)
+    assert progress["enqueued"] == 2
+    assert progress["skipped"] == 3
+    assert len(progress["errors"]) == 1
+    assert "flask" in progress["errors"][0]
+    assert sorted(queued(setup)) == ["a@example.com", "b@example.com"]
+
+
+def test_cached_lookups_are_not_fetched_again(setup, client, api_server):
+    cache = LookupCache(ttls={"news": 60, "forecast": 60, "geocode": None}, negative_ttls={"geocode": 60})
+    run_job(setup, client, cache)
+    first_calls = sum(api_server.calls.values())
+    progress = run_job(setup, client, cache)
+    assert sum(api_server.calls.values()) == first_calls
+    assert progress["enqueued"] == 4
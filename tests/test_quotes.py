@@ -0,0 +1,66 @@
+from collections import Counter
+from datetime import datetime
+import pytest
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DateTime, Integer, String, Text
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
+from page_cache import PageCache
+from quotes import QuotePool
+
+
+@pytest.fixture(params=["memory", "null"])
+def workers(request, tmp_path):
+    # Two quote pools, as two worker processes would have, over one database
+    class Base(DeclarativeBase):
+        pass
+
+    db = SQLAlchemy(model_class=Base)
+
+    class Quote(db.Model):
+        __tablename__ = "quotes"
+        id: Mapped[int] = mapped_column(Integer, primary_key=True)
+        text: Mapped[str] = mapped_column(Text, nullable=False)
+        author: Mapped[str] = mapped_column(String(250), nullable=True)
+        weight: Mapped[int] = mapped_column(Integer, nullable=False, default=1)
+        created_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, default=datetime.utcnow)
+        updated_at: Mapped[datetime] = mapped_column(DateTime, nullable=True, default=datetime.utcnow,
+                                                     onupdate=datetime.utcnow)
+
+    app = Flask(__name__)
+    app.config.update(SQLALCHEMY_DATABASE_URI=f"sqlite:///{tmp_path / 'quotes.db'}", PAGE_CACHE_TYPE=request.param,
+                      PAGE_CACHE_DIR=str(tmp_path / "page_cache"), QUOTE_POOL_TTL=3600)
+    db.init_app(app)
+    pools = [QuotePool(app, db, Quote, PageCache(app)) for _ in range(2)]
+    with app.app_context():
+        db.create_all()
+        db.session.add(Quote(text="First", weight=1))
+        db.session.commit()
+        yield db, Quote, pools
+
+
+def test_weights_decide_how_often_a_quote_is_picked(workers):
+    db, Quote, (pool, _) = workers
+    db.session.add_all([Quote(text="Common", author="Someone", weight=3), Quote(text="Hidden", weight=0)])
+    db.session.commit()
+    pool.changed()
+    picks = Counter(pool.choice() for _ in range(4000))
+    assert set(picks) == {"First", "Common - Someone"}
+    assert 2.5 < picks["Common - Someone"] / picks["First"] < 3.5
+
+
+def test_other_workers_see_changes(workers):
+    db, Quote, (editor, other) = workers
+    assert other.choice() == "First"
+
+    quote = db.session.execute(db.select(Quote)).scalar_one()
+    quote.text = "Edited"
+    db.session.commit()
+    editor.changed()
+    assert other.choice() == "Edited"
+
+    db.session.add(Quote(text="Second", weight=1))
+    db.session.delete(quote)
+    db.session.commit()
+    editor.changed()
+    assert other.choice() == "Second"
@@ -0,0 +1,113 @@
+import time
+import pytest
+from flask import Flask, request
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import Integer, String, insert
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
+from read_replica import REPLICA, ReadReplica, RoutingSession
+
+# Two SQLite files stand in for the primary and its replica. Each holds a row naming the
+# database, so a page shows where its SELECT went.
+
+
+def make_app(tmp_path, replica=True):
+    class Base(DeclarativeBase):
+        pass
+
+    db = SQLAlchemy(model_class=Base, session_options={"class_": RoutingSession})
+
+    class Note(db.Model):
+        __tablename__ = 'notes'
+        id: Mapped[int] = mapped_column(Integer, primary_key=True)
+        text: Mapped[str] = mapped_column(String(50))
+
+    app = Flask(__name__)
+    app.config.update(SECRET_KEY="test", SQLALCHEMY_DATABASE_URI=f"sqlite:///{tmp_path / 'primary.db'}",
+                      REPLICA_ENDPOINTS=("notes", "touch"), REPLICA_STICKY_SECONDS=10)
+    if replica:
+        app.config['SQLALCHEMY_BINDS'] = {REPLICA: f"sqlite:///{tmp_path / 'replica.db'}"}
+    db.init_app(app)
+    read_replica = ReadReplica(app, db)
+
+    def first_note():
+        return db.session.execute(db.select(Note.text).order_by(Note.id)).scalars().first()
+
+    @app.route("/notes")
+    def notes():
+        return first_note()
+
+    @app.route("/other")
+    def other():
+        return first_note()
+
+    @app.route("/notes", methods=["POST"], endpoint="add_note")
+    def add_note():
+        db.session.add(Note(text=request.form["text"]))
+        db.session.commit()
+        return "added"
+
+    @app.route("/touch")
+    def touch():
+        # A listed page that writes (like saving a post's rendered HTML), then reads
+        db.session.add(Note(text="touched"))
+        db.session.flush()
+        return first_note()
+
+    with app.app_context():
+        for name, engine in db.engines.items():
+            Base.metadata.create_all(engine)
+            with engine.begin() as connection:
+                connection.execute(insert(Note.__table__).values(text=name or "primary"))
+    return app, read_replica
+
+
+@pytest.fixture
+def replica_app(tmp_path):
+    return make_app(tmp_path)
+
+
+def test_listed_pages_read_from_the_replica(replica_app):
+    app, _ = replica_app
+    client = app.test_client()
+    assert client.get("/notes").get_data(as_text=True) == REPLICA
+    assert client.get("/other").get_data(as_text=True) == "primary"
+
+
+def test_reads_after_a_write_use_the_primary(replica_app):
+    app, _ = replica_app
+    assert app.test_client().get("/touch").get_data(as_text=True) == "primary"
+
+
+def test_writer_stays_on_the_primary(replica_app):
+    app, read_replica = replica_app
+    writer = app.test_client()
+    writer.post("/notes", data={"text": "new"})
+    # As if another worker process had handled the write
+    read_replica._last_write = 0
+    assert writer.get("/notes").get_data(as_text=True) == "primary"
+    assert app.test_client().get("/notes").get_data(as_text=True) == REPLICA
+
+    with writer.session_transaction() as session:
+        session["db_written_at"] = time.time() - 11
+    assert writer.get("/notes").get_data(as_text=True) == REPLICA
+
+
+def test_worker_that_wrote_stays_on_the_primary(replica_app):
+    app, read_replica = replica_app
+    app.test_client().post("/notes", data={"text": "new"})
+    assert app.test_client().get("/notes").get_data(as_text=True) == "primary"
+    read_replica._last_write -= 11
+    assert app.test_client().get("/notes").get_data(as_text=True) == REPLICA
+
+
+def test_reading_pages_leave_no_cookie(replica_app):
+    app, _ = replica_app
+    assert "Set-Cookie" not in app.test_client().get("/notes").headers
+
+
+def test_without_a_replica_everything_uses_the_primary(tmp_path):
+    app, _ = make_app(tmp_path, replica=False)
+    client = app.test_client()
+    assert client.get("/notes").get_data(as_text=True) == "primary"
+    client.post("/notes", data={"text": "new"})
+    assert client.get("/notes").get_data(as_text=True) == "primary"
@@ -0,0 +1,35 @@
+from datetime import datetime
+
+
+def add_post(main_module, title, updated_at, rendered):
+    post = main_module.BlogPost(title=title, subtitle="Subtitle", date="October 18, 2026",
+                                img_url="https://example.com/image.jpg", updated_at=updated_at)
+    if rendered:
+        post.set_body("<p>Already rendered</p>")
+    else:
+        # Saved before renditions existed
+        post.body = "<h2>Heading</h2><p>Never rendered</p>"
+    main_module.db.session.add(post)
+    return post
+
+
+def test_render_posts_keeps_updated_at(app, main_module):
+    db, BlogPost = main_module.db, main_module.BlogPost
+    edited = datetime(2026, 1, 2, 3, 4, 5)
+    with app.app_context():
+        db.session.execute(db.delete(BlogPost))
+        new = add_post(main_module, "Not rendered", edited, rendered=False)
+        old = add_post(main_module, "Rendered", edited, rendered=True)
+        db.session.commit()
+        new_id, old_id = new.id, old.id
+
+    result = app.test_cli_runner().invoke(args=["render-posts", "--all"])
+    assert result.exit_code == 0
+    assert "Rendered 1 blog_posts" in result.output
+
+    with app.app_context():
+        new, old = db.session.get(BlogPost, new_id), db.session.get(BlogPost, old_id)
+        assert "Never rendered" in new.body_html
+        assert new.excerpt == "Heading Never rendered"
+        assert new.toc
+        assert new.updated_at == old.updated_at == edited
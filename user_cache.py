@@ -0,0 +1,62 @@
+from typing import NamedTuple
+from page_cache import MemoryCache
+
+# Flask-Login loads the logged in user on every request. Instead of a users row (with all its
+# Text columns) every time, it gets a small read only Principal with just what pages and
+# permission checks use, kept in a per-process LRU cache for USER_CACHE_TTL seconds.
+# Routes that change a user's name, email or permission (or delete them) call invalidate().
+# Other gunicorn workers see the change once their copy expires.
+#
+# current_user is a Principal, not a User, so code that changes the user or links rows to them
+# loads the User (db.session.get(User, current_user.id)) or uses current_user.id.
+
+
+class Principal(NamedTuple):
+    id: int
+    name: str
+    email: str
+    permission_status: str
+
+    # What Flask-Login needs from a user object
+    is_authenticated = True
+    is_active = True
+    is_anonymous = False
+
+    def get_id(self):
+        return str(self.id)
+
+
+class UserCache:
+    def __init__(self, app=None, db=None, user_model=None):
+        if app is not None:
+            self.init_app(app, db, user_model)
+
+    def init_app(self, app, db, user_model):
+        self.db = db
+        self.user_model = user_model
+        app.config.setdefault('USER_CACHE_MAX_ENTRIES', 1000)
+        app.config.setdefault('USER_CACHE_TTL', 60)
+        self._cache = MemoryCache(max_entries=app.config['USER_CACHE_MAX_ENTRIES'],
+                                  timeout=app.config['USER_CACHE_TTL'])
+        app.extensions['user_cache'] = self
+
+    def load(self, user_id):
+        try:
+            user_id = int(user_id)
+        except (TypeError, ValueError):
+            return None
+        principal = self._cache.get(user_id)
+        if principal is not None:
+            return principal
+        user = self.user_model
+        row = self.db.session.execute(
+            self.db.select(user.id, user.name, user.email, user.permission_status).where(user.id == user_id)
+        ).first()
+        if row is None:
+            return None
+        principal = Principal(*row)
+        self._cache.set(user_id, principal)
+        return principal
+
+    def invalidate(self, user_id):
+        self._cache.delete(int(user_id))